@@ -1,51 +1,107 @@
 #! /usr/bin/python3
-import base64, json, os, datetime
+import base64, hashlib, hmac, os, datetime
+from urllib.parse import quote
 
-from flask import Flask, request, redirect
+from flask import Flask, request, redirect, abort
 import requests
 
-import config
+from tenants import config
+import http_client
+import qb_tokens
+import state
+import tenants
 
+application_path = os.path.abspath(os.path.dirname(__file__))
 app = Flask(__name__)
 
+def get_tenant_path(tenant: str) -> str:
+    # The folder of the tenant named in the URL. The config.py location only without config.tenants, as nothing
+    # syncs it once tenants are configured
+    if tenant is None and not tenants.get_tenants():
+        return application_path
+    if tenant is not None and tenant in tenants.get_tenants():
+        return tenants.get_application_path(application_path, tenant)
+    abort(404)
+
+
 @app.route(config.qb_auth_slug)
 def authorization():
-    # Check if user returned from the authorization page with the code
+    # Check if user returned from the authorization page with the code. The tenant goes to the authorization page
+    # as ?tenant=<name> and comes back in the OAuth state, the redirect URI stays the same for all of them
     authCode = request.args.get('code')
-    if authCode:
-        # send the code to get the token
-        headers = {
-            'Accept': 'application/json',
-            'content-type': 'application/x-www-form-urlencoded',
-            'Authorization': 'Basic ' + str(base64.b64encode((config.qb_id + ':' + config.qb_secret).encode("utf-8")), "utf-8")
-        }
-        payload = {
-            'code': authCode,
-            'redirect_uri': config.qb_redirect_uri + config.qb_auth_slug,
-            'grant_type': 'authorization_code'
-        }
-        response = requests.post(f'https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer', data=payload, headers=headers)
-
-        variables = json.load(open('variables.txt', 'r'))
-        variables['quickbooks']['access token'] = response.json()['access_token']
-        variables['quickbooks']['refresh token'] = response.json()['refresh_token']
-        # Add almost an hour to account for slow requests speed:
-        variables['quickbooks']['best before'] = (
-                    datetime.datetime.utcnow() + datetime.timedelta(seconds=3300)).isoformat()
-
-        json.dump(variables, open('variables.txt', 'w'))  # Save them immediately
-
-        return f'\n\nThe app is authorized, thank you.\n\nYou can close this tab now.'
-
-    else:
-        # send the authorization request to get the code
-        redirectUrl = f'https://appcenter.intuit.com/app/connect/oauth2/authorize?' \
-                      f'scope={config.qb_scope}&' \
-                      f'client_id={config.qb_id}&' \
-                      f'response_type=code&' \
-                      f'redirect_uri={config.qb_redirect_uri}{config.qb_auth_slug}&' \
-                      f'state=ProductionAuth'
-        return redirect(redirectUrl)
+    tenant = request.args.get('state' if authCode else 'tenant')
+    if tenant == 'ProductionAuth':
+        tenant = None
+    tenant_path = get_tenant_path(tenant)
+    with tenants.use(tenant):
+        if authCode:
+            if request.args.get('realmId', config.qb_company_id) != config.qb_company_id:
+                return f'\n\nThe app was authorized for company {request.args["realmId"]}, but ' \
+                       f'{tenant or "config.py"} uses company {config.qb_company_id}. Nothing was saved.', 400
+            # send the code to get the token
+            headers = {
+                'Accept': 'application/json',
+                'content-type': 'application/x-www-form-urlencoded',
+                'Authorization': 'Basic ' + str(base64.b64encode((config.qb_id + ':' + config.qb_secret).encode("utf-8")), "utf-8")
+            }
+            payload = {
+                'code': authCode,
+                'redirect_uri': config.qb_redirect_uri + config.qb_auth_slug,
+                'grant_type': 'authorization_code'
+            }
+            response = requests.post(http_client.base_url('quickbooks oauth', qb_tokens.OAUTH_URL) + '/oauth2/v1/tokens/bearer',
+                                     data=payload, headers=headers)
+
+            token = state.get_cursor(tenant_path, 'quickbooks')
+            token['access token'] = response.json()['access_token']
+            token['refresh token'] = response.json()['refresh_token']
+            # Add almost an hour to account for slow requests speed:
+            token['best before'] = (
+                        datetime.datetime.utcnow() + datetime.timedelta(seconds=3300)).isoformat()
+
+            # The running scripts pick up the new token when its version changes
+            state.save(tenant_path, 'quickbooks', cursor=token)
+
+            return f'\n\nThe app is authorized, thank you.\n\nYou can close this tab now.'
+
+        else:
+            # send the authorization request to get the code
+            redirectUrl = f'https://appcenter.intuit.com/app/connect/oauth2/authorize?' \
+                          f'scope={config.qb_scope}&' \
+                          f'client_id={config.qb_id}&' \
+                          f'response_type=code&' \
+                          f'redirect_uri={config.qb_redirect_uri}{config.qb_auth_slug}&' \
+                          f'state={quote(tenant or "ProductionAuth")}'
+            return redirect(redirectUrl)
+
+def verify_shopify(body: bytes, headers) -> bool:
+    # https://shopify.dev/docs/apps/webhooks/configuration/https#step-5-verify-the-webhook
+    digest = hmac.new(config.shopify_webhook_secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest), headers.get('X-Shopify-Hmac-Sha256', '').encode('utf-8'))
+
+
+# Platforms that push orders, with the signature check and the topics that carry new orders
+webhooks = {
+    'shopify': {'verify': verify_shopify, 'topic header': 'X-Shopify-Topic', 'topics': {'orders/create'}}
+}
+
+
+@app.route('/webhooks/<platform>', methods=['POST'])
+@app.route('/webhooks/<tenant>/<platform>', methods=['POST'])
+def webhook(platform, tenant=None):
+    # Only verify and store the payload, the pipeline takes it from the inbox, so the platform gets its answer
+    # without waiting for Sheets or QuickBooks. With config.tenants, every tenant's webhooks go to
+    # /webhooks/<tenant>/<platform>, the plain route answers 404 instead of filling an inbox nothing reads
+    if platform not in webhooks:
+        abort(404)
+    tenant_path = get_tenant_path(tenant)
+    with tenants.use(tenant):
+        body = request.get_data()
+        if not webhooks[platform]['verify'](body, request.headers):
+            abort(401)
+        if request.headers.get(webhooks[platform]['topic header']) in webhooks[platform]['topics']:
+            state.enqueue(tenant_path, platform, body.decode('utf-8'))
+    return '', 200
 
 @app.route('/')
 def hello_world():
@@ -0,0 +1,71 @@
+#! /usr/bin/python3
+# Reads the orders of a past period again, e.g. after losing the state database. worker.py, main.py or daemon.py write
+# them as usual. The cursors aren't touched. Google Sheets skips the orders it already shows and only has the deliveries
+# from yesterday on. Notch orders are remembered as seen and the ones still to be delivered go to the dashboard.
+# Shopify orders only go to QuickBooks with --quickbooks, for the ones that never had an estimate:
+#   python3 backfill.py notch --since 2021-06-01 --until 2021-07-01 --connections 4
+#   python3 backfill.py shopify --since 2021-01-01
+import argparse, datetime, os
+
+import logging_module, main, notch, shopify, tenants
+
+
+def run_notch(args: argparse.Namespace, application_path: str) -> None:
+    local_time = main.get_local_time()
+    logger = logging_module.get_logger(application_path=application_path, local_time=local_time)
+    for tenant in args.tenant or tenants.get_tenants() or [None]:
+        with tenants.use(tenant):
+            results = notch.backfill(
+                logger=logger,
+                application_path=tenants.get_application_path(application_path, tenant),
+                local_time=local_time,
+                since=args.since,
+                until=args.until,
+                connections=args.connections
+            )
+        print(f'{tenant or "config.py"}: {results["orders"]} orders read from {results["messages"]} messages, '
+              f'{results["queued"]} still to be delivered queued for the dashboard'
+              + (f', {results["failed ranges"]} ranges failed, run it again' if results['failed ranges'] else ''))
+    logging_module.write_metrics(application_path=application_path, logger=logger)
+
+
+def run_shopify(args: argparse.Namespace, application_path: str) -> None:
+    logger = logging_module.get_logger(application_path=application_path, local_time=main.get_local_time())
+    for tenant in args.tenant or tenants.get_tenants() or [None]:
+        with tenants.use(tenant):
+            results = shopify.backfill(
+                logger=logger,
+                application_path=tenants.get_application_path(application_path, tenant),
+                since=args.since,
+                until=args.until,
+                quickbooks=args.quickbooks
+            )
+        print(f'{tenant or "config.py"}: {results["orders"]} orders queued'
+              + (f', {results["failed"]} couldn\'t be read' if results['failed'] else ''))
+    logging_module.write_metrics(application_path=application_path, logger=logger)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reads the orders of a past period again and queues them for the sinks')
+    parser.add_argument('--tenant', action='append', help='Only this tenant, can be repeated. All of them by default')
+    subparsers = parser.add_subparsers(required=True)
+
+    notch_backfill = subparsers.add_parser(
+        'notch', help='Notch notifications received in the period: their orders are remembered as seen, the ones '
+                      'still to be delivered are queued for the dashboard')
+    notch_backfill.add_argument('--since', type=datetime.date.fromisoformat, required=True)
+    notch_backfill.add_argument('--until', type=datetime.date.fromisoformat, help='Excluded, today by default')
+    notch_backfill.add_argument('--connections', type=int, default=notch.DEFAULT_BACKFILL_CONNECTIONS,
+                                help='IMAP connections reading the mailbox at the same time')
+    notch_backfill.set_defaults(run=run_notch)
+
+    shopify_backfill = subparsers.add_parser('shopify', help='Open Shopify orders created in the period, by a bulk query')
+    shopify_backfill.add_argument('--since', type=datetime.date.fromisoformat, required=True)
+    shopify_backfill.add_argument('--until', type=datetime.date.fromisoformat, help='Excluded, today by default')
+    shopify_backfill.add_argument('--quickbooks', action='store_true',
+                                  help='Create their QuickBooks estimates too. Only for orders that never had one: '
+                                       'the estimates posted before the ledger existed would be duplicated')
+    shopify_backfill.set_defaults(run=run_shopify)
+
+    args = parser.parse_args()
+    args.run(args, os.path.abspath(os.path.dirname(__file__)))
@@ -0,0 +1,996 @@
+# Offline benchmarks against the local stand-ins from stand_ins.py, e.g.:
+#   python benchmark.py qb-batch --orders 500 --latency 0.05
+#   python benchmark.py e2e --orders 100 1000 10000 --rate-limit 40 --error-rate 0.01 --output results.jsonl
+# The project modules are imported only after config is pointed at the stand-ins, so production is never touched
+from typing import Dict, List
+from decimal import Decimal
+from email.message import EmailMessage
+from concurrent.futures import ThreadPoolExecutor
+import argparse, base64, collections, contextlib, datetime, email.utils, hashlib, hmac, imaplib, importlib.util, json, \
+    logging, multiprocessing, os, random, resource, statistics, sys, tempfile, threading, time, tracemalloc, types
+
+import requests
+
+import stand_ins
+
+logger = logging.getLogger('benchmark')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+def configure(**settings) -> None:
+    # Replaces the project's config module with settings for the stand-ins
+    config = sys.modules.setdefault('config', types.ModuleType('config'))
+    for key, value in settings.items():
+        setattr(config, key, value)
+
+
+def make_application_path(**cursors) -> str:
+    # A temporary folder with the same files the project keeps next to main.py
+    import state
+    application_path = tempfile.mkdtemp(prefix='benchmark ')
+    cursors.setdefault(
+        'quickbooks', {'access token': 'token', 'refresh token': 'token', 'best before': '2100-01-01T00:00:00'}
+    )
+    for platform, cursor in cursors.items():
+        state.save(application_path, platform, cursor=cursor)
+    return application_path
+
+
+def use_sheets_stand_in(url: str) -> None:
+    # Points the ezsheets services google_sheets.py uses at a SheetsStandIn
+    import ezsheets, httplib2
+    from googleapiclient.discovery import build
+    for name, version in (('SHEETS_SERVICE', 'v4'), ('DRIVE_SERVICE', 'v3')):
+        setattr(ezsheets, name, build(
+            'sheets' if version == 'v4' else 'drive', version, http=httplib2.Http(), static_discovery=True,
+            client_options={'api_endpoint': url + '/'}
+        ))
+    ezsheets.IS_INITIALIZED = True
+
+
+def report(title: str, rows: List[Dict]) -> None:
+    print(title)
+    columns = list(rows[0])
+    widths = [max(len(str(column)), *(len(str(row[column])) for row in rows)) for column in columns]
+    print('  '.join(str(column).ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row[column]).ljust(width) for column, width in zip(columns, widths)))
+    print()
+
+
+def bench_qb_batch(args: argparse.Namespace) -> None:
+    items = [f'Item {i}' for i in range(200)]
+    customers = [f'Customer {i}' for i in range(50)]
+    with stand_ins.QuickBooksStandIn(items, customers, fault_rate=args.fault_rate, latency=args.latency) as qb:
+        configure(api_urls={'quickbooks': qb.url}, qb_company_id='1', qb_id='id', qb_secret='secret')
+        import quickbooks
+        application_path = make_application_path()
+
+        orders = []
+        for i in range(args.orders):
+            line_items = [
+                quickbooks.prepare_qb_line_item(
+                    platform='Benchmark',
+                    item_name_in_order=random.choice(items),
+                    price=Decimal('9.99'),
+                    qty=Decimal(random.randint(1, 5)),
+                    discount=Decimal('0'),
+                    logger=logger,
+                    application_path=application_path
+                ) for _ in range(random.randint(1, 10))
+            ]
+            orders.append({'customer': random.choice(customers), 'line items': line_items, 'number': str(i)})
+
+        rows = []
+        qb.requests.clear()
+        start = time.perf_counter()
+        for order in orders:
+            quickbooks.create_qb_estimate(
+                platform='Benchmark',
+                customer_name_in_order=order['customer'],
+                line_items=order['line items'],
+                order_number=order['number'],
+                logger=logger,
+                application_path=application_path
+            )
+        rows.append({'path': 'one POST per estimate', 'round trips': sum(qb.requests.values()),
+                     'wall time, s': f'{time.perf_counter() - start:.2f}'})
+
+        qb.requests.clear()
+        start = time.perf_counter()
+        pending = [
+            quickbooks.build_qb_estimate(
+                platform='Benchmark',
+                customer_name_in_order=order['customer'],
+                line_items=order['line items'],
+                order_number=order['number'],
+                logger=logger,
+                application_path=application_path
+            ) for order in orders
+        ]
+        results = quickbooks.create_qb_estimates(pending=pending, logger=logger, application_path=application_path)
+        rows.append({'path': f'/batch of {quickbooks.BATCH_SIZE}', 'round trips': sum(qb.requests.values()),
+                     'wall time, s': f'{time.perf_counter() - start:.2f}'})
+        failed = sum('error' in result for result in results)
+
+    report(f'QuickBooks estimates for {args.orders} orders, {args.latency}s latency, {failed} failed', rows)
+
+
+def bench_ledger(args: argparse.Namespace) -> None:
+    # The same orders sent to QuickBooks again, as after a crash or an overlapping fetch window, then with a few changed
+    items = [f'Item {i}' for i in range(200)]
+    customers = [f'Customer {i}' for i in range(50)]
+    with stand_ins.QuickBooksStandIn(items, customers, latency=args.latency) as qb:
+        configure(api_urls={'quickbooks': qb.url}, qb_company_id='1', qb_id='id', qb_secret='secret')
+        import quickbooks, state
+        from order_model import Order, LineItem
+        application_path = make_application_path()
+        orders = [
+            Order(platform='Benchmark', order_id=i, customer=f'Customer {i % 50}', qb_customer=f'Customer {i % 50}',
+                  delivery_dt=datetime.datetime.now(), notes='',
+                  lines=tuple(LineItem(name=random.choice(items), quantity=random.randint(1, 5), price=Decimal('9.99'))
+                              for _ in range(random.randint(1, 10))))
+            for i in range(args.orders)
+        ]
+        changed = list(orders)
+        changed_ids = random.sample(range(args.orders), int(args.orders * args.changed_share))
+        for i in changed_ids:
+            changed[i] = orders[i]._replace(lines=orders[i].lines + (LineItem(name=items[0], quantity=1),))
+        # Some of the changed orders' estimates were also edited in QuickBooks, so their recorded SyncToken is stale
+        edited_ids = changed_ids[:int(len(changed_ids) * args.edited_share)]
+
+        rows = []
+        for run, run_orders in (('first run', orders), ('rerun, nothing changed', orders),
+                                (f'rerun, {args.changed_share:.0%} changed, {len(edited_ids)} edited in QuickBooks',
+                                 changed)):
+            if run_orders is changed:
+                for i in edited_ids:
+                    qb.edit_estimate(state.get_estimate(application_path, 'Benchmark', i)['estimate id'])
+            qb.requests.clear()
+            start = time.perf_counter()
+            pending = [estimate for estimate in (
+                quickbooks.build_order_estimate(order=order, logger=logger, application_path=application_path)
+                for order in run_orders
+            ) if estimate]
+            results = quickbooks.create_qb_estimates(pending=pending, logger=logger, application_path=application_path)
+            rows.append({'run': run, 'created': sum('estimate id' in result and not result['updated'] for result in results),
+                         'updated': sum('estimate id' in result and result['updated'] for result in results),
+                         'failed': sum('error' in result for result in results),
+                         'round trips': sum(qb.requests.values()), 'estimates in QuickBooks': len(qb.estimates),
+                         'wall time, s': f'{time.perf_counter() - start:.2f}'})
+
+    report(f'QuickBooks estimate ledger, {args.orders} orders, {args.latency}s latency', rows)
+
+
+def bench_qb_recovery(args: argparse.Namespace) -> None:
+    # QuickBooks answers a repeated requestid with the first response, faults included. A transient fault must not
+    # stick to the orders, and a lost answer or a worker that crashed after posting must not lead to duplicates
+    items = [f'Item {i}' for i in range(200)]
+    customers = [f'Customer {i}' for i in range(50)]
+    with stand_ins.QuickBooksStandIn(items, customers, latency=args.latency) as qb:
+        configure(api_urls={'quickbooks': qb.url}, qb_company_id='1', qb_id='id', qb_secret='secret', job_lease_seconds=1)
+        import main, quickbooks, state
+        from order_model import Order, LineItem
+        rows = []
+        for case in ('transient fault, in-run retry', 'faults past the in-run retries, job retry',
+                     'created then 502, in-run retry', 'created then 502 past the in-run retries, job retry',
+                     'crash after the post, job taken over'):
+            application_path = make_application_path()
+            state.save(application_path, 'benchmark', orders=[
+                Order(platform='Benchmark', order_id=str(i), customer=customer, qb_customer=customer,
+                      delivery_dt=datetime.datetime.now(datetime.timezone.utc), notes='', lines=tuple(
+                        LineItem(name=random.choice(items), quantity=random.randint(1, 5), price=Decimal('9.99'))
+                        for _ in range(random.randint(1, 5))))
+                for i, customer in enumerate(random.choice(customers) for _ in range(args.orders))
+            ])
+            estimates_before = len(qb.estimates)
+            qb.requests.clear()
+            start = time.perf_counter()
+
+            if case.startswith('transient'):
+                qb.fault_requests = 1
+            elif case.startswith('faults past'):
+                qb.fault_rate = 1.0
+                main.process_jobs(sink='quickbooks', owner='benchmark', logger=logger,
+                                  application_path=application_path, local_time=main.get_local_time())
+                qb.fault_rate = 0.0
+            elif case == 'created then 502, in-run retry':
+                qb.lost_responses = 1
+            elif case.startswith('created then 502'):
+                # Every batch of the first claim is created and its answer lost, on every in-run attempt
+                qb.lost_responses = 10 ** 6
+                main.process_jobs(sink='quickbooks', owner='benchmark', logger=logger,
+                                  application_path=application_path, local_time=main.get_local_time())
+                qb.lost_responses = 0
+            else:
+                # The worker posts its estimates and dies before the ledger is saved
+                jobs = state.claim_jobs(application_path, 'quickbooks', 'crashed', limit=args.orders, lease_seconds=1)
+                pending = [quickbooks.build_order_estimate(order=order, logger=logger,
+                                                           application_path=application_path) for job_id, order in jobs]
+                chunks = quickbooks._make_chunks(pending)
+                state.set_job_requests(application_path, 'crashed', {
+                    job_id: (estimate['request id'], estimate['batch item'])
+                    for (job_id, order), estimate in zip(jobs, pending)
+                })
+                for request_id, chunk in chunks.items():
+                    quickbooks._post_qb_batch(chunk, request_id, application_path=application_path)
+                time.sleep(1)
+
+            for attempt in range(state.DEFAULT_JOB_ATTEMPTS):
+                # Without waiting for the backoff of the failed jobs
+                state.connect(application_path).execute("UPDATE jobs SET available_at = 0 WHERE sink = 'quickbooks'")
+                while main.process_jobs(sink='quickbooks', owner='benchmark', logger=logger,
+                                        application_path=application_path, local_time=main.get_local_time()):
+                    continue
+                if not state.count_jobs(application_path).get('quickbooks'):
+                    break
+            estimates = len(qb.estimates) - estimates_before
+            rows.append({'case': case, 'orders': args.orders, 'estimates': estimates,
+                         'duplicate estimates': max(estimates - args.orders, 0),
+                         'jobs left': state.count_jobs(application_path).get('quickbooks', 0),
+                         'dead jobs': state.count_jobs(application_path)['dead'],
+                         'batch requests': qb.requests['POST /v3/company/1/batch'],
+                         'wall time, s': f'{time.perf_counter() - start:.2f}'})
+
+    report(f'QuickBooks fault recovery, {args.orders} orders, {args.latency}s latency', rows)
+
+
+def make_notch_messages(count: int, first_id: int, notch_share: float = 0.1) -> List[bytes]:
+    # Notch notifications have a plain text and a large HTML part, the rest of the inbox is unrelated mail
+    messages = []
+    placed = datetime.date.today().strftime('%A, %d %B %Y')
+    delivery = (datetime.date.today() + datetime.timedelta(days=1)).strftime('%A, %d %B %Y')
+    for i in range(count):
+        message = EmailMessage()
+        message['Date'] = email.utils.format_datetime(datetime.datetime.now(datetime.timezone.utc))
+        html = '<html><body>' + '<p>Lorem ipsum dolor sit amet</p>' * 400 + '</body></html>'
+        if random.random() < notch_share:
+            order_id = first_id + i
+            message['From'] = 'Notch <notifications@notchordering.com>'
+            message['Subject'] = f'You have a new order (#{order_id})'
+            message.set_content(
+                f'Order ID: {order_id}\nOrder place date: {placed}\nDelivery day: {delivery}\n'
+                f'Made by: Customer {order_id % 50}\nView order details <https://www.notchordering.com/o/{order_id}>\n'
+                f'Don\'t reply to this email\n', cte='quoted-printable'
+            )
+            message.add_alternative(html, subtype='html')
+        else:
+            message['From'] = 'Someone <someone@example.com>'
+            message['Subject'] = f'Newsletter {i}'
+            message.set_content(html, subtype='html')
+        messages.append(message.as_bytes())
+    return messages
+
+
+def bench_notch(args: argparse.Namespace) -> None:
+    with stand_ins.IMAPStandIn(make_notch_messages(args.messages, first_id=1), latency=args.latency) as imap:
+        configure(
+            api_urls={'notch': f'imap://127.0.0.1:{imap.port}'},
+            notch_gmail_address='user', notch_gmail_password='password',
+            notch_notifications_from_address='notifications@notchordering.com'
+        )
+        import notch
+        application_path = make_application_path()
+
+        rows = []
+        for run, new_messages in (('first run', 0), ('next run', args.new_messages)):
+            imap.add_messages(make_notch_messages(new_messages, first_id=args.messages + 1))
+            imap.bytes_sent = 0
+            imap.commands.clear()
+            start = time.perf_counter()
+            orders = notch.get_orders(logger=logger, application_path=application_path,
+                                      local_time=datetime.datetime.now(datetime.timezone.utc))
+            rows.append({'run': f'UID cursor, {run}', 'orders': len(orders), 'commands': sum(imap.commands.values()),
+                         'bytes': imap.bytes_sent, 'wall time, s': f'{time.perf_counter() - start:.2f}'})
+
+        # The previous approach: download whole messages one by one from the newest until 5 known orders in a row
+        imap.bytes_sent = 0
+        imap.commands.clear()
+        start = time.perf_counter()
+        mail = imaplib.IMAP4('127.0.0.1', imap.port)
+        mail.login('user', 'password')
+        mail.select('inbox')
+        known = 0
+        for message_id in range(len(imap.messages), 0, -1):
+            msg = email.message_from_bytes(mail.fetch(str(message_id), '(RFC822)')[1][0][1])
+            if 'notchordering.com' in msg['from']:
+                known += message_id <= args.messages
+                if known == 5:
+                    break
+        mail.logout()
+        rows.append({'run': 'RFC822 one by one, next run', 'orders': len(orders), 'commands': sum(imap.commands.values()),
+                     'bytes': imap.bytes_sent, 'wall time, s': f'{time.perf_counter() - start:.2f}'})
+
+    report(f'Notch inbox of {args.messages} messages, {args.new_messages} new, {args.latency}s latency', rows)
+
+
+def _split_notch_body(body: str, subject: str) -> Dict:
+    # The previous parser: a split chain over the whole body per field
+    return {
+        'id': body.split('Order ID:')[1].split('\n')[0].strip(),
+        'delivery date': body.split('Delivery day:')[1].split('\n')[0].strip(),
+        'customer': body.split('Made by:')[1].split('\n')[0].strip(),
+        'order url': body.split('View order details')[1].split('Don')[0].strip().strip('<>'),
+    }
+
+
+def bench_notch_backfill(args: argparse.Namespace) -> None:
+    messages = make_notch_messages(args.messages, first_id=1, notch_share=args.notch_share)
+    with stand_ins.IMAPStandIn(messages, latency=args.latency) as imap:
+        configure(
+            api_urls={'notch': f'imap://127.0.0.1:{imap.port}'},
+            notch_gmail_address='user', notch_gmail_password='password',
+            notch_notifications_from_address='notifications@notchordering.com'
+        )
+        import notch, state
+        since = datetime.date.today() - datetime.timedelta(days=30)
+        rows = []
+        for connections in args.connections:
+            application_path = make_application_path()
+            for run in ('backfill', 'run again'):
+                imap.commands.clear()
+                start = time.perf_counter()
+                results = notch.backfill(logger=logger, application_path=application_path,
+                                         local_time=datetime.datetime.now(datetime.timezone.utc),
+                                         since=since, connections=connections)
+                seconds = time.perf_counter() - start
+                rows.append({'connections': connections, 'run': run, 'messages': results['messages'],
+                             'orders': results['orders'], 'jobs queued': sum(
+                                 count for sink, count in state.count_jobs(application_path).items() if sink != 'dead'),
+                             'commands': sum(imap.commands.values()), 'wall time, s': f'{seconds:.2f}',
+                             'messages/s': int(results['messages'] / seconds)})
+
+    report(f'Notch backfill of {args.messages} messages, {args.latency}s latency', rows)
+
+    # The body parser alone, over the text parts of the notifications
+    text_parts = [email.message_from_bytes(message, policy=email.policy.default).get_body(('plain',))
+                  for message in messages]
+    bodies = [part.get_content() for part in text_parts if part is not None] * 20
+    # Real notifications also carry the item list and a footer, which the split chains copy again for every field
+    footer = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n' * 40
+    rows = []
+    for body_name, body_set in (('as generated', bodies), ('with a 2 KB footer', [body + footer for body in bodies])):
+        for name, parse in (('split chains', _split_notch_body), ('single pass', notch._parse_order)):
+            start = time.perf_counter()
+            for body in body_set:
+                parse(body, '')
+            rows.append({'bodies': body_name, 'parser': name, 'count': len(body_set),
+                         'microseconds per body': f'{(time.perf_counter() - start) / len(body_set) * 1e6:.1f}'})
+    report('Notch body parser', rows)
+
+
+def bench_shopify(args: argparse.Namespace) -> None:
+    with stand_ins.ShopifyStandIn(args.orders, latency=args.latency) as shop:
+        configure(api_urls={'shopify': shop.url}, shopify_store='benchmark', shopify_password='password')
+        import shopify
+        rows = []
+
+        # The previous approach: every full order JSON collected into one list
+        tracemalloc.start()
+        start = time.perf_counter()
+        url = f'{shop.url}/admin/api/2021-04/orders.json'
+        response = requests.get(url, params={'status': 'open', 'limit': 250, 'since_id': 0})
+        orders = response.json()['orders']
+        first_order = time.perf_counter() - start
+        while '; rel="next"' in response.headers.get('Link', ''):
+            response = requests.get(response.headers['Link'].split('; rel="next"')[0].strip(' <>'))
+            orders += response.json()['orders']
+        rows.append({'path': 'full orders in one list', 'orders': len(orders),
+                     'first order, s': f'{first_order:.2f}', 'wall time, s': f'{time.perf_counter() - start:.2f}',
+                     'peak memory, MB': f'{tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f}'})
+        del orders, response
+        tracemalloc.stop()
+
+        for path in ('get_orders(), projected list', 'iter_orders(), streamed'):
+            application_path = make_application_path(shopify={'last order id': 0})
+            tracemalloc.start()
+            start = time.perf_counter()
+            first_order = None
+            if path.startswith('get_orders'):
+                orders = shopify.get_orders(logger=logger, application_path=application_path)
+                count = len(orders)
+                del orders
+            else:
+                count = 0
+                for order in shopify.iter_orders(logger=logger, application_path=application_path):
+                    if first_order is None:
+                        first_order = time.perf_counter() - start
+                    count += 1
+            wall_time = time.perf_counter() - start
+            rows.append({'path': path, 'orders': count,
+                         'first order, s': f'{first_order if first_order is not None else wall_time:.2f}',
+                         'wall time, s': f'{wall_time:.2f}',
+                         'peak memory, MB': f'{tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f}'})
+            tracemalloc.stop()
+
+    report(f'Shopify store with {args.orders} orders, {args.latency}s latency', rows)
+
+
+def bench_shopify_backfill(args: argparse.Namespace) -> None:
+    with stand_ins.ShopifyStandIn(args.orders, latency=args.latency, bulk_seconds=args.bulk_seconds) as shop:
+        configure(api_urls={'shopify': shop.url}, shopify_store='benchmark', shopify_password='password',
+                  shopify_bulk_poll_interval=args.poll_interval)
+        import shopify, state
+        rows = []
+        application_path = make_application_path(shopify={'last order id': 0})
+        for path in ('REST pages, iter_orders()', 'bulk query', 'bulk query, run again',
+                     f'bulk query, line items {args.late_items} orders late'):
+            shop.late_items = args.late_items if 'late' in path else 0
+            shop.requests.clear()
+            shop.bytes_sent = 0
+            if args.memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            if path.startswith('REST'):
+                count = sum(1 for order in shopify.iter_orders(logger=logger, application_path=application_path))
+                # The REST orders are in the queue now, the backfill starts from an empty one
+                application_path = make_application_path(shopify={'last order id': 0})
+                jobs = '-'
+            else:
+                count = shopify.backfill(logger=logger, application_path=application_path,
+                                         since=datetime.date.today() - datetime.timedelta(days=365))['orders']
+                jobs = sum(count for sink, count in state.count_jobs(application_path).items() if sink != 'dead')
+            rows.append({'path': path, 'orders': count, 'requests': sum(shop.requests.values()),
+                         'MB received': f'{shop.bytes_sent / 2 ** 20:.1f}', 'jobs queued': jobs,
+                         'wall time, s': f'{time.perf_counter() - start:.2f}'})
+            if args.memory:
+                # Traced memory slows Python down several times, the wall time is only comparable without it
+                rows[-1]['peak memory, MB'] = f'{tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f}'
+                tracemalloc.stop()
+
+    report(f'Shopify history of {args.orders} orders, {args.latency}s latency, bulk query runs {args.bulk_seconds}s',
+           rows)
+
+
+def bench_rekki(args: argparse.Namespace) -> None:
+    # A backlog after downtime: the whole backlog in one orders/list response vs pages with a checkpoint after each.
+    # The second pass stops the consumer halfway, as a crash would, and counts the orders the next run won't refetch
+    with stand_ins.RekkiStandIn(args.orders, latency=args.latency) as rekki_api:
+        configure(api_urls={'rekki': rekki_api.url}, rekki_token='token')
+        import rekki, state
+        default_page_size = rekki.PAGE_SIZE
+        rows = []
+        for path, page_size in (('one response', args.orders + 1), (f'pages of {default_page_size}', default_page_size)):
+            rekki.PAGE_SIZE = page_size
+            application_path = make_application_path(rekki={'last order time': '2000-01-01T00:00:00.000000Z'})
+            with open(os.path.join(application_path, 'shopify-rekki product codes matching.csv'), 'w') as file:
+                file.writelines(f'R-{i},SKU-{i}\n' for i in range(200))
+            tracemalloc.start()
+            start = time.perf_counter()
+            first_order = None
+            count = 0
+            for order in rekki.iter_orders(logger=logger, application_path=application_path):
+                if first_order is None:
+                    first_order = time.perf_counter() - start
+                count += 1
+            wall_time = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            # The same backlog again, interrupted halfway
+            application_path = make_application_path(rekki={'last order time': '2000-01-01T00:00:00.000000Z'})
+            with open(os.path.join(application_path, 'shopify-rekki product codes matching.csv'), 'w') as file:
+                file.writelines(f'R-{i},SKU-{i}\n' for i in range(200))
+            for i, order in enumerate(rekki.iter_orders(logger=logger, application_path=application_path)):
+                if i == args.orders // 2:
+                    break
+            kept = state.connect(application_path).execute(
+                "SELECT COUNT(*) FROM seen_orders WHERE platform = 'rekki'"
+            ).fetchone()[0]
+            rows.append({'path': path, 'orders': count, 'requests': -(-(args.orders + 1) // page_size),
+                         'first order, s': f'{first_order:.2f}', 'wall time, s': f'{wall_time:.2f}',
+                         'peak memory, MB': f'{peak_memory / 2 ** 20:.1f}', 'kept after a crash halfway': kept})
+        rekki.PAGE_SIZE = default_page_size
+
+    report(f'Rekki backlog of {args.orders} orders, {args.latency}s latency', rows)
+
+
+def bench_marketman(args: argparse.Namespace) -> None:
+    # Two runs with new orders in between: a token and the whole delivery window every run vs the saved token and
+    # the sent-date window from the high-water mark, parsed while it downloads
+    with stand_ins.MarketmanStandIn(args.orders, latency=args.latency) as marketman_api:
+        configure(api_urls={'marketman': marketman_api.url}, marketman_api_key='key', marketman_api_password='password',
+                  marketman_vendor_guid='vendor')
+        import marketman
+        application_path = make_application_path()
+        rows = []
+        for run in ('first run', 'next run'):
+            if run == 'next run':
+                marketman_api.add_orders(args.new_orders)
+            for path in ('GetToken + GetOrdersByDeliveryDate', 'saved token + GetOrdersBySentDate'):
+                marketman_api.requests.clear()
+                marketman_api.bytes_sent = 0
+                tracemalloc.start()
+                start = time.perf_counter()
+                if path.startswith('GetToken'):
+                    token = requests.post(f'{marketman_api.url}/v3/buyers/auth/GetToken', json={}).json()['Token']
+                    response = requests.post(f'{marketman_api.url}/v3/vendors/orders/GetOrdersByDeliveryDate',
+                                             headers={'AUTH_TOKEN': token}, json={})
+                    orders = marketman.normalize_orders(response.json()['Orders'], logger=logger)
+                else:
+                    orders = marketman.get_orders(logger=logger, application_path=application_path,
+                                                  local_time=datetime.datetime.now())
+                rows.append({'run': run, 'path': path, 'orders': len(orders),
+                             'requests': sum(marketman_api.requests.values()),
+                             'downloaded, KB': marketman_api.bytes_sent // 1024,
+                             'wall time, s': f'{time.perf_counter() - start:.2f}',
+                             'peak memory, MB': f'{tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f}'})
+                tracemalloc.stop()
+
+    report(f'Marketman with {args.orders} orders in the delivery window, {args.new_orders} new before the next run, '
+           f'{args.latency}s latency', rows)
+
+
+def bench_webhooks(args: argparse.Namespace) -> None:
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').disabled = True
+    secret = 'webhook secret'
+    configure(qb_auth_slug='/qb', shopify_webhook_secret=secret)
+    import shopify
+    spec = importlib.util.spec_from_file_location(
+        'qb_authorization', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'QB authorization.py')
+    )
+    flask_app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(flask_app)
+    flask_app.application_path = application_path = make_application_path(shopify={'last order id': 0})
+
+    server = make_server('127.0.0.1', 0, flask_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/webhooks/shopify'
+
+    # Shopify retries deliveries, so some webhooks arrive twice
+    order_ids = list(range(1, args.webhooks + 1))
+    order_ids += random.sample(order_ids, int(args.webhooks * args.duplicate_share))
+    random.shuffle(order_ids)
+    local = threading.local()
+
+    def deliver(order_id: int) -> float:
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        body = json.dumps(stand_ins.ShopifyStandIn.make_order(order_id)).encode('utf-8')
+        signature = base64.b64encode(hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()).decode()
+        start = time.perf_counter()
+        response = local.session.post(url, data=body, headers={
+            'X-Shopify-Hmac-Sha256': signature, 'X-Shopify-Topic': 'orders/create', 'Content-Type': 'application/json'
+        })
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = sorted(executor.map(deliver, order_ids))
+    flood_time = time.perf_counter() - start
+    server.shutdown()
+
+    start = time.perf_counter()
+    orders = shopify.get_queued_orders(logger=logger, application_path=application_path)
+    drain_time = time.perf_counter() - start
+
+    report(f'{len(order_ids)} Shopify webhooks, {args.concurrency} concurrent senders', [
+        {'stage': 'acknowledge', 'orders': len(order_ids), 'wall time, s': f'{flood_time:.2f}',
+         'per second': f'{len(order_ids) / flood_time:.0f}', 'median, ms': f'{statistics.median(latencies) * 1000:.1f}',
+         'p99, ms': f'{latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f}'},
+        {'stage': 'drain the inbox', 'orders': len(orders), 'wall time, s': f'{drain_time:.2f}',
+         'per second': f'{len(order_ids) / drain_time:.0f}', 'median, ms': '', 'p99, ms': ''}
+    ])
+
+
+def bench_throttle(args: argparse.Namespace) -> None:
+    # Concurrent GETs against stand-ins that enforce a rate limit: plain requests vs http_client's token buckets.
+    # Shopify reports its bucket in a header, the QuickBooks stand-in only answers 429, and http_client is configured
+    # with twice its real limit, so it has to find the limit itself
+    shop = stand_ins.ShopifyStandIn(args.requests, rate_limit=args.rate_limit, burst=args.burst, latency=args.latency)
+    qb = stand_ins.QuickBooksStandIn(['Item'], ['Customer'], rate_limit=args.rate_limit, burst=args.burst,
+                                     latency=args.latency)
+    with shop, qb:
+        shop_netloc, qb_netloc = shop.url.split('//')[1], qb.url.split('//')[1]
+        configure(rate_limits={
+            shop_netloc: (args.rate_limit, args.burst), qb_netloc: (args.rate_limit * 2, args.burst)
+        })
+        import http_client
+        from logging_module import metrics
+        urls = {
+            'Shopify, call limit header': f'{shop.url}/admin/api/2021-04/orders.json?limit=1',
+            'QuickBooks, 429 only': f'{qb.url}/v3/company/1/query?query=select%20*%20from%20Item%20'
+                                    f'STARTPOSITION%201%20MAXRESULTS%201'
+        }
+        rows = []
+        for service, url in urls.items():
+            for client in ('plain requests', 'http_client'):
+                time.sleep(args.burst / args.rate_limit)  # Let the stand-in's bucket refill
+                metrics.reset()
+                session = requests.Session() if client == 'plain requests' else None
+                get = session.get if session else http_client.get
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                    statuses = collections.Counter(
+                        response.status_code for response in executor.map(lambda _: get(url), range(args.requests))
+                    )
+                wall_time = time.perf_counter() - start
+                rows.append({'service': service, 'client': client, 'succeeded': statuses[200],
+                             'failed with 429': statuses[429], 'retries': metrics.counters['retries'],
+                             'wall time, s': f'{wall_time:.1f}', 'succeeded/s': f'{statuses[200] / wall_time:.1f}'})
+
+    report(f'{args.requests} requests from {args.concurrency} threads, limit {args.rate_limit}/s '
+           f'with bursts of {args.burst}', rows)
+
+
+def bench_logging(args: argparse.Namespace) -> None:
+    # Time per log call from threads that mostly wait on the network, like the fetches and the sinks: a FileHandler
+    # writing in the calling thread, like basicConfig did, vs logging_module's queue. Every --stall-every records the
+    # disk stalls for --stall seconds
+    configure()
+    import logging_module
+    application_path = tempfile.mkdtemp(prefix='benchmark ')
+
+    def stall(record: logging.LogRecord) -> bool:
+        stall.records += 1
+        if args.stall_every and stall.records % args.stall_every == 0:
+            time.sleep(args.stall)
+        return True
+
+    def log_calls(log: logging.Logger) -> List[float]:
+        def work(thread: int) -> List[float]:
+            durations = []
+            for index in range(args.records // args.threads):
+                start = time.perf_counter()
+                log.info(f'Order {thread}-{index} written to the sheet')
+                durations.append(time.perf_counter() - start)
+                time.sleep(args.work)
+            return durations
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            return [duration for durations in executor.map(work, range(args.threads)) for duration in durations]
+
+    rows = []
+    for setup in ('FileHandler', 'logging_module'):
+        stall.records = 0
+        if setup == 'FileHandler':
+            log = logging.getLogger('FileHandler')
+            log.propagate = False
+            log.setLevel(logging.INFO)
+            handler = logging.FileHandler(os.path.join(application_path, 'log.txt'))
+            handler.addFilter(stall)
+            log.addHandler(handler)
+        else:
+            log = logging_module.get_logger(application_path=application_path, local_time=datetime.datetime.now())
+            handler = logging_module._listener.handlers[0]
+            handler.addFilter(stall)
+        start = time.perf_counter()
+        durations = log_calls(log)
+        wall_time = time.perf_counter() - start
+        if setup == 'logging_module':
+            logging_module.stop_logging()  # Waits for the queue to be written
+        durations.sort()
+        rows.append({'handler': setup, 'records': len(durations),
+                     'median, µs': f'{statistics.median(durations) * 1e6:.1f}',
+                     'p99, µs': f'{durations[int(len(durations) * 0.99)] * 1e6:.1f}',
+                     'p99.9, ms': f'{durations[int(len(durations) * 0.999)] * 1e3:.2f}',
+                     'stalled calls': sum(duration >= args.stall for duration in durations),
+                     'threads done, s': f'{wall_time:.2f}', 'written by exit, s': f'{time.perf_counter() - start:.2f}'})
+
+    report(f'{args.records} log calls from {args.threads} threads, {args.stall}s disk stall every '
+           f'{args.stall_every} records', rows)
+
+
+# Share of the synthetic orders each platform gets in the end-to-end benchmark
+E2E_PLATFORM_SHARES = {'shopify': 0.4, 'rekki': 0.25, 'marketman': 0.2, 'notch': 0.15}
+
+
+def run_pipeline(order_count: int, latency: float, rate_limit: float, error_rate: float, tenant_count: int = 0) -> Dict:
+    # One main.run() against a stand-in for every service. Runs in a fresh process, so the modules start cold
+    # and the peak RSS belongs to this run only. With tenant_count, main.run() syncs that many tenants, each with its
+    # own spreadsheet and QuickBooks company and the same orders
+    counts = {platform: int(order_count * share) for platform, share in E2E_PLATFORM_SHARES.items()}
+    counts['shopify'] += order_count - sum(counts.values())
+    options = {'latency': latency, 'rate_limit': rate_limit, 'error_rate': error_rate}
+    items = [f'Item {i}' for i in range(200)]
+    customers = [f'Customer {i}' for i in range(50)] + [f'Jane Doe {i}' for i in range(97)]
+
+    with contextlib.ExitStack() as stack:
+        stand_in = {
+            'quickbooks': stack.enter_context(stand_ins.QuickBooksStandIn(items, customers, **options)),
+            'shopify': stack.enter_context(stand_ins.ShopifyStandIn(counts['shopify'], **options)),
+            'rekki': stack.enter_context(stand_ins.RekkiStandIn(counts['rekki'], **options)),
+            'marketman': stack.enter_context(stand_ins.MarketmanStandIn(counts['marketman'], **options)),
+            'sheets': stack.enter_context(stand_ins.SheetsStandIn(**options))
+        }
+        imap = stack.enter_context(stand_ins.IMAPStandIn(
+            make_notch_messages(counts['notch'], first_id=1, notch_share=1.0), latency=latency
+        ))
+        configure(
+            api_urls=dict({platform: stand_in[platform].url for platform in ('quickbooks', 'shopify', 'rekki', 'marketman')},
+                          notch=f'imap://127.0.0.1:{imap.port}'),
+            qb_company_id='1', qb_id='id', qb_secret='secret',
+            shopify_store='benchmark', shopify_password='password',
+            rekki_token='token',
+            marketman_api_key='key', marketman_api_password='password',
+            marketman_vendor_guid='vendor',
+            notch_gmail_address='user', notch_gmail_password='password',
+            notch_notifications_from_address='notifications@notchordering.com',
+            google_sheet_id='spreadsheet'
+        )
+        if tenant_count:
+            configure(tenants={
+                f'location {i}': {'google_sheet_id': f'spreadsheet {i}', 'qb_company_id': str(i)}
+                for i in range(tenant_count)
+            })
+        use_sheets_stand_in(stand_in['sheets'].url)
+
+        import main, logging_module, state, tenants
+        cursors = {'shopify': {'last order id': 0}, 'rekki': {'last order time': '2000-01-01T00:00:00.000000Z'}}
+        application_path = make_application_path(**cursors)
+        os.mkdir(os.path.join(application_path, logging_module.LOGS_FOLDER_NAME))
+        folders = [tenants.get_application_path(application_path, name) for name in tenants.get_tenants()]
+        for folder in folders:
+            for platform, cursor in dict(cursors, quickbooks=state.get_cursor(application_path, 'quickbooks')).items():
+                state.save(folder, platform, cursor=cursor)
+        for folder in folders or [application_path]:
+            for file_name, rows in (
+                    ('customer rank.csv', [[f'Customer {i}', str(i % 5)] for i in range(50)]),
+                    ('product codes location.csv', [[f'SKU-{i}', f'Shelf {i % 20}'] for i in range(200)]),
+                    ('shopify-rekki product codes matching.csv', [[f'R-{i}', f'SKU-{i}'] for i in range(200)])
+            ):
+                with open(os.path.join(folder, file_name), 'w') as file:
+                    file.writelines(','.join(row) + '\n' for row in rows)
+
+        start = time.perf_counter()
+        main.run(logger=logger, application_path=application_path, local_time=main.get_local_time())
+        wall_time = time.perf_counter() - start
+
+        with open(os.path.join(application_path, logging_module.LOGS_FOLDER_NAME, logging_module.METRICS_FILE)) as file:
+            summary = json.loads(file.readlines()[-1])
+        calls = {service: sum(server.requests.values()) for service, server in stand_in.items()}
+        calls['notch'] = sum(imap.commands.values())
+        return {
+            'orders': order_count,
+            'wall time, s': round(wall_time, 3),
+            'peak RSS, MB': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'CPU, s': round(resource.getrusage(resource.RUSAGE_SELF).ru_utime
+                            + resource.getrusage(resource.RUSAGE_SELF).ru_stime, 2),
+            'calls': calls,
+            'refused': {service: dict(server.refused) for service, server in stand_in.items() if server.refused},
+            'estimates': len(stand_in['quickbooks'].estimates),
+            'sheet rows': sum(len(tab['rows']) for tab in stand_in['sheets'].tabs.values()),
+            'stages': {name: stage['seconds'] for name, stage in summary['stages'].items()},
+            'counters': summary['counters']
+        }
+
+
+def bench_e2e(args: argparse.Namespace) -> None:
+    results = []
+    for order_count in args.orders:
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            results.append(pool.apply(run_pipeline, (order_count, args.latency, args.rate_limit, args.error_rate)))
+    if args.output:
+        with open(args.output, 'a') as file:
+            for result in results:
+                file.write(json.dumps(dict(result, timestamp=datetime.datetime.now().isoformat(timespec='seconds'),
+                                           latency=args.latency, rate_limit=args.rate_limit,
+                                           error_rate=args.error_rate)) + '\n')
+
+    conditions = f'{args.latency}s latency, rate limit {args.rate_limit or "none"}, {args.error_rate:.0%} errors'
+    report(f'main.run() end to end, {conditions}', [{
+        'orders': result['orders'],
+        'wall time, s': result['wall time, s'],
+        'orders/s': f"{result['orders'] / result['wall time, s']:.0f}",
+        'peak RSS, MB': result['peak RSS, MB'],
+        'API calls': sum(result['calls'].values()),
+        'refused': sum(sum(refused.values()) for refused in result['refused'].values()),
+        'estimates': result['estimates'],
+        'sheet rows': result['sheet rows']
+    } for result in results])
+    report('API calls per service', [
+        dict({'orders': result['orders']}, **result['calls']) for result in results
+    ])
+    stages = list(dict.fromkeys(stage for result in results for stage in result['stages']))
+    report('Seconds per stage', [
+        dict({'stage': stage}, **{f"{result['orders']} orders": result['stages'].get(stage, '') for result in results})
+        for stage in stages
+    ])
+
+
+def queue_worker(settings: Dict, sheets_url: str, application_path: str) -> None:
+    # What worker.py does, until the queue is empty. Runs in its own process
+    configure(**settings)
+    use_sheets_stand_in(sheets_url)
+    import main, state
+    while sum(count for sink, count in state.count_jobs(application_path).items() if sink != 'dead'):
+        main.write_queued(logger=logger, application_path=application_path, local_time=main.get_local_time(),
+                          owner=f'benchmark {os.getpid()}')
+        time.sleep(0.1)
+
+
+def bench_queue(args: argparse.Namespace) -> None:
+    # Queued orders written by 1..N worker processes. With --kill-after, one worker is killed in the middle of its
+    # claim and a new one started, as a supervisor would: its jobs are taken over once their lease runs out
+    items = [f'Item {i}' for i in range(200)]
+    customers = [f'Customer {i}' for i in range(50)]
+    with stand_ins.QuickBooksStandIn(items, customers, latency=args.latency) as qb, \
+            stand_ins.SheetsStandIn(latency=args.latency) as sheets:
+        settings = {'api_urls': {'quickbooks': qb.url}, 'qb_company_id': '1', 'qb_id': 'id', 'qb_secret': 'secret',
+                    'job_lease_seconds': args.lease}
+        configure(**settings)
+        import state
+        from order_model import Order, LineItem
+        delivery_dt = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+        rows = []
+        for process_count in args.processes:
+            application_path = make_application_path()
+            with open(os.path.join(application_path, 'customer rank.csv'), 'w') as file:
+                file.writelines(f'{customer},{i % 5}\n' for i, customer in enumerate(customers))
+            state.save(application_path, 'benchmark', orders=[
+                Order(platform='Benchmark', order_id=str(i), customer=customer, qb_customer=customer,
+                      delivery_dt=delivery_dt, notes='', lines=tuple(
+                        LineItem(name=random.choice(items), quantity=random.randint(1, 5), price=Decimal('9.99'))
+                        for _ in range(random.randint(1, 5))))
+                for i, customer in enumerate(random.choice(customers) for _ in range(args.orders))
+            ])
+            worker_settings = dict(settings, google_sheet_id=f'spreadsheet {process_count}')
+            estimates_before = len(qb.estimates)
+
+            context = multiprocessing.get_context('spawn')
+            start = time.perf_counter()
+            processes = [context.Process(target=queue_worker, args=(worker_settings, sheets.url, application_path))
+                         for _ in range(process_count)]
+            for process in processes:
+                process.start()
+            if args.kill_after:
+                time.sleep(args.kill_after)
+                processes[0].kill()
+                processes.append(context.Process(target=queue_worker,
+                                                 args=(worker_settings, sheets.url, application_path)))
+                processes[-1].start()
+            for process in processes:
+                process.join()
+            wall_time = time.perf_counter() - start
+
+            estimates = len(qb.estimates) - estimates_before
+            rows.append({
+                'processes': process_count, 'killed': 1 if args.kill_after else 0,
+                'wall time, s': f'{wall_time:.2f}', 'orders/s': f'{args.orders / wall_time:.0f}',
+                'estimates': estimates, 'duplicate estimates': max(estimates - args.orders, 0),
+                'orders in sheet': len({tuple(row[:2]) for title, tab in sheets.spreadsheets[
+                    worker_settings['google_sheet_id']]['tabs'].items() for row in tab['rows'][1:]}),
+                'jobs left': sum(state.count_jobs(application_path).values())
+            })
+    report(f'{args.orders} queued orders, {args.latency}s latency, lease {args.lease}s', rows)
+
+
+def bench_tenants(args: argparse.Namespace) -> None:
+    # N locations synced by N copies of the script, each its own process with its own imports, tokens and connections,
+    # vs one process syncing N tenants. The wall time is measured from the parent, so it includes the startup
+    rows = []
+    for tenant_count in args.tenants:
+        for setup in ('separate processes', 'one process'):
+            start = time.perf_counter()
+            if setup == 'separate processes':
+                with multiprocessing.get_context('spawn').Pool(tenant_count) as pool:
+                    results = pool.starmap(run_pipeline, [(args.orders, args.latency, None, 0.0)] * tenant_count)
+            else:
+                with multiprocessing.get_context('spawn').Pool(1) as pool:
+                    results = [pool.apply(run_pipeline, (args.orders, args.latency, None, 0.0, tenant_count))]
+            wall_time = time.perf_counter() - start
+            rows.append({
+                'tenants': tenant_count, 'setup': setup, 'wall time, s': f'{wall_time:.2f}',
+                'orders/s': f'{args.orders * tenant_count / wall_time:.0f}',
+                'CPU, s': f"{sum(result['CPU, s'] for result in results):.1f}",
+                'peak RSS, MB': f"{sum(result['peak RSS, MB'] for result in results):.0f}",
+                'estimates': sum(result['estimates'] for result in results),
+                'sheet rows': sum(result['sheet rows'] for result in results)
+            })
+    report(f'{args.orders} orders per tenant, {args.latency}s latency', rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Offline benchmarks against local stand-in servers')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    qb_batch = subparsers.add_parser('qb-batch', help='QuickBooks /batch estimates vs one POST per estimate')
+    qb_batch.add_argument('--orders', type=int, default=500)
+    qb_batch.add_argument('--latency', type=float, default=0.05, help='Seconds added to every stand-in response')
+    qb_batch.add_argument('--fault-rate', type=float, default=0.0, help='Share of batch operations that fail')
+    qb_batch.set_defaults(run=bench_qb_batch)
+
+    qb_recovery = subparsers.add_parser('qb-recovery', help='QuickBooks: transient faults, lost answers and a crash after posting')
+    qb_recovery.add_argument('--orders', type=int, default=300)
+    qb_recovery.add_argument('--latency', type=float, default=0.05, help='Seconds added to every stand-in response')
+    qb_recovery.set_defaults(run=bench_qb_recovery)
+
+    ledger = subparsers.add_parser('ledger', help='QuickBooks estimates on reruns with the estimate ledger')
+    ledger.add_argument('--orders', type=int, default=500)
+    ledger.add_argument('--changed-share', type=float, default=0.1, help='Share of orders changed before the last run')
+    ledger.add_argument('--edited-share', type=float, default=0.5,
+                        help='Share of the changed orders whose estimate was also edited in QuickBooks')
+    ledger.add_argument('--latency', type=float, default=0.05, help='Seconds added to every stand-in response')
+    ledger.set_defaults(run=bench_ledger)
+
+    notch_fetch = subparsers.add_parser('notch', help='Notch IMAP fetch: UID cursor vs whole messages one by one')
+    notch_fetch.add_argument('--messages', type=int, default=5000, help='Messages in the inbox before the first run')
+    notch_fetch.add_argument('--new-messages', type=int, default=200, help='Messages arriving before the next run')
+    notch_fetch.add_argument('--latency', type=float, default=0.01, help='Seconds added to every IMAP command')
+    notch_fetch.set_defaults(run=bench_notch)
+
+    notch_backfill = subparsers.add_parser('notch-backfill', help='Notch backfill over 1 or more IMAP connections')
+    notch_backfill.add_argument('--messages', type=int, default=5000, help='Messages in the inbox')
+    notch_backfill.add_argument('--notch-share', type=float, default=0.5, help='Share of Notch notifications')
+    notch_backfill.add_argument('--connections', type=int, nargs='+', default=[1, 2, 4, 8])
+    notch_backfill.add_argument('--latency', type=float, default=0.05, help='Seconds added to every IMAP command')
+    notch_backfill.set_defaults(run=bench_notch_backfill)
+
+    shopify_fetch = subparsers.add_parser('shopify', help='Shopify order fetch: peak memory and time to first order')
+    shopify_fetch.add_argument('--orders', type=int, default=20000)
+    shopify_fetch.add_argument('--latency', type=float, default=0.05, help='Seconds added to every stand-in response')
+    shopify_fetch.set_defaults(run=bench_shopify)
+
+    shopify_backfill = subparsers.add_parser('shopify-backfill', help='Shopify history: REST pages vs a bulk query')
+    shopify_backfill.add_argument('--orders', type=int, default=20000)
+    shopify_backfill.add_argument('--latency', type=float, default=0.1, help='Seconds added to every request')
+    shopify_backfill.add_argument('--bulk-seconds', type=float, default=3, help='Seconds the bulk query runs')
+    shopify_backfill.add_argument('--poll-interval', type=float, default=1, help='Seconds between status checks')
+    shopify_backfill.add_argument('--memory', action='store_true', help='Trace the peak memory, slows the run down')
+    shopify_backfill.add_argument('--late-items', type=int, default=50,
+                                  help='Orders between an order and its line items in the last bulk result')
+    shopify_backfill.set_defaults(run=bench_shopify_backfill)
+
+    rekki_fetch = subparsers.add_parser('rekki', help='Rekki backlog: one response vs checkpointed pages')
+    rekki_fetch.add_argument('--orders', type=int, default=10000)
+    rekki_fetch.add_argument('--latency', type=float, default=0.05, help='Seconds added to every stand-in response')
+    rekki_fetch.set_defaults(run=bench_rekki)
+
+    marketman_fetch = subparsers.add_parser('marketman', help='Marketman: full window every run vs incremental')
+    marketman_fetch.add_argument('--orders', type=int, default=5000, help='Orders in the delivery window')
+    marketman_fetch.add_argument('--new-orders', type=int, default=50, help='Orders arriving before the next run')
+    marketman_fetch.add_argument('--latency', type=float, default=0.05, help='Seconds added to every stand-in response')
+    marketman_fetch.set_defaults(run=bench_marketman)
+
+    webhooks = subparsers.add_parser('webhooks', help='Flood the Flask webhook route and drain its inbox')
+    webhooks.add_argument('--webhooks', type=int, default=2000)
+    webhooks.add_argument('--concurrency', type=int, default=16)
+    webhooks.add_argument('--duplicate-share', type=float, default=0.05, help='Share of webhooks delivered twice')
+    webhooks.set_defaults(run=bench_webhooks)
+
+    throttle = subparsers.add_parser('throttle', help='Rate limited stand-ins: plain requests vs token buckets')
+    throttle.add_argument('--requests', type=int, default=300)
+    throttle.add_argument('--concurrency', type=int, default=8)
+    throttle.add_argument('--rate-limit', type=float, default=20, help='Requests per second the stand-ins allow')
+    throttle.add_argument('--burst', type=float, default=40, help='Requests the stand-ins allow at once')
+    throttle.add_argument('--latency', type=float, default=0.01, help='Seconds added to every stand-in response')
+    throttle.set_defaults(run=bench_throttle)
+
+    log_calls = subparsers.add_parser('logging', help='Log call latency: FileHandler vs the background queue')
+    log_calls.add_argument('--records', type=int, default=40000)
+    log_calls.add_argument('--threads', type=int, default=8)
+    log_calls.add_argument('--work', type=float, default=0.0005, help='Seconds each thread waits between log calls')
+    log_calls.add_argument('--stall', type=float, default=0.05, help='Seconds a write waits for a slow disk')
+    log_calls.add_argument('--stall-every', type=int, default=2000, help='Records between disk stalls, 0 for none')
+    log_calls.set_defaults(run=bench_logging)
+
+    e2e = subparsers.add_parser('e2e', help='main.run() against stand-ins for every service')
+    e2e.add_argument('--orders', type=int, nargs='+', default=[100, 1000, 10000], help='Order volumes, one run each')
+    e2e.add_argument('--latency', type=float, default=0.02, help='Seconds added to every stand-in response')
+    e2e.add_argument('--rate-limit', type=float, default=None, help='Requests per second per HTTP stand-in')
+    e2e.add_argument('--error-rate', type=float, default=0.0, help='Share of HTTP requests answered with 503')
+    e2e.add_argument('--output', help='Append the results as JSON lines to this file, to compare runs')
+    e2e.set_defaults(run=bench_e2e)
+
+    job_queue = subparsers.add_parser('queue', help='Queued orders written by 1..N worker processes')
+    job_queue.add_argument('--orders', type=int, default=3000)
+    job_queue.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4], help='Worker processes, one run each')
+    job_queue.add_argument('--latency', type=float, default=0.2, help='Seconds added to every stand-in response')
+    job_queue.add_argument('--lease', type=float, default=3, help='Seconds a claim is leased for')
+    job_queue.add_argument('--kill-after', type=float, default=0, help='Kill a worker after this many seconds')
+    job_queue.set_defaults(run=bench_queue)
+
+    tenant_runs = subparsers.add_parser('tenants', help='N locations: a process each vs one process with N tenants')
+    tenant_runs.add_argument('--tenants', type=int, nargs='+', default=[1, 4, 8], help='Tenant counts, one run each')
+    tenant_runs.add_argument('--orders', type=int, default=500, help='Orders per tenant')
+    tenant_runs.add_argument('--latency', type=float, default=0.05, help='Seconds added to every stand-in response')
+    tenant_runs.set_defaults(run=bench_tenants)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#! /usr/bin/python3
+# Long-running alternative to running main.py from cron: the imports, the Google and QuickBooks clients, the
+# spreadsheet snapshot and the CSV tables stay in memory, each platform is polled on its own interval and the
+# collected orders are written to Sheets and QuickBooks together every flush_interval seconds. With config.tenants
+# every tenant's platforms are polled and flushed the same way, in the same process
+from typing import Dict, List, Tuple, Union
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+import os, signal, threading, time, traceback
+
+import config
+import ingestion, logging_module, main, tenants
+
+# Seconds between polls per platform, config.poll_intervals overrides them.
+# 'shopify webhooks' only reads the local inbox the Flask app fills, so it's cheap to check often
+DEFAULT_POLL_INTERVALS = {'shopify': 60, 'shopify webhooks': 1, 'rekki': 60, 'marketman': 300, 'notch': 300}
+DEFAULT_FLUSH_INTERVAL = 15
+
+
+class Daemon:
+    def __init__(self, logger: getLogger, application_path: str):
+        self.logger = logger
+        self.application_path = application_path
+        self.poll_intervals = dict(DEFAULT_POLL_INTERVALS, **getattr(config, 'poll_intervals', {}))
+        self.flush_interval = getattr(config, 'flush_interval', DEFAULT_FLUSH_INTERVAL)
+        # None stands for the single location of config.py when there are no config.tenants
+        self.tenants: List[Union[str, None]] = tenants.get_tenants() or [None]
+        self.stopping = threading.Event()
+        self._running = set()
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.poll_intervals) * len(self.tenants), thread_name_prefix='poll'
+        )
+
+    def _poll(self, tenant: Union[str, None], platform: str) -> None:
+        # The connector queues the new orders for the sinks, flush() writes them. The platform stays in _running until
+        # the connector's thread ends, even when the poll gave up on it after its time budget, so a platform never has
+        # two fetches at once
+        submitted = False
+        try:
+            with tenants.use(tenant):
+                sources = main.get_sources(
+                    logger=self.logger, application_path=tenants.get_application_path(self.application_path, tenant),
+                    local_time=main.get_local_time()
+                )
+                submitted = True
+                ingestion.fetch_orders(
+                    sources={platform: sources[platform]}, logger=self.logger,
+                    on_done=lambda _: self._running.discard((tenant, platform))
+                )
+        except:
+            self.logger.error(f'Polling {platform}{f" of {tenant}" if tenant else ""} failed:')
+            self.logger.error(traceback.format_exc())
+            if not submitted:
+                self._running.discard((tenant, platform))
+
+    def _flush_tenant(self, tenant: Union[str, None]) -> None:
+        start = time.monotonic()
+        try:
+            with tenants.use(tenant):
+                main.write_queued(
+                    logger=self.logger,
+                    application_path=tenants.get_application_path(self.application_path, tenant),
+                    local_time=main.get_local_time()
+                )
+            self.logger.debug(f'Flushed{f" {tenant}" if tenant else ""} in {time.monotonic() - start:.1f}s')
+        except:
+            self.logger.error(f'Flushing{f" {tenant}" if tenant else ""} failed:')
+            self.logger.error(traceback.format_exc())
+
+    def flush(self) -> None:
+        # One Sheets sync and one round of QuickBooks batches per tenant for the jobs queued since the last flush,
+        # the tenants at the same time. Separate worker.py processes may take some of the jobs too
+        with ThreadPoolExecutor(max_workers=len(self.tenants), thread_name_prefix='flush') as executor:
+            for tenant in self.tenants:
+                executor.submit(self._flush_tenant, tenant)
+        # One metrics summary per flush, covering the polls since the previous one
+        if logging_module.metrics.counters or logging_module.metrics.stages:
+            logging_module.write_metrics(application_path=self.application_path, logger=self.logger)
+
+    def run(self) -> None:
+        next_poll: Dict[Tuple[Union[str, None], str], float] = {
+            (tenant, platform): time.monotonic() for tenant in self.tenants for platform in self.poll_intervals
+        }
+        next_flush = time.monotonic() + self.flush_interval
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            for (tenant, platform), due in next_poll.items():
+                # A slow platform is skipped until its previous poll finishes, the others carry on
+                if due <= now and (tenant, platform) not in self._running:
+                    self._running.add((tenant, platform))
+                    self._executor.submit(self._poll, tenant, platform)
+                    next_poll[(tenant, platform)] = now + self.poll_intervals[platform]
+            if next_flush <= now:
+                self.flush()
+                next_flush = time.monotonic() + self.flush_interval
+            self.stopping.wait(max(min(min(next_poll.values()), next_flush) - time.monotonic(), 0.1))
+
+        self.logger.info('Stopping, waiting for the running polls')
+        self._executor.shutdown(wait=True)
+        self.flush()
+
+
+if __name__ == '__main__':
+    applicationPath = os.path.abspath(os.path.dirname(__file__))
+    daemon = Daemon(
+        logger=logging_module.get_logger(application_path=applicationPath, local_time=main.get_local_time()),
+        application_path=applicationPath
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.stopping.set())
+    daemon.run()
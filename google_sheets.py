@@ -1,38 +1,189 @@
-import datetime
-import traceback
+import datetime, json, os, tempfile, threading, time
 from typing import List, Dict, Union
+from urllib.parse import urlparse
 
 import ezsheets
 from googleapiclient.errors import HttpError
 
-import config
+from tenants import config
+import http_client
+from logging_module import metrics
+from order_model import Order
 
 
-def get_sheet_data(local_dt: datetime.datetime,) -> Dict:
-    ss = ezsheets.Spreadsheet(config.google_sheet_id)  # Spreadsheet ID from its URL
-    ss_data = {}
+HEADERS = ['Platform', 'Order', 'Customer', 'Item Qty', 'Item Name', 'Notes', 'Priority']
+TITLE_FORMAT = '%a, %b %d %Y'
+
+SNAPSHOT_FILE = 'sheets snapshot.json'
+
+# What the spreadsheet holds as of the last read or write: {tab title: {'sheet id': int, 'rows': [[str]]}} in tab order,
+# and the Drive version of the file it matches. update_sheet_tabs() compares the desired data with it and sends only
+# the differences, get_sheet_data() skips the download when the version didn't change since the last run.
+# One per application path, as every tenant has its own spreadsheet
+_snapshots = {}
+# The services of ezsheets share one httplib2 connection, which isn't thread-safe
+_service_lock = threading.Lock()
+
+
+def _get_snapshot(application_path: str) -> Dict:
+    return _snapshots.setdefault(application_path, {'version': None, 'tabs': {}})
+
 
-    for sheet in ss.sheets:
-        # Remove the tabs older than today
+def _services() -> tuple:
+    if not ezsheets.IS_INITIALIZED:
+        ezsheets.init()
+    return ezsheets.SHEETS_SERVICE, ezsheets.DRIVE_SERVICE
+
+
+def _is_rate_limited(error: HttpError) -> bool:
+    # Quota errors come as 429, or as 403 with a rate limit reason from the older APIs like Drive v3
+    return error.resp.status in http_client.RETRY_STATUSES or (
+        error.resp.status == 403 and b'ateLimitExceeded' in (error.content or b'')
+    )
+
+
+def _execute(request) -> Dict:
+    # Sends a Google API request through the host's token bucket, retries it after quota errors and records every
+    # attempt in the run metrics
+    netloc = urlparse(request.uri).netloc
+    bucket = http_client.get_bucket(netloc)
+    for attempt in range(http_client.MAX_ATTEMPTS):
+        bucket.acquire()
+        start = time.monotonic()
+        status = 200
         try:
-            sheet_title_dt = datetime.datetime.strptime(sheet.title, '%a, %b %d %Y')
-        except ValueError:
-            # If sheet title is not a date, don't process it as all
+            with _service_lock:
+                response = request.execute()
+            bucket.succeeded()
+            return response
+        except HttpError as error:
+            status = error.resp.status
+            if not _is_rate_limited(error) or attempt == http_client.MAX_ATTEMPTS - 1:
+                raise
+            bucket.back_off(http_client.backoff_delay(attempt, error.resp.get('retry-after')))
+            metrics.count('retries')
+        except Exception as error:
+            status = type(error).__name__
+            raise
+        finally:
+            metrics.observe_call(urlparse(request.uri).hostname, status, time.monotonic() - start)
+
+
+def _get_version() -> str:
+    sheets_service, drive_service = _services()
+    return _execute(drive_service.files().get(fileId=config.google_sheet_id, fields='version'))['version']
+
+
+def _trim_rows(rows: List[List]) -> List[List[str]]:
+    # Compare cells the way Sheets returns them: strings, without trailing empty cells and rows
+    trimmed = []
+    for row in rows:
+        row = [str(cell) for cell in row]
+        while row and row[-1] == '':
+            row.pop()
+        trimmed.append(row)
+    while trimmed and not trimmed[-1]:
+        trimmed.pop()
+    return trimmed
+
+
+def _a1_range(title: str, first_row: int = None) -> str:
+    quoted_title = "'" + title.replace("'", "''") + "'"
+    return quoted_title + '!A' + str(first_row) if first_row else quoted_title
+
+
+def _is_date_tab(title: str) -> bool:
+    try:
+        datetime.datetime.strptime(title, TITLE_FORMAT)
+        return True
+    except ValueError:
+        return False
+
+
+def _read_spreadsheet() -> Dict:
+    # Two requests for the whole spreadsheet: the tab list and the values of all date tabs in one batchGet
+    sheets_service, drive_service = _services()
+    metadata = _execute(sheets_service.spreadsheets().get(
+        spreadsheetId=config.google_sheet_id, fields='sheets.properties(sheetId,title,index)'
+    ))
+    tabs = {}
+    for sheet in sorted(metadata['sheets'], key=lambda sheet: sheet['properties']['index']):
+        tabs[sheet['properties']['title']] = {'sheet id': sheet['properties']['sheetId'], 'rows': []}
+
+    # If sheet title is not a date, don't process it as all
+    date_tabs = [title for title in tabs if _is_date_tab(title)]
+    if date_tabs:
+        value_ranges = _execute(sheets_service.spreadsheets().values().batchGet(
+            spreadsheetId=config.google_sheet_id, ranges=[_a1_range(title) for title in date_tabs]
+        ))['valueRanges']
+        for title, value_range in zip(date_tabs, value_ranges):
+            tabs[title]['rows'] = _trim_rows(value_range.get('values', []))
+    return tabs
+
+
+def _save_snapshot(application_path: str) -> None:
+    snapshot = _get_snapshot(application_path)
+    if snapshot['version'] is None:
+        snapshot['version'] = _get_version()
+    # A temporary file of its own, the worker.py processes may save the snapshot at the same time
+    with tempfile.NamedTemporaryFile('w', dir=application_path, suffix='.tmp', delete=False) as file:
+        json.dump(snapshot, file)
+    os.replace(file.name, os.path.join(application_path, SNAPSHOT_FILE))
+
+
+def _load_snapshot(application_path: str) -> None:
+    # Reuse the last snapshot if nobody changed the spreadsheet since, otherwise download it again
+    snapshot = _get_snapshot(application_path)
+    version = _get_version()
+    if snapshot['version'] != version:
+        try:
+            with open(os.path.join(application_path, SNAPSHOT_FILE), 'r') as file:
+                snapshot.update(json.load(file))
+        except (FileNotFoundError, ValueError):
+            pass
+    if snapshot['version'] != version:
+        snapshot['tabs'] = _read_spreadsheet()
+        snapshot['version'] = version
+
+
+def get_sheet_data(local_dt: datetime.datetime, application_path: str) -> Dict:
+    snapshot = _get_snapshot(application_path)
+    _load_snapshot(application_path=application_path)
+    ss_data = {}
+
+    # Remove the tabs older than today, all in one request
+    expired = []
+    for title, tab in snapshot['tabs'].items():
+        if not _is_date_tab(title):
             continue
-        if sheet_title_dt < local_dt.replace(tzinfo=None) - datetime.timedelta(days=2):
-            sheet.delete()
+        if datetime.datetime.strptime(title, TITLE_FORMAT) < local_dt.replace(tzinfo=None) - datetime.timedelta(days=2):
+            expired.append(title)
         else:
             rows = []
-            # Get not empty rows only
-            for row in sheet.getRows():
+            # Get not empty rows only, without the header row
+            for row in tab['rows'][1:] if tab['rows'] and tab['rows'][0] == HEADERS else tab['rows']:
                 if True in (elem != '' for elem in row):
-                    rows.append(row)
-            ss_data[sheet.title] = rows
+                    rows.append(row + [''] * (len(HEADERS) - len(row)))
+            ss_data[title] = rows
 
+    if expired and len(expired) < len(snapshot['tabs']):  # A spreadsheet can't have zero tabs
+        sheets_service, drive_service = _services()
+        _execute(sheets_service.spreadsheets().batchUpdate(
+            spreadsheetId=config.google_sheet_id,
+            body={'requests': [{'deleteSheet': {'sheetId': snapshot['tabs'][title]['sheet id']}} for title in expired]}
+        ))
+        for title in expired:
+            del snapshot['tabs'][title]
+        snapshot['version'] = None
 
     return ss_data
 
 
+def is_shown(delivery_dt: datetime.datetime, local_dt: datetime.datetime) -> bool:
+    # The dashboard only has tabs for the deliveries from yesterday on, the older orders aren't added
+    return delivery_dt >= local_dt - datetime.timedelta(days=1)
+
+
 def add_order_to_sheet_data(
         ss_data: Dict[str, List],
         delivery_dt: datetime.datetime,
@@ -45,7 +196,7 @@ def add_order_to_sheet_data(
         notes: str,
         customer_rank: Union[str, int]
 ) -> Dict:
-    if delivery_dt < local_dt - datetime.timedelta(days=1):
+    if not is_shown(delivery_dt, local_dt):
         return ss_data
     # If there is no sheet for this delivery date yet, create it
     sheet_title = delivery_dt.strftime('%a, %b %d %Y')
@@ -63,49 +214,95 @@ def add_order_to_sheet_data(
     return ss_data
 
 
-def update_sheet_tabs(ss_data: Dict[str, List]) -> None:
-    ss = ezsheets.Spreadsheet(config.google_sheet_id)  # Spreadsheet ID from its URL
+def add_order_rows(
+        ss_data: Dict[str, List],
+        order: Order,
+        local_dt: datetime.datetime,
+        customer_rank: Union[str, int]
+) -> Dict:
+    # One dashboard row per line item
+    for line in order.lines:
+        add_order_to_sheet_data(
+            ss_data=ss_data,
+            delivery_dt=order.delivery_dt,
+            local_dt=local_dt,
+            platform=order.platform,
+            order_id=order.order_id,
+            customer_name=order.customer,
+            quantity=line.quantity,
+            item_name=line.name,
+            notes=order.notes,
+            customer_rank=customer_rank
+        )
+    return ss_data
+
+
+def update_sheet_tabs(ss_data: Dict[str, List], application_path: str) -> None:
+    snapshot = _get_snapshot(application_path)
+    if snapshot['version'] is None and not snapshot['tabs']:
+        _load_snapshot(application_path=application_path)  # Nothing was read in this process yet
+    tabs = snapshot['tabs']
 
     # Sort each spreadsheet's rows by customer rank/priority and add headers to the first row
-    for tab in ss_data.keys():
-        rows = ss_data[tab]
-        rows.sort(key=lambda x: x[6])  # sort by the 7th column (customer rank)
-        rows = [[
-            'Platform',
-            'Order',
-            'Customer',
-            'Item Qty',
-            'Item Name',
-            'Notes',
-            'Priority'
-        ]] + rows  # add headers to the beginning
-        ss_data[tab] = rows
-
-    # Sort sheets by date using a datetime object made from tab names
-    tabs_order = []
-    for key in ss_data.keys():
-        tabs_order.append([
-            datetime.datetime.strptime(key, '%a, %b %d %Y'),
-            key
-        ])
-    tabs_order.sort()
-
-    # Remove old sheets and add new ones
-    try:
-        ss.createSheet('[none]', 0)  # Create an empty sheet because you can't leave zero sheets
-    except HttpError:
-        if '"[none]" already exists' in traceback.format_exc():
-            pass
-        else:
-            raise Exception(traceback.format_exc())
+    desired = {}
+    for tab in sorted(ss_data.keys(), key=lambda key: datetime.datetime.strptime(key, TITLE_FORMAT)):
+        rows = sorted(ss_data[tab], key=lambda x: x[6])  # sort by the 7th column (customer rank)
+        desired[tab] = _trim_rows([HEADERS] + rows)  # add headers to the beginning
 
-    for sheet in ss.sheets[1:]:
-        sheet.delete()
-    len(ss.sheets)
+    # Tabs: add the new ones, remove the ones that aren't needed anymore and fix the order, all in one request
+    requests = []
+    sheet_ids = {tab: tabs[tab]['sheet id'] for tab in desired if tab in tabs}
+    used_ids = {tab_data['sheet id'] for tab_data in tabs.values()}
+    order = [tab for tab in tabs if tab in desired]
+    for tab in desired:
+        if tab not in sheet_ids:
+            sheet_ids[tab] = max(used_ids | set(sheet_ids.values()) | {0}) + 1
+            requests.append({'addSheet': {'properties': {'sheetId': sheet_ids[tab], 'title': tab}}})
+            order.append(tab)
+    obsolete = [tab for tab in tabs if tab not in desired]
+    if not desired:
+        obsolete = obsolete[1:]  # A spreadsheet can't have zero tabs
+    for tab in obsolete:
+        requests.append({'deleteSheet': {'sheetId': tabs[tab]['sheet id']}})
+    for index, tab in enumerate(desired):
+        # Only move tabs towards the beginning, the ones before index are already in place
+        if order[index] != tab:
+            order.remove(tab)
+            order.insert(index, tab)
+            requests.append({'updateSheetProperties': {
+                'properties': {'sheetId': sheet_ids[tab], 'index': index},
+                'fields': 'index'
+            }})
+    service, drive_service = _services()
+    if requests:
+        _execute(service.spreadsheets().batchUpdate(spreadsheetId=config.google_sheet_id, body={'requests': requests}))
 
-    for item in tabs_order:
-        tabName = item[1]
-        sheet = ss.createSheet(tabName)
-        sheet.updateRows(ss_data[tabName])
+    # Values: rewrite each tab from its first changed row and blank out rows that are not needed anymore
+    data = []
+    for tab, rows in desired.items():
+        old_rows = tabs[tab]['rows'] if tab in tabs else []
+        first_changed = 0
+        while first_changed < min(len(rows), len(old_rows)) and rows[first_changed] == old_rows[first_changed]:
+            first_changed += 1
+        if first_changed == len(rows) == len(old_rows):
+            continue
+        values = []
+        for i in range(first_changed, max(len(rows), len(old_rows))):
+            row = rows[i] if i < len(rows) else []
+            width = max(len(HEADERS), len(old_rows[i]) if i < len(old_rows) else 0)
+            values.append(row + [''] * (width - len(row)))
+        data.append({'range': _a1_range(tab, first_changed + 1), 'values': values})
+    if data:
+        _execute(service.spreadsheets().values().batchUpdate(
+            spreadsheetId=config.google_sheet_id,
+            body={'valueInputOption': 'USER_ENTERED', 'data': data}
+        ))
+    metrics.count('sheet rows written', sum(len(value_range['values']) for value_range in data))
 
-    ss.sheets[0].delete()  # Remove the dummy sheet
+    if requests or data:
+        snapshot['version'] = None
+    if desired:
+        snapshot['tabs'] = {tab: {'sheet id': sheet_ids[tab], 'rows': rows} for tab, rows in desired.items()}
+    else:
+        snapshot['tabs'] = {tab: tab_data for tab, tab_data in tabs.items() if tab not in obsolete}
+    _save_snapshot(application_path=application_path)
@@ -0,0 +1,160 @@
+# The HTTP requests of the connectors go through here: one requests session per thread keeps the connections to each
+# API alive between calls, every call is counted per host and status with its latency in the run metrics, and a token
+# bucket per host keeps the calls under the API's rate limit
+from typing import Dict, Tuple, Union
+from urllib.parse import urlparse
+import random, threading, time
+
+import requests
+
+import config
+import tenants
+from logging_module import metrics
+
+# Requests per second and burst per host, config.rate_limits overrides and extends them. A key matches the host
+# (with the port, if it has one) or its ending. An API limited per account rather than per host, like QuickBooks
+# per company, passes the account as limit_key and gets a bucket of its own with the host's limits
+DEFAULT_RATE_LIMITS: Dict[str, Tuple[float, float]] = {
+    '.myshopify.com': (2, 40),  # REST Admin API leaky bucket
+    'quickbooks.api.intuit.com': (8, 10),  # 500 requests a minute per company
+    'sheets.googleapis.com': (1, 10),  # 60 requests a minute per user
+    'www.googleapis.com': (1, 10)
+}
+RETRY_STATUSES = {429, 503}
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1  # Seconds before the first retry without Retry-After, doubles with every attempt
+BACKOFF_MAX = 60
+# Shopify reports how full its bucket is, e.g. '32/40'
+SHOPIFY_CALL_LIMIT_HEADER = 'X-Shopify-Shop-Api-Call-Limit'
+
+_local = threading.local()
+
+
+def base_url(api: str, default: str) -> str:
+    # config.api_urls overrides the base URL of an API by its name, e.g. {'quickbooks': 'http://127.0.0.1:8000'} points
+    # the module at a local stand-in server. Read in the tenant's settings, which may have their own
+    return getattr(tenants.config, 'api_urls', {}).get(api, default)
+
+
+class TokenBucket:
+    """Lets requests to one host through at `rate` per second with bursts of up to `burst`.
+
+    After a 429 the rate is halved and every thread waits out the back-off, each success then raises it by a tenth of
+    the configured rate, so the client settles just under the limit the server actually enforces. Without a rate the
+    bucket only applies the back-offs.
+    """
+
+    def __init__(self, rate: Union[float, None] = None, burst: float = 1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        # Blocks until a request may be sent, returns the seconds waited
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.rate:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif not self.rate:
+                    return waited
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def back_off(self, delay: float) -> None:
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.tokens = 0
+            if self.rate:
+                self.rate = max(self.rate / 2, self.max_rate / 16)
+
+    def succeeded(self) -> None:
+        with self._lock:
+            if self.rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def observe_usage(self, used: int, limit: int) -> None:
+        # The server's count is the truth: never hold more tokens than it has room for
+        with self._lock:
+            self.burst = limit
+            self.tokens = min(self.tokens, max(limit - used, 0))
+
+
+_buckets: Dict[Tuple[str, Union[str, None]], TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(netloc: str, limit_key: Union[str, None] = None) -> TokenBucket:
+    # One bucket per host, or per account of the host, shared by all threads
+    with _buckets_lock:
+        if (netloc, limit_key) not in _buckets:
+            limits = dict(DEFAULT_RATE_LIMITS, **getattr(config, 'rate_limits', {}))
+            host = netloc.split(':')[0]
+            matches = [key for key in limits if key in (netloc, host) or host.endswith(key)]
+            _buckets[(netloc, limit_key)] = TokenBucket(*limits[max(matches, key=len)]) if matches else TokenBucket()
+        return _buckets[(netloc, limit_key)]
+
+
+def backoff_delay(attempt: int, retry_after: Union[str, None] = None) -> float:
+    # Retry-After if the server sent one, exponential otherwise, with jitter so the threads don't retry all at once
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+    return delay * random.uniform(1, 1.5)
+
+
+def get_session() -> requests.Session:
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def request(method: str, url: str, limit_key: Union[str, None] = None, **kwargs) -> requests.Response:
+    netloc = urlparse(url).netloc
+    host = urlparse(url).hostname
+    bucket = get_bucket(netloc, limit_key)
+    for attempt in range(MAX_ATTEMPTS):
+        waited = bucket.acquire()
+        if waited:
+            metrics.count('throttled seconds', waited)
+        start = time.monotonic()
+        try:
+            response = get_session().request(method, url, **kwargs)
+        except requests.RequestException as error:
+            metrics.observe_call(host, type(error).__name__, time.monotonic() - start)
+            raise
+        metrics.observe_call(host, response.status_code, time.monotonic() - start)
+
+        call_limit = response.headers.get(SHOPIFY_CALL_LIMIT_HEADER)
+        if call_limit:
+            used, limit = call_limit.split('/')
+            bucket.observe_usage(int(used), int(limit))
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+            if response.status_code < 400:
+                bucket.succeeded()
+            return response
+        # The request wasn't processed: wait, with every other thread calling this host, and send it again
+        bucket.back_off(backoff_delay(attempt, response.headers.get('Retry-After')))
+        metrics.count('retries')
+
+
+def get(url: str, limit_key: Union[str, None] = None, **kwargs) -> requests.Response:
+    return request('GET', url, limit_key=limit_key, **kwargs)
+
+
+def post(url: str, limit_key: Union[str, None] = None, **kwargs) -> requests.Response:
+    return request('POST', url, limit_key=limit_key, **kwargs)
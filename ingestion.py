@@ -0,0 +1,63 @@
+from typing import Callable, Dict, List
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import time, traceback
+
+from tenants import config
+import state
+import tenants
+from logging_module import metrics
+
+# Seconds each platform may take before its orders are skipped for this run
+DEFAULT_TIME_BUDGET = 300
+
+
+def _timed(platform: str, generation: int, fetch: Callable[[], List]) -> Dict:
+    start = time.monotonic()
+    with state.fetching(platform, generation), metrics.stage(f'fetch {platform}'):
+        orders = fetch()
+    metrics.count(f'{platform} orders', len(orders))
+    return {'orders': orders, 'seconds': time.monotonic() - start}
+
+
+def fetch_orders(
+        sources: Dict[str, Callable[[], List]],
+        logger: getLogger,
+        on_done: Callable[[str], None] = None
+) -> Dict[str, List]:
+    # Run every connector in its own thread, so the total time is close to the slowest one instead of the sum.
+    # on_done(platform) is called when the thread actually ends, which may be after this returns
+    time_budget = getattr(config, 'ingestion_time_budget', {})
+    start = time.monotonic()
+    orders = {}
+
+    executor = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix='ingestion')
+    futures = {}
+    generations = {}
+    for platform, fetch in sources.items():
+        generations[platform] = state.start_fetch(platform)
+        futures[platform] = tenants.submit(executor, _timed, platform, generations[platform], fetch)
+        if on_done:
+            futures[platform].add_done_callback(lambda _, platform=platform: on_done(platform))
+
+    for platform, future in futures.items():
+        deadline = start + time_budget.get(platform, DEFAULT_TIME_BUDGET)
+        try:
+            result = future.result(timeout=max(deadline - time.monotonic(), 0))
+            orders[platform] = result['orders']
+            logger.info(f'{platform}: {len(result["orders"])} orders in {result["seconds"]:.1f}s')
+        except TimeoutError:
+            # The thread can't be stopped, but its cursor won't be saved, so these orders are fetched again next run
+            state.abandon(platform, generations[platform])
+            orders[platform] = []
+            logger.error(f'{platform} didn\'t return orders within {time_budget.get(platform, DEFAULT_TIME_BUDGET)}s, '
+                         f'skipped until the next run')
+        except:
+            orders[platform] = []
+            logger.error(f'{platform} failed:')
+            logger.error(traceback.format_exc())
+
+    executor.shutdown(wait=False)
+    logger.info(f'Ingestion took {time.monotonic() - start:.1f}s')
+
+    return orders
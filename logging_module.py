@@ -1,26 +1,271 @@
-import logging, os, datetime
+from typing import Dict
+import atexit, collections, contextlib, copy, fcntl, json, logging, logging.handlers, os, datetime, queue, tempfile, \
+    threading, time
+
+import config
+import tenants
+
+LOGS_FOLDER_NAME = 'logs for the past 20 days'
+LOG_FILE = 'log.jsonl'  # The current log, one JSON record per line. Rotated ones get the time of rotation in the name
+LOCK_FILE = 'log.lock'  # Held by the process rotating the log
+METRICS_FILE = 'metrics.jsonl'  # One JSON summary per run, appended, in the logs folder
+DEFAULT_LOG_MAX_BYTES = 10 * 2 ** 20
+DEFAULT_LOG_RETENTION_DAYS = 20
+# Upper bounds of the latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'module': record.module,
+            'message': record.getMessage()
+        }
+        if getattr(record, 'tenant', None):
+            entry['tenant'] = record.tenant
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only what can't wait happens in the calling thread: the arguments are merged into the message and the
+        # traceback is turned into text, the JSON is made by the background thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.tenant = tenants.get_name()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RotatingLogHandler(logging.handlers.BaseRotatingHandler):
+    """Appends to LOG_FILE and rotates it when it grows over max_bytes or a new day starts.
+
+    The rotated file is renamed 'log <time>.jsonl' and the rotated files older than retention_days are removed then,
+    so the folder is only listed at a rotation, never at startup. main.py, daemon.py, the worker.py processes and the
+    Flask app share the file: the first one to rotate renames it, the others find it renamed and only reopen.
+    """
+
+    def __init__(self, logs_path: str, max_bytes: int, retention_days: int):
+        self.logs_path = logs_path
+        self.max_bytes = max_bytes
+        self.retention_days = retention_days
+        path = os.path.join(logs_path, LOG_FILE)
+        super().__init__(path, 'a', encoding='utf-8', delay=False)
+        self.day = datetime.date.fromtimestamp(os.stat(path).st_mtime) if os.path.getsize(path) else datetime.date.today()
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if datetime.date.fromtimestamp(record.created) != self.day:
+            return True
+        return self.stream.tell() >= self.max_bytes
+
+    def _is_renamed(self) -> bool:
+        # Whether LOG_FILE is no longer the file this process has open
+        try:
+            return not os.path.samestat(os.stat(self.baseFilename), os.fstat(self.stream.fileno()))
+        except FileNotFoundError:
+            return True
+
+    def doRollover(self) -> None:
+        now = datetime.datetime.now()
+        # The lock makes the check and the rename one step across the processes
+        with open(os.path.join(self.logs_path, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            rotate = not self._is_renamed()
+            if rotate:
+                rotated = os.path.join(self.logs_path, 'log ' + now.strftime('%Y-%m-%d %H-%M-%S-%f') + '.jsonl')
+                os.replace(self.baseFilename, rotated)
+            self.stream.close()
+            self.stream = self._open()
+        self.day = now.date()
+        if not rotate:
+            return
+        # Remove the old logs
+        for file_name in os.listdir(self.logs_path):
+            path = os.path.join(self.logs_path, file_name)
+            try:
+                if file_name.startswith('log ') and os.path.getmtime(path) < now.timestamp() - self.retention_days * 86400:
+                    os.remove(path)
+            except OSError:
+                continue
 
 
 def get_logger(
         application_path: str, local_time: datetime.datetime
 ) -> logging.getLogger:
+    # The records go to a queue and a background thread writes them, so a log call never waits for the disk.
+    # The queue is flushed when the process exits
+    global _listener
+    logger = logging.getLogger()
+    if _listener is not None:
+        return logger
+
     # Create the logs folder if it's not created yet
-    logs_folder_name = 'logs for the past 20 days'
-    logs_path = os.path.join(application_path, logs_folder_name)
-    if logs_folder_name not in os.listdir(application_path):
-        os.mkdir(logs_path)
+    logs_path = os.path.join(application_path, LOGS_FOLDER_NAME)
+    os.makedirs(logs_path, exist_ok=True)
 
     # Create the logging object
-    report_name = os.path.join(logs_path, 'log ' + local_time.strftime('%Y-%m-%d %H-%M-%S') + '.txt')
-    logging.basicConfig(filename=report_name, level=logging.INFO, format=' %(asctime)s -  %(levelname)s -  %(message)s')
+    file_handler = RotatingLogHandler(
+        logs_path=logs_path,
+        max_bytes=getattr(config, 'log_max_bytes', DEFAULT_LOG_MAX_BYTES),
+        retention_days=getattr(config, 'log_retention_days', DEFAULT_LOG_RETENTION_DAYS)
+    )
+    file_handler.setFormatter(JsonFormatter())
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    logger.addHandler(_QueueHandler(records))
+    logger.setLevel(logging.INFO)
+    logger.info(f'Started at {local_time.isoformat()}')
+
+    return logger
 
-    # Remove the old logs
-    for fileName in os.listdir(logs_path):
+
+def stop_logging() -> None:
+    # Writes the records still in the queue and stops the background thread, get_logger() starts it again
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        logging.getLogger().handlers = [
+            handler for handler in logging.getLogger().handlers
+            if not isinstance(handler, logging.handlers.QueueHandler)
+        ]
+        _listener = None
+
+
+class Metrics:
+    """Timers of the pipeline stages, counters of the processed orders and rows, and the external calls per host.
+
+    Every module records into the shared `metrics` object below, write_metrics() saves the summary and starts over.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started = time.time()
+            self.stages = {}  # {name: {'count': int, 'seconds': float}}
+            self.counters = collections.Counter()
+            self.calls = collections.Counter()  # {(host, status): count}
+            self.latencies = {}  # {host: {'buckets': [count per bucket + overflow], 'count', 'sum', 'max'}}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        # with metrics.stage('sheets write'): ...
+        start = time.monotonic()
         try:
-            log_date = datetime.datetime.strptime(fileName[4:-4], '%Y-%m-%d %H-%M-%S')
-            if log_date < (local_time - datetime.timedelta(days=20)):
-                os.remove(os.path.join(logs_path, fileName))
-        except:
-            continue
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            with self._lock:
+                stage = self.stages.setdefault(name, {'count': 0, 'seconds': 0.0})
+                stage['count'] += 1
+                stage['seconds'] += seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def observe_call(self, host: str, status, seconds: float) -> None:
+        # status is the HTTP status code, or a short word for protocols and failures without one
+        with self._lock:
+            self.calls[(host, str(status))] += 1
+            latency = self.latencies.setdefault(
+                host, {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'count': 0, 'sum': 0.0, 'max': 0.0}
+            )
+            index = 0
+            while index < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[index]:
+                index += 1
+            latency['buckets'][index] += 1
+            latency['count'] += 1
+            latency['sum'] += seconds
+            latency['max'] = max(latency['max'], seconds)
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                'started': datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat(),
+                'seconds': round(time.time() - self.started, 3),
+                'stages': {name: {'count': stage['count'], 'seconds': round(stage['seconds'], 3)}
+                           for name, stage in self.stages.items()},
+                'counters': dict(self.counters),
+                'calls': [{'host': host, 'status': status, 'count': count}
+                          for (host, status), count in sorted(self.calls.items())],
+                'latency buckets': list(LATENCY_BUCKETS),
+                'latencies': {host: dict(latency, sum=round(latency['sum'], 3), max=round(latency['max'], 3))
+                              for host, latency in self.latencies.items()}
+            }
+
+
+metrics = Metrics()
+
+
+def _prometheus_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(summary: Dict) -> str:
+    # Text exposition format, for the node_exporter textfile collector
+    lines = ['# TYPE orders_run_seconds gauge', f'orders_run_seconds {summary["seconds"]}',
+             '# TYPE orders_stage_seconds gauge']
+    for name, stage in summary['stages'].items():
+        lines.append(f'orders_stage_seconds{{stage="{_prometheus_label(name)}"}} {stage["seconds"]}')
+    lines.append('# TYPE orders_stage_runs gauge')
+    for name, stage in summary['stages'].items():
+        lines.append(f'orders_stage_runs{{stage="{_prometheus_label(name)}"}} {stage["count"]}')
+    lines.append('# TYPE orders_processed gauge')
+    for name, value in summary['counters'].items():
+        lines.append(f'orders_processed{{name="{_prometheus_label(name)}"}} {value}')
+    lines.append('# TYPE orders_api_calls gauge')
+    for call in summary['calls']:
+        lines.append(f'orders_api_calls{{host="{_prometheus_label(call["host"])}",'
+                     f'status="{_prometheus_label(call["status"])}"}} {call["count"]}')
+    lines.append('# TYPE orders_api_call_seconds histogram')
+    for host, latency in summary['latencies'].items():
+        label = f'host="{_prometheus_label(host)}"'
+        cumulative = 0
+        for bound, count in zip(list(summary['latency buckets']) + ['+Inf'], latency['buckets']):
+            cumulative += count
+            lines.append(f'orders_api_call_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f'orders_api_call_seconds_sum{{{label}}} {latency["sum"]}')
+        lines.append(f'orders_api_call_seconds_count{{{label}}} {latency["count"]}')
+    return '\n'.join(lines) + '\n'
+
 
-    return logging.getLogger()
\ No newline at end of file
+def write_metrics(application_path: str, logger: logging.getLogger) -> Dict:
+    # Appends the summary of this run to the metrics file and, if config.prometheus_file is set, rewrites that file
+    # in the Prometheus text format. The metrics start over for the next run
+    summary = metrics.summary()
+    metrics.reset()
+    try:
+        with open(os.path.join(application_path, LOGS_FOLDER_NAME, METRICS_FILE), 'a') as file:
+            file.write(json.dumps(summary) + '\n')
+        prometheus_file = getattr(config, 'prometheus_file', None)
+        if prometheus_file:
+            # Write and rename, so the collector never reads half a file. A temporary file of its own, the processes
+            # sharing the file may write it at the same time
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(prometheus_file)),
+                                             suffix='.tmp', delete=False) as file:
+                file.write(format_prometheus(summary))
+            os.chmod(file.name, 0o644)  # It's created readable by its owner only, the collector may be another user
+            os.replace(file.name, prometheus_file)
+    except:
+        logger.exception('Metrics couldn\'t be saved:')
+    logger.info(f'Stages: {json.dumps(summary["stages"])}')
+    return summary
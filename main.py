@@ -1,185 +1,204 @@
-from typing import Dict
-from decimal import Decimal
+from typing import Callable, Dict, List, Tuple, Union
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
 from dateutil import tz
-import os, datetime, csv
-
-import logging_module, shopify, rekki, marketman, notch, quickbooks, google_sheets
-
-
-def get_table(file_name: str) -> Dict:
-    data = list(csv.reader(open(os.path.join(application_path, file_name))))
-    table = {}
-    for row in data:
-        table[row[0]] = row[1]
-    return table
-
-
-application_path = os.path.abspath(os.path.dirname(__file__))
-localTime = datetime.datetime.utcnow().replace(tzinfo=tz.gettz('UTC')).astimezone(tz.gettz('America/Toronto'))
-logger = logging_module.get_logger(application_path=application_path, local_time=localTime)
-
-# Obtain the orders data
-orders = {
-    'shopify': shopify.get_orders(logger=logger, application_path=application_path),
-    'rekki': rekki.get_orders(logger=logger, application_path=application_path),
-    'marketman': marketman.get_orders(logger=logger, application_path=application_path, local_time=localTime),
-    'notch': notch.get_orders(logger=logger, application_path=application_path)
-}
-
-# Load the dictionary with the location info per each product
-# The first item is product code, the second one is location
-productLocation = get_table('product codes location.csv')
-
-# Load the dictionary with the customer rank info
-# The first item is customer ID, the second one is rank int()
-customerRank = get_table('customer rank.csv')
-
-# Match the Rekki product codes with Shopify codes
-orders['rekki'] = rekki.match_product_codes(orders=orders['rekki'], application_path=application_path)
-
-# todo Add the location information using the productLocation dictionary
-
-# Get the existing data from Google Sheets
-ssData = google_sheets.get_sheet_data(local_dt=localTime)
-
-# Add the orders with delivery date starting from today to the spreadsheet
-for order in orders['shopify']:
-    deliveryDateTime = shopify.get_delivery_dt(order)
-    customerName = (order['customer']['first_name'] + ' ' + order['customer']['last_name']).strip()
-    for item in order['line_items']:
-        ssData = google_sheets.add_order_to_sheet_data(
-            ss_data=ssData,
-            delivery_dt=deliveryDateTime,
-            local_dt=localTime,
-            platform='Shopify',
-            order_id=order['id'],
-            customer_name=customerName,
-            quantity=item['quantity'],
-            item_name=item['name'],
-            notes='',
-            customer_rank=customerRank.get(customerName, '')
+import os, datetime, functools, socket, traceback, uuid
+
+import logging_module, ingestion, pipeline, reference_data, shopify, rekki, marketman, notch, quickbooks, qb_tokens, \
+    google_sheets, state, tenants
+from tenants import config
+from logging_module import metrics
+from order_model import Order
+
+
+def get_local_time() -> datetime.datetime:
+    return datetime.datetime.utcnow().replace(tzinfo=tz.gettz('UTC')).astimezone(tz.gettz('America/Toronto'))
+
+
+def get_sources(
+        logger: getLogger, application_path: str, local_time: datetime.datetime
+) -> Dict[str, Callable[[], List[Order]]]:
+    return {
+        'shopify': lambda: shopify.get_orders(logger=logger, application_path=application_path),
+        'shopify webhooks': lambda: shopify.get_queued_orders(logger=logger, application_path=application_path),
+        'rekki': lambda: rekki.get_orders(logger=logger, application_path=application_path),
+        'marketman': lambda: marketman.get_orders(logger=logger, application_path=application_path, local_time=local_time),
+        'notch': lambda: notch.get_orders(logger=logger, application_path=application_path, local_time=local_time)
+    }
+
+
+# Seconds a worker may hold claimed jobs before another one takes them over, config.job_lease_seconds overrides it
+LEASE_SECONDS = 300
+# Jobs per claim: one sheet sync writes all of its claim, QuickBooks posts its claim in parallel /batch requests
+CLAIM_SIZES = {'google sheets': 2000, 'quickbooks': 300}
+
+
+def write_sheet(
+        jobs: List[Tuple[int, Order]], logger: getLogger, application_path: str, local_time: datetime.datetime
+) -> Dict[int, str]:
+    # Adds the orders to the spreadsheet in one sync. An order already in the spreadsheet isn't added again, so a job
+    # retried after a crash doesn't duplicate its rows. Returns the errors of the failed jobs
+    with metrics.stage('sheets read'):
+        ss_data = google_sheets.get_sheet_data(local_dt=local_time, application_path=application_path)
+    written = {(row[0], str(row[1])) for rows in ss_data.values() for row in rows}
+
+    def add_to_sheet(order: Order) -> None:
+        # Add the orders with delivery date starting from today to the spreadsheet
+        if (order.platform, str(order.order_id)) in written:
+            return
+        google_sheets.add_order_rows(
+            ss_data=ss_data,
+            order=order,
+            local_dt=local_time,
+            customer_rank=reference_data.customer_rank(order.customer, application_path=application_path)
         )
+        written.add((order.platform, str(order.order_id)))
+
+    errors = pipeline.apply(jobs=jobs, sink=add_to_sheet, logger=logger)
+
+    # Save the orders in the Google Spreadsheet
+    with metrics.stage('sheets write'):
+        google_sheets.update_sheet_tabs(ss_data=ss_data, application_path=application_path)
+    return errors
+
+
+def write_quickbooks(
+        jobs: List[Tuple[int, Order]], owner: str, logger: getLogger, application_path: str
+) -> Dict[int, str]:
+    # Creates or updates the estimates of the orders. The ledger skips the orders whose estimate is up to date, so a
+    # retried job doesn't create a second one. A job taken over from a worker that crashed between sending its
+    # estimate and saving the ledger goes again under the saved requestid. Returns the errors of the failed jobs
+    pending_estimates = []
+
+    def add_to_quickbooks(order: Order) -> None:
+        estimate = quickbooks.build_order_estimate(order=order, logger=logger, application_path=application_path)
+        if estimate:
+            pending_estimates.append(estimate)
+
+    errors = pipeline.apply(jobs=jobs, sink=add_to_quickbooks, logger=logger)
+
+    job_ids = {(order.platform, str(order.order_id)): job_id for job_id, order in jobs}
+    requests = state.get_job_requests(application_path, job_ids.values())
+    for estimate in pending_estimates:
+        job_id = job_ids[(estimate['platform'], str(estimate['order number']))]
+        if job_id in requests:
+            estimate['request id'], estimate['batch item'] = requests[job_id]
+
+    def remember(chunks: Dict[str, List[Dict]]) -> None:
+        state.set_job_requests(application_path, owner, {
+            job_ids[(item['platform'], str(item['order number']))]: (request_id, item['batch item'])
+            for request_id, chunk in chunks.items() for item in chunk
+        })
+
+    answered = {}
+    for result in quickbooks.create_qb_estimates(pending=pending_estimates, logger=logger,
+                                                 application_path=application_path, remember=remember):
+        if 'error' in result:
+            job_id = job_ids[(result['platform'], str(result['order number']))]
+            errors[job_id] = result['error']
+            # A fault QuickBooks answered is retried under a new requestid, one without an answer under the same
+            if 'request id' not in result:
+                answered[job_id] = (None, None)
+    state.set_job_requests(application_path, owner, answered)
+    return errors
+
+
+def process_jobs(
+        sink: str, owner: str, logger: getLogger, application_path: str, local_time: datetime.datetime
+) -> int:
+    # Claims a batch of the sink's jobs, writes them, then completes them or puts the failed ones back for a retry.
+    # Returns the number of jobs claimed, 0 when nothing is due
+    jobs = state.claim_jobs(
+        application_path, sink, owner, limit=CLAIM_SIZES[sink],
+        lease_seconds=getattr(config, 'job_lease_seconds', LEASE_SECONDS),
+        exclusive=sink == 'google sheets'  # Two concurrent syncs of one spreadsheet would overwrite each other
+    )
+    if not jobs:
+        return 0
+    try:
+        if sink == 'google sheets':
+            errors = write_sheet(jobs=jobs, logger=logger, application_path=application_path, local_time=local_time)
+        else:
+            errors = write_quickbooks(jobs=jobs, owner=owner, logger=logger, application_path=application_path)
+    except Exception as error:
+        logger.error(f'Writing {len(jobs)} orders to {sink} failed, they will be retried:')
+        logger.error(traceback.format_exc())
+        errors = {job_id: f'{type(error).__name__}: {error}' for job_id, order in jobs}
+
+    state.complete_jobs(application_path, owner, [job_id for job_id, order in jobs if job_id not in errors])
+    dead = state.fail_jobs(application_path, owner, errors)
+    metrics.count(f'{sink} jobs done', len(jobs) - len(errors))
+    metrics.count(f'{sink} jobs retried', len(errors) - dead)
+    if dead:
+        metrics.count(f'{sink} jobs dead', dead)
+        logger.error(f'{dead} {sink} jobs failed for the last time and were moved to dead_jobs')
+    return len(jobs)
+
+
+def write_queued(
+        logger: getLogger, application_path: str, local_time: datetime.datetime, owner: Union[str, None] = None
+) -> None:
+    # Writes every due job, the sinks at the same time. A failing sink doesn't hold up the other one
+    owner = owner or f'{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex[:8]}'
+
+    def drain(sink: str) -> None:
+        while process_jobs(sink=sink, owner=owner, logger=logger, application_path=application_path,
+                           local_time=local_time):
+            continue
+
+    pipeline.run_outputs(outputs={sink: functools.partial(drain, sink) for sink in state.SINKS}, logger=logger)
+
+
+def sync(logger: getLogger, application_path: str, local_time: datetime.datetime) -> None:
+    # Obtain the orders data. The connectors queue the orders for the sinks as they save their cursors
+    ingestion.fetch_orders(
+        sources=get_sources(logger=logger, application_path=application_path, local_time=local_time),
+        logger=logger
+    )
 
-for order in orders['rekki']:
-    deliveryDateTime = rekki.get_delivery_dt(order)
-    for item in order['items']:
-        ssData = google_sheets.add_order_to_sheet_data(
-            ss_data=ssData,
-            delivery_dt=deliveryDateTime,
-            local_dt=localTime,
-            platform='Rekki',
-            order_id=order['reference'],
-            customer_name=order['customer_account_no'],
-            quantity=item['quantity'],
-            item_name=item['name'],
-            notes=order['notes'],
-            customer_rank=customerRank.get(order['customer_account_no'], '')
-        )
+    # todo Add the location information using reference_data.product_location()
 
-for order in orders['marketman']:
-    # Convert Marketman UTC timestamp string to local time datetime object
-    deliveryDateTime = marketman.get_delivery_dt(order)
-    for item in order['Items']:
-        ssData = google_sheets.add_order_to_sheet_data(
-            ss_data=ssData,
-            delivery_dt=deliveryDateTime,
-            local_dt=localTime,
-            platform='Marketman',
-            order_id=order['OrderNumber'],
-            customer_name=order['BuyerName'],
-            quantity=item['Quantity'],
-            item_name=item['ItemName'],
-            notes=order['Comments'],
-            customer_rank= customerRank.get(order['BuyerName'], '')
-        )
+    # Write them, together with the ones left by an earlier run that failed or crashed
+    write_queued(logger=logger, application_path=application_path, local_time=local_time)
 
-for order in orders['notch']:
-    deliveryDateTime, notes = notch.get_delivery_dt(order, localTime)
-    ssData = google_sheets.add_order_to_sheet_data(
-        ss_data=ssData,
-        delivery_dt=deliveryDateTime,
-        local_dt=localTime,
-        platform='Notch',
-        order_id=order['id'],
-        customer_name=order['customer'],
-        quantity='',
-        item_name=order['order url'],
-        notes=notes,
-        customer_rank=customerRank.get(order['customer'], '')
-    )
+    logger.info(f'QuickBooks token: {qb_tokens.get_token_manager(application_path).stats()}')
+    logger.info(f'Jobs left: {state.count_jobs(application_path)}')
 
-# Save the orders in the Google Spreadsheet
-google_sheets.update_sheet_tabs(ssData)
-
-# Create Estimates in QuickBooks
-for order in orders['shopify']:
-    lineItems = []
-    for line in order['line_items']:
-        discount = Decimal("0")
-        for discount_allocation in line['discount_allocations']:
-            discount += Decimal(discount_allocation['amount'])
-        lineItems.append(
-            quickbooks.prepare_qb_line_item(
-                platform='Shopify',
-                item_name_in_order=line['name'],
-                price=Decimal(str(line['price'])),
-                qty=Decimal(line['quantity']),
-                discount=discount,
-                logger=logger,
-                application_path=application_path
-            )
-        )
-    quickbooks.create_qb_estimate(
-        platform='Shopify',
-        customer_name_in_order=(order['customer']['first_name'] + ' ' + order['customer']['last_name']).strip(),
-        line_items=lineItems,
-        order_number=order['id'],
-        logger=logger,
-        application_path=application_path
-    )
 
-for order in orders['rekki']:
-    lineItems = []
-    for line in order['items']:
-        lineItems.append(
-            quickbooks.prepare_qb_line_item(
-                platform='Rekki',
-                item_name_in_order=line['name'],
-                price=Decimal(str(line['price']) + '.' + str(line['price_cents'])),
-                qty=Decimal(line['quantity']),
-                discount=Decimal("0"),
-                logger=logger,
-                application_path=application_path
-            )
+def sync_tenant(tenant: str, logger: getLogger, application_path: str, local_time: datetime.datetime) -> None:
+    with tenants.use(tenant):
+        sync(
+            logger=logger,
+            application_path=tenants.get_application_path(application_path, tenant),
+            local_time=local_time
         )
-    quickbooks.create_qb_estimate(
-        platform='Rekki',
-        customer_name_in_order=order['contact_name'],
-        line_items=lineItems,
-        order_number=order['reference'],
-        logger=logger,
-        application_path=application_path
-    )
 
-for order in orders['marketman']:
-    lineItems = []
-    for line in order['Items']:
-        lineItems.append(
-            quickbooks.prepare_qb_line_item(
-                platform='Marketman',
-                item_name_in_order=line['ItemName'],
-                price=Decimal(str(line['Price'])),
-                qty=Decimal(line['Quantity']),
-                discount=Decimal("0"),
-                logger=logger,
-                application_path=application_path
-            )
-        )
-    quickbooks.create_qb_estimate(
-        platform='Marketman',
-        customer_name_in_order=order['BuyerName'],
-        line_items=lineItems,
-        order_number=order['OrderNumber'],
-        logger=logger,
-        application_path=application_path
+
+def run(logger: getLogger, application_path: str, local_time: datetime.datetime) -> None:
+    names = tenants.get_tenants()
+    if not names:
+        sync(logger=logger, application_path=application_path, local_time=local_time)
+    else:
+        # Every tenant at the same time, sharing the connections. Each QuickBooks company has its own rate limit and pool
+        with ThreadPoolExecutor(max_workers=len(names), thread_name_prefix='tenant') as executor:
+            futures = {
+                name: executor.submit(sync_tenant, name, logger, application_path, local_time) for name in names
+            }
+        for name, future in futures.items():
+            try:
+                future.result()
+            except:
+                logger.error(f'Tenant {name} failed:')
+                logger.error(traceback.format_exc())
+
+    logging_module.write_metrics(application_path=application_path, logger=logger)
+
+
+if __name__ == '__main__':
+    applicationPath = os.path.abspath(os.path.dirname(__file__))
+    localTime = get_local_time()
+    run(
+        logger=logging_module.get_logger(application_path=applicationPath, local_time=localTime),
+        application_path=applicationPath,
+        local_time=localTime
     )
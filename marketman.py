@@ -1,57 +1,136 @@
 import datetime
-from typing import List, Dict
+from typing import List, Dict, Iterator
+from decimal import Decimal
 from logging import getLogger
-import json, os, traceback
+import json, re, traceback
 from dateutil import tz
 
-import requests
+from tenants import config
+import http_client
+import state
+from order_model import Order, LineItem
 
-import config
 
+TOKEN_LIFETIME = datetime.timedelta(minutes=50)  # When GetToken doesn't say when the token expires
+TOKEN_MARGIN = datetime.timedelta(minutes=2)  # Get a new token this long before the old one expires
+TIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+SENT_TIME_OVERLAP = datetime.timedelta(minutes=10)  # Orders saved late or with a skewed clock fall into the next window
+FIRST_RUN_LOOKBACK = datetime.timedelta(days=1)  # The window of the first run without a saved high-water mark
+READ_CHUNK_SIZE = 64 * 1024
 
-def get_orders(logger: getLogger, application_path: str, local_time: datetime.datetime) -> List:
-    # API reference https://api-doc.marketman.com/?version=latest#3ade36ea-af67-4dc0-842b-eca56311d1e0
-    orders = []
-    try:
-        variables = json.load(open(os.path.join(application_path, 'variables.txt'), 'r'))
-        
-        # Get the token first
-        url = "https://api.marketman.com/v3/buyers/auth/GetToken"
+
+def get_api_url() -> str:
+    return http_client.base_url('marketman', 'https://api.marketman.com')
+
+
+def get_token(application_path: str, renew: bool = False) -> str:
+    # The token is kept in the state database until it expires, so every run and process reuses it
+    cursor = state.get_cursor(application_path, 'marketman')
+    if (renew or 'token' not in cursor
+            or datetime.datetime.utcnow() > datetime.datetime.fromisoformat(cursor['token expires']) - TOKEN_MARGIN):
+        url = get_api_url() + "/v3/buyers/auth/GetToken"
         payload = {
             "APIKey": f"{config.marketman_api_key}",
             "APIPassword": f"{config.marketman_api_password}"
         }
-        response = requests.post(url, json=payload)
+        response = http_client.post(url, json=payload)
         response.raise_for_status()
-        access_token = response.json()['Token']
+        cursor['token'] = response.json()['Token']
+        try:
+            expires = datetime.datetime.strptime(response.json()['ExpireDateUTC'], TIME_FORMAT)
+        except (KeyError, TypeError, ValueError):
+            expires = datetime.datetime.utcnow() + TOKEN_LIFETIME
+        cursor['token expires'] = expires.isoformat()
+        state.save(application_path, 'marketman', cursor=cursor)
+    return cursor['token']
+
+
+def _iter_json_array(response, key: str) -> Iterator[Dict]:
+    # Decodes the objects of the response's top-level array `key` one by one while the body downloads,
+    # instead of building the whole document first
+    decoder = json.JSONDecoder()
+    response.encoding = response.encoding or 'utf-8'
+    chunks = response.iter_content(chunk_size=READ_CHUNK_SIZE, decode_unicode=True)
+    buffer = ''
+    position = None  # In the buffer, inside the array; None until the array is found
+    for chunk in chunks:
+        buffer += chunk
+        if position is None:
+            match = re.search(r'"' + key + r'"\s*:\s*\[', buffer)
+            if not match:
+                continue
+            position = match.end()
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if buffer[position:position + 1] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                break  # The object continues in the next chunk
+            yield item
+            position = end
+        buffer = buffer[position:]
+        position = 0
+    if position is None:
+        raise ValueError(f'No {key} in the response')
+
+
+def _request_orders(application_path: str, payload: Dict):
+    url = get_api_url() + "/v3/vendors/orders/GetOrdersBySentDate"
+    for renew in (False, True):
+        headers = {
+            'AUTH_TOKEN': f'{get_token(application_path, renew=renew)}'
+        }
+        response = http_client.post(url, headers=headers, json=payload, stream=True)
+        # A token revoked before its expiry gets one renewal
+        if response.status_code != 401:
+            break
+        response.close()
+    response.raise_for_status()
+    return response
+
 
-        # Get the orders since the last order time
+def get_orders(logger: getLogger, application_path: str, local_time: datetime.datetime) -> List[Order]:
+    # API reference https://api-doc.marketman.com/?version=latest#3ade36ea-af67-4dc0-842b-eca56311d1e0
+    orders = []
+    try:
+        # Get the orders sent since the high-water mark of the previous run, a little overlap is removed below
         # todo Obtain the API credentials and try to look into vendors and buyers orders, save the vendors/buyers ID
-        
-        url = "https://api.marketman.com/v3/vendors/orders/GetOrdersByDeliveryDate"
+        cursor = state.get_cursor(application_path, 'marketman')
+        now = datetime.datetime.utcnow()
+        if 'last sent time' in cursor:
+            since = datetime.datetime.strptime(cursor['last sent time'], TIME_FORMAT) - SENT_TIME_OVERLAP
+        else:
+            since = now - FIRST_RUN_LOOKBACK
         payload = {
-            "DateTimeFromUTC": local_time.strftime('%Y/%m/%d 00:00:00'),
+            "DateTimeFromUTC": since.strftime(TIME_FORMAT),
+            "DateTimeToUTC": now.strftime(TIME_FORMAT),
             "VendorGuid": config.marketman_vendor_guid
         }
-        headers = {
-            'AUTH_TOKEN': f'{access_token}'
-        }
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
+        response = _request_orders(application_path, payload)
+
+        # Remove orders that may duplicate from the previous windows, the seen orders are kept for the whole retention
+        # period, longer than any delivery window
+        order_ids = set()
+        with response:
+            for order in _iter_json_array(response, 'Orders'):
+                if order['OrderNumber'] not in order_ids and \
+                        not state.is_seen(application_path, 'marketman', order['OrderNumber']):
+                    orders.append(order)
+                    order_ids.add(order['OrderNumber'])
+        orders = normalize_orders(orders, logger=logger)
 
-        # Remove orders that may duplicate from the last call
-        orderIds = []
-        for order in response.json()['Orders']:
-            if order['OrderNumber'] not in variables['marketman']['last orders']:
-                orders.append(order)
-                orderIds.append(order['OrderNumber'])
-        variables['marketman']['last orders'] = orderIds
-        json.dump(variables, open(os.path.join(application_path, 'variables.txt'), 'w'))
+        cursor = state.get_cursor(application_path, 'marketman')  # With the token get_token() may have saved
+        cursor['last sent time'] = payload['DateTimeToUTC']
+        state.save(application_path, 'marketman', cursor=cursor, seen_order_ids=order_ids, orders=orders)
 
         logger.info(f'Marketman returned {str(len(orders))} orders')
     except:
         logger.error(f'Could n\'t get orders from Marketman:')
         logger.error(traceback.format_exc())
+        orders = []
 
     return orders
 
@@ -60,3 +139,29 @@ def get_delivery_dt(order: Dict) -> datetime.datetime:
     return (datetime.datetime.strptime(order['DeliveryDateUTC'], '%Y-%m-%d')
             .replace(tzinfo=tz.gettz('UTC'))
             .astimezone(tz.gettz('America/Toronto')))
+
+
+def normalize_orders(orders: List[Dict], logger: getLogger) -> List[Order]:
+    normalized = []
+    for order in orders:
+        try:
+            normalized.append(Order(
+                platform='Marketman',
+                order_id=order['OrderNumber'],
+                customer=order['BuyerName'],
+                qb_customer=order['BuyerName'],
+                # Convert Marketman UTC timestamp string to local time datetime object
+                delivery_dt=get_delivery_dt(order),
+                notes=order['Comments'],
+                lines=tuple(
+                    LineItem(
+                        name=line['ItemName'],
+                        quantity=line['Quantity'],
+                        price=Decimal(str(line['Price']))
+                    ) for line in order['Items']
+                )
+            ))
+        except:
+            logger.error(f'Marketman order {order.get("OrderNumber")} couldn\'t be read and was skipped:')
+            logger.error(traceback.format_exc())
+    return normalized
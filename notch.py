@@ -1,85 +1,355 @@
-from typing import List, Dict, Tuple
+from typing import Iterator, List, Dict, Tuple, Union
 from logging import getLogger
-import json, os, traceback, imaplib, email, datetime
+from concurrent.futures import ThreadPoolExecutor
+from dateutil import tz
+from urllib.parse import urlparse
+import traceback, imaplib, email, datetime, time, base64, quopri
 
-import config
+from tenants import config
+import google_sheets
+import http_client
+import state
+import tenants
+from logging_module import metrics
+from order_model import Order, LineItem
 
+FETCH_BATCH_SIZE = 200  # UIDs per FETCH command, the server streams the whole batch back in one response
+LOOKBACK_DAYS = 14  # How far back the first run without a saved UID looks
+# IMAP connections of a backfill, Gmail allows 15 per account
+DEFAULT_BACKFILL_CONNECTIONS = 4
+# The fields of a notification in their order, each with the text that ends its value
+_FIELDS = (('Order ID:', '\n'), ('Delivery day:', '\n'), ('Made by:', '\n'), ('View order details', 'Don'))
 
-def get_orders(logger: getLogger, application_path: str) -> List:
+
+class _ByteCounter:
+    # Counts the bytes received from the server to measure how much the fetch downloads, and records every command
+    # with its response status and time in the run metrics
+    bytes_received = 0
+
+    def _simple_command(self, name, *args):
+        start = time.monotonic()
+        status = 'error'
+        try:
+            result = super()._simple_command(name, *args)
+            status = result[0]
+            return result
+        finally:
+            metrics.observe_call(self.host, status, time.monotonic() - start)
+
+    def read(self, size):
+        data = super().read(size)
+        self.bytes_received += len(data)
+        return data
+
+    def readline(self):
+        line = super().readline()
+        self.bytes_received += len(line)
+        return line
+
+
+class _IMAP4(_ByteCounter, imaplib.IMAP4):
+    pass
+
+
+class _IMAP4SSL(_ByteCounter, imaplib.IMAP4_SSL):
+    pass
+
+
+def _connect() -> imaplib.IMAP4:
+    # imaps:// for IMAP over SSL, imap:// without it
+    url = urlparse(http_client.base_url('notch', 'imaps://imap.gmail.com'))
+    if url.scheme == 'imaps':
+        mail = _IMAP4SSL(url.hostname, url.port or 993)
+    else:
+        mail = _IMAP4(url.hostname, url.port or 143)
+    mail.login(config.notch_gmail_address, config.notch_gmail_password)
+    return mail
+
+
+def _parse_imap(data: bytes, position: int = 0) -> Tuple[List, int]:
+    # Parses IMAP response data into nested lists of atoms, strings and literals
+    items = []
+    while position < len(data):
+        char = data[position:position + 1]
+        if char in b' \r\n':
+            position += 1
+        elif char == b'(':
+            nested, position = _parse_imap(data, position + 1)
+            items.append(nested)
+        elif char == b')':
+            return items, position + 1
+        elif char == b'"':
+            end = position + 1
+            value = bytearray()
+            while data[end:end + 1] != b'"':
+                if data[end:end + 1] == b'\\':
+                    end += 1
+                value += data[end:end + 1]
+                end += 1
+            items.append(bytes(value))
+            position = end + 1
+        elif char == b'{':
+            end = data.index(b'}', position)
+            size = int(data[position + 1:end])
+            start = data.index(b'\n', end) + 1
+            items.append(data[start:start + size])
+            position = start + size
+        else:
+            end = position
+            while end < len(data) and data[end:end + 1] not in b' ()\r\n':
+                if data[end:end + 1] == b'[':  # BODY[HEADER.FIELDS (SUBJECT)] is a single atom
+                    end = data.index(b']', end)
+                end += 1
+            atom = data[position:end]
+            items.append(None if atom.upper() == b'NIL' else atom)
+            position = end
+    return items, position
+
+
+def _fetch(mail: imaplib.IMAP4, uids: List[bytes], items: str) -> Dict[int, Dict[str, Union[bytes, List]]]:
+    # Returns {uid: {item name: value}} for one UID FETCH command
+    status, data = mail.uid('fetch', b','.join(uids), items)
+    stream = b''
+    for part in data:
+        if isinstance(part, tuple):
+            stream += part[0] + b'\r\n' + part[1]
+        elif part:
+            stream += part + b'\r\n'
+    parsed, position = _parse_imap(stream)
+    messages = {}
+    for attributes in parsed:
+        if isinstance(attributes, list):
+            values = dict(zip((str(key, 'utf-8').upper() for key in attributes[::2]), attributes[1::2]))
+            messages[int(values['UID'])] = values
+    return messages
+
+
+def _find_text_part(structure: List, prefix: str = '') -> Union[Tuple[str, bytes, str], None]:
+    # Walks BODYSTRUCTURE and returns the section number, transfer encoding and charset of the text/plain part
+    if structure and isinstance(structure[0], list):
+        # A multipart body lists its parts first, then the subtype and extension data
+        for number, part in enumerate(structure, start=1):
+            if not isinstance(part, list):
+                break
+            found = _find_text_part(part, prefix + str(number) + '.')
+            if found:
+                return found
+        return None
+    if (structure[0] or b'').upper() == b'TEXT' and (structure[1] or b'').upper() == b'PLAIN':
+        parameters = dict(zip((key.lower() for key in structure[2][::2]), structure[2][1::2])) if structure[2] else {}
+        charset = str(parameters.get(b'charset', b'utf-8'), 'ascii')
+        return (prefix or '1.').rstrip('.'), (structure[5] or b'7BIT').upper(), charset
+    return None
+
+
+def _decode(payload: bytes, encoding: bytes, charset: str) -> str:
+    if encoding == b'QUOTED-PRINTABLE':
+        payload = quopri.decodestring(payload)
+    elif encoding == b'BASE64':
+        payload = base64.b64decode(payload)
+    return payload.decode(charset, errors='replace')
+
+
+def _extract(body: str) -> Union[Dict[str, str], None]:
+    # One pass over the body: every field is looked for after the previous one, in the order Notch writes them,
+    # and only the values are copied out. A field missing from its place is looked for from the start
+    fields = {}
+    position = 0
+    for label, end_mark in _FIELDS:
+        start = body.find(label, position)
+        if start < 0:
+            start = body.find(label)
+            if start < 0:
+                return None
+        start += len(label)
+        end = body.find(end_mark, start)
+        if end < 0:
+            end = len(body)
+        fields[label] = body[start:end].strip()
+        position = end
+    return fields
+
+
+def _parse_order(body: str, subject: str) -> Dict:
+    fields = _extract(body)
+    if fields:
+        return {
+            'id': fields['Order ID:'],
+            'delivery date': fields['Delivery day:'],  # format Saturday, 19 June 2021
+            'customer': fields['Made by:'],
+            'order url': fields['View order details'].strip('<>'),
+        }
+    return {
+        'id': subject.split('(#')[1].split(')')[0].strip(),
+        'delivery date': 'Monday, 1 January 1990',
+        'customer': '[ERROR] CHECK THE ORDER NOTIFICATION, IT FAILED TO PROCESS',
+        'order url': 'https://www.notchordering.com/'
+    }
+
+
+def _read_orders(
+        mail: imaplib.IMAP4, uids: List[bytes], local_time: datetime.datetime
+) -> Iterator[Tuple[List[bytes], List[Order]]]:
+    # Yields every batch of UIDs with the orders of its Notch notifications, oldest first
+    for batch_start in range(0, len(uids), FETCH_BATCH_SIZE):
+        batch = uids[batch_start:batch_start + FETCH_BATCH_SIZE]
+        # Only the structure and the subject first, then only the text part. BODY.PEEK keeps the messages unread
+        headers = _fetch(mail, batch, '(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT)])')
+        sections = {}
+        for uid, values in headers.items():
+            text_part = _find_text_part(values['BODYSTRUCTURE'])
+            if text_part:
+                sections.setdefault(text_part, []).append(str(uid).encode())
+        bodies = {}
+        for (section, encoding, charset), section_uids in sections.items():
+            for uid, values in _fetch(mail, section_uids, f'(UID BODY.PEEK[{section}])').items():
+                bodies[uid] = _decode(values[f'BODY[{section}]'] or b'', encoding, charset)
+
+        orders = []
+        for uid, values in sorted(headers.items()):
+            subject = email.message_from_bytes(values['BODY[HEADER.FIELDS (SUBJECT)]'] or b'')['subject'] or ''
+            if 'order ' in subject:
+                orders.append(normalize(_parse_order(bodies.get(uid, ''), subject), local_time))
+        yield batch, orders
+
+
+def get_orders(logger: getLogger, application_path: str, local_time: datetime.datetime) -> List[Order]:
     orders = []
     try:
-        variables = json.load(open(os.path.join(application_path, 'variables.txt'), 'r'))
-
-        # Read the emails from the last email
-        mail = imaplib.IMAP4_SSL('imap.gmail.com')
-        mail.login(config.notch_gmail_address, config.notch_gmail_password)
-        mail.select('inbox')
-
-        data = mail.search(None, 'ALL')
-        mail_ids = data[1]
-        id_list = mail_ids[0].split()
-        latest_email_id = int(id_list[-1])
-
-        i = 0
-        for emailId in range(latest_email_id, 1, -1):
-            data = mail.fetch(str(emailId), '(RFC822)')
-            for response_part in data:
-                arr = response_part[0]
-                if isinstance(arr, tuple):
-                    msg = email.message_from_string(str(arr[1], 'utf-8'))
-                    break
-            if config.notch_notifications_from_address in msg['from'] and 'order ' in msg['subject']:
-                for part in msg.walk():
-                    if part.get_content_type() == "text/plain":  # ignore attachments/html
-                        body = part.get_payload(decode=True).decode('utf-8')
-                        break
-            else:
-                continue
-            try:
-                order = {
-                    'id': body.split('Order ID:')[1].split('\n')[0].strip(),
-                    # 'order date': body.split('Order place date:')[1].split('\n')[0].strip(),  # format Friday, 18 June 2021
-                    'delivery date': body.split('Delivery day:')[1].split('\n')[0].strip(),
-                    # format Saturday, 19 June 2021
-                    'customer': body.split('Made by:')[1].split('\n')[0].strip(),
-                    'order url': body.split('View order details')[1].split('Don')[0].strip().strip('<>'),
-                    # 'shipping address': body.split('Shipping Address:')[1].split('\n')[0].strip()
-                }
-            except:
-                order = {
-                    'id': msg['subject'].split('(#')[1].split(')')[0].strip(),
-                    # 'order date': 'Monday, 1 January 1990',
-                    'delivery date': 'Monday, 1 January 1990',
-                    'customer': '[ERROR] CHECK THE ORDER NOTIFICATION, IT FAILED TO PROCESS',
-                    'order url': 'https://www.notchordering.com/'
-                    # 'shipping address': body.split('Shipping Address:')[1].split('\n')[0].strip()
-                }
-            # Stop if iterated over 5 orders from the previous imports in a row
-            if order['id'] in variables['notch']['last orders']:
-                i += 1
-                if i == 5:
-                    break
-                else:
+        cursor = state.get_cursor(application_path, 'notch')
+        start = time.monotonic()
+
+        mail = _connect()
+        mail.select('inbox', readonly=True)
+        uid_validity = int(mail.response('UIDVALIDITY')[1][0])
+
+        # Let the server find the Notch notifications that arrived after the last processed one
+        criteria = ['FROM', f'"{config.notch_notifications_from_address}"', 'SUBJECT', '"order "']
+        last_uid = cursor.get('last uid', 0)
+        if cursor.get('uid validity') != uid_validity:
+            last_uid = 0
+        if last_uid:
+            criteria = ['UID', f'{last_uid + 1}:*'] + criteria
+        else:
+            since = datetime.date.today() - datetime.timedelta(days=LOOKBACK_DAYS)
+            criteria = ['SINCE', since.strftime('%d-%b-%Y')] + criteria
+        status, data = mail.uid('search', None, *criteria)
+        # 'n:*' always matches the newest message, even if it's older than n
+        uids = [uid for uid in data[0].split() if int(uid) > last_uid]
+        order_ids = set()
+
+        for batch, batch_orders in _read_orders(mail, uids, local_time):
+            for order in batch_orders:
+                if state.is_seen(application_path, 'notch', order.order_id) or order.order_id in order_ids:
                     continue
-            i = 0
-            orders.append(order)
-            variables['notch']['last orders'] = variables['notch']['last orders'][-99:] + [
-                order['id']]  # save the last 100 order IDs
+                orders.append(order)
+                order_ids.add(order.order_id)
+
+        if uids:
+            cursor['last uid'] = max(int(uid) for uid in uids)
+        cursor['uid validity'] = uid_validity
+        logger.info(f'Notch returned {len(orders)} orders from {len(uids)} messages, '
+                    f'{mail.bytes_received} bytes in {time.monotonic() - start:.1f}s')
+        mail.logout()
 
-        json.dump(variables, open(os.path.join(application_path, 'variables.txt'), 'w'))
+        state.save(application_path, 'notch', cursor=cursor, seen_order_ids=order_ids, orders=orders)
     except:
         logger.error(f'Could n\'t get orders from Notch:')
         logger.error(traceback.format_exc())
 
+    orders.reverse()  # Newest first, as the inbox used to be read
     return orders
 
 
+def _backfill_range(
+        application_path: str, uids: List[bytes], local_time: datetime.datetime
+) -> Tuple[int, int, int]:
+    # Reads a range of UIDs over its own connection and saves the orders batch by batch. Notch orders have no
+    # estimate and the dashboard only shows the deliveries from yesterday on, so only those are queued, for Google
+    # Sheets. The older ones are only remembered as seen. Returns the orders read, the ones queued and the bytes received
+    mail = _connect()
+    try:
+        mail.select('inbox', readonly=True)
+        read = queued = 0
+        for batch, orders in _read_orders(mail, uids, local_time):
+            shown = [order for order in orders if google_sheets.is_shown(order.delivery_dt, local_time)]
+            state.save(application_path, 'notch', seen_order_ids={order.order_id for order in orders}, orders=shown,
+                       sinks=('google sheets',))
+            read += len(orders)
+            queued += len(shown)
+        return read, queued, mail.bytes_received
+    finally:
+        mail.logout()
+
+
+def backfill(
+        logger: getLogger,
+        application_path: str,
+        local_time: datetime.datetime,
+        since: datetime.date,
+        until: datetime.date = None,
+        connections: int = DEFAULT_BACKFILL_CONNECTIONS
+) -> Dict[str, int]:
+    # Reads every notification received from `since` up to `until`: their orders are remembered as seen again, e.g.
+    # after losing the state database, and the ones still to be delivered are queued for the dashboard, the orders
+    # already seen too. The UIDs are split into one range per connection, read at the same time. The cursor of
+    # get_orders() isn't touched. A batch is saved as soon as it's read and Google Sheets skips the orders it already
+    # shows, so an interrupted backfill is simply run again
+    start = time.monotonic()
+    mail = _connect()
+    mail.select('inbox', readonly=True)
+    criteria = ['SINCE', since.strftime('%d-%b-%Y')]
+    if until:
+        criteria += ['BEFORE', until.strftime('%d-%b-%Y')]
+    criteria += ['FROM', f'"{config.notch_notifications_from_address}"', 'SUBJECT', '"order "']
+    status, data = mail.uid('search', None, *criteria)
+    mail.logout()
+    uids = data[0].split()
+
+    range_size = max(-(-len(uids) // connections), 1)
+    ranges = [uids[range_start:range_start + range_size] for range_start in range(0, len(uids), range_size)]
+    results = {'messages': len(uids), 'orders': 0, 'queued': 0, 'bytes': mail.bytes_received, 'failed ranges': 0}
+    with ThreadPoolExecutor(max_workers=max(len(ranges), 1), thread_name_prefix='notch backfill') as executor:
+        futures = [tenants.submit(executor, _backfill_range, application_path, uid_range, local_time)
+                   for uid_range in ranges]
+        for uid_range, future in zip(ranges, futures):
+            try:
+                read, queued, bytes_received = future.result()
+                results['orders'] += read
+                results['queued'] += queued
+                results['bytes'] += bytes_received
+            except:
+                results['failed ranges'] += 1
+                logger.error(f'Notch backfill of UIDs {int(uid_range[0])}-{int(uid_range[-1])} failed:')
+                logger.error(traceback.format_exc())
+    metrics.count('notch backfill messages', len(uids))
+    logger.info(f'Notch backfill read {results["orders"]} orders from {len(uids)} messages over {len(ranges)} '
+                f'connections and queued {results["queued"]}, {results["bytes"]} bytes in {time.monotonic() - start:.1f}s')
+    return results
+
+
 def get_delivery_dt(order: Dict, local_dt: datetime.datetime) -> Tuple[datetime.datetime, str]:
     try:
-        delivery_date_time = datetime.datetime.strptime(order['delivery date'], '%A, %d %B %Y')
+        delivery_date_time = (datetime.datetime
+                              .strptime(order['delivery date'], '%A, %d %B %Y')
+                              .replace(tzinfo=tz.gettz('America/Toronto')))
         notes = "'"
     except:
         delivery_date_time = local_dt
         notes = '[ERROR] CHECK THE DELIVERY DATE, IT MAY BE INCORRECT'
 
-    return delivery_date_time, notes
\ No newline at end of file
+    return delivery_date_time, notes
+
+
+def normalize(order: Dict, local_dt: datetime.datetime) -> Order:
+    # Notch notifications don't list the items, the dashboard shows the order link instead
+    delivery_dt, notes = get_delivery_dt(order, local_dt)
+    return Order(
+        platform='Notch',
+        order_id=order['id'],
+        customer=order['customer'],
+        qb_customer=None,
+        delivery_dt=delivery_dt,
+        notes=notes,
+        lines=(LineItem(name=order['order url'], quantity=''),)
+    )
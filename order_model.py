@@ -0,0 +1,39 @@
+# The compact order representation every connector emits, so the sinks don't need to know platform-specific keys
+from typing import NamedTuple, Tuple, Union
+from decimal import Decimal
+import datetime, json
+
+
+class LineItem(NamedTuple):
+    name: str
+    quantity: Union[int, str]  # '' for Notch, its notifications don't list the items
+    price: Decimal = Decimal('0')
+    discount: Decimal = Decimal('0')
+    product_code: str = ''
+
+
+class Order(NamedTuple):
+    platform: str  # As shown in the dashboard: 'Shopify', 'Rekki', 'Marketman', 'Notch'
+    order_id: Union[str, int]
+    customer: str  # The name shown in the dashboard and the key of the customer rank table
+    qb_customer: Union[str, None]  # The customer's name in QuickBooks, None if no estimate is created
+    delivery_dt: datetime.datetime
+    notes: str
+    lines: Tuple[LineItem, ...]
+
+
+def to_json(order: Order) -> str:
+    # For the job queue of the state database: the amounts as strings, the delivery time with its UTC offset
+    return json.dumps(order._replace(
+        delivery_dt=order.delivery_dt.isoformat(),
+        lines=[line._replace(price=str(line.price), discount=str(line.discount)) for line in order.lines]
+    ))
+
+
+def from_json(text: str) -> Order:
+    order = Order(*json.loads(text))
+    return order._replace(
+        delivery_dt=datetime.datetime.fromisoformat(order.delivery_dt),
+        lines=tuple(LineItem(name, quantity, Decimal(price), Decimal(discount), product_code)
+                    for name, quantity, price, discount, product_code in order.lines)
+    )
@@ -0,0 +1,43 @@
+from typing import Any, Callable, Dict, Iterable, Tuple
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+import traceback
+
+import tenants
+from logging_module import metrics
+from order_model import Order
+
+
+def apply(jobs: Iterable[Tuple[int, Order]], sink: Callable[[Order], None], logger: getLogger) -> Dict[int, str]:
+    # Hands the order of every job to the sink. A sink failing on one order doesn't stop the others, the errors are
+    # returned by job ID so only those jobs are retried
+    errors = {}
+    count = 0
+    for job_id, order in jobs:
+        try:
+            with metrics.stage(f'sink {getattr(sink, "__name__", sink)}'):
+                sink(order)
+        except Exception as error:
+            errors[job_id] = f'{type(error).__name__}: {error}'
+            logger.error(f'Order {order.order_id} from {order.platform} failed in {getattr(sink, "__name__", sink)}:')
+            logger.error(traceback.format_exc())
+        count += 1
+    metrics.count('orders processed', count)
+    return errors
+
+
+def run_outputs(outputs: Dict[str, Callable[[], Any]], logger: getLogger) -> Dict[str, Any]:
+    # Runs the outputs at the same time, each in its own thread. They don't depend on each other, so a failing one is
+    # logged and the others still finish. Returns the result of every output, None for the failed ones
+    with ThreadPoolExecutor(max_workers=max(len(outputs), 1), thread_name_prefix='output') as executor:
+        futures = {name: tenants.submit(executor, output) for name, output in outputs.items()}
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except:
+            results[name] = None
+            metrics.count('outputs failed')
+            logger.error(f'{name} failed:')
+            logger.error(traceback.format_exc())
+    return results
@@ -0,0 +1,88 @@
+from typing import Dict, Union
+import base64, datetime, threading
+
+from tenants import config
+import http_client
+import state
+
+OAUTH_URL = 'https://oauth.platform.intuit.com'
+# Refresh this long before 'best before' so a token never expires in the middle of a batch of requests
+REFRESH_MARGIN = datetime.timedelta(seconds=60)
+
+
+class TokenManager:
+    """Keeps the QuickBooks access token in memory and refreshes it once, shortly before it expires.
+
+    The token is stored as the 'quickbooks' cursor of the state database, the same place the Flask app
+    in 'QB authorization.py' writes it after a new authorization, and it's re-read when its version changes.
+    """
+
+    def __init__(self, application_path: str):
+        self.application_path = application_path
+        self.refreshes = 0
+        self.cache_hits = 0
+        self._lock = threading.Lock()
+        self._token = None
+        self._version = None
+
+    def _load(self) -> None:
+        version = state.get_cursor_version(self.application_path, 'quickbooks')
+        if version != self._version:
+            self._token = state.get_cursor(self.application_path, 'quickbooks')
+            self._version = version
+
+    def _refresh(self, token: Dict) -> Union[Dict, None]:
+        # Runs in the write transaction of state.update_cursor(), so the processes sharing the state database send one
+        # refresh between them. None when another one refreshed the token while this one waited
+        if not self._expired(token):
+            return None
+        # Authorization API reference:
+        # https://developer.intuit.com/app/developer/qbo/docs/develop/authentication-and-authorization/faq
+        url = http_client.base_url('quickbooks oauth', OAUTH_URL) + '/oauth2/v1/tokens/bearer'
+        headers = {
+            'Accept': 'application/json',
+            'content-type': 'application/x-www-form-urlencoded',
+            'Authorization': 'Basic ' + str(base64.b64encode((config.qb_id + ':' + config.qb_secret).encode("utf-8")), "utf-8")
+        }
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': token['refresh token']
+        }
+        response = http_client.post(url, headers=headers, data=data)
+        response.raise_for_status()
+        token = dict(token)
+        token['access token'] = response.json()['access_token']
+        token['refresh token'] = response.json()['refresh_token']
+        # Add almost an hour to account for slow requests speed:
+        token['best before'] = (datetime.datetime.utcnow() + datetime.timedelta(seconds=3300)).isoformat()
+        self.refreshes += 1
+        return token
+
+    @staticmethod
+    def _expired(token: Dict) -> bool:
+        return datetime.datetime.utcnow() > datetime.datetime.fromisoformat(token['best before']) - REFRESH_MARGIN
+
+    def get_access_token(self) -> str:
+        # The lock makes concurrent callers wait for a single refresh instead of each sending its own
+        with self._lock:
+            self._load()
+            if self._expired(self._token):
+                # Saved immediately, in the same transaction that checked it's still due
+                self._token, self._version = state.update_cursor(self.application_path, 'quickbooks', self._refresh)
+            else:
+                self.cache_hits += 1
+            return self._token['access token']
+
+    def stats(self) -> Dict[str, int]:
+        return {'refreshes': self.refreshes, 'cache hits': self.cache_hits}
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_token_manager(application_path: str) -> TokenManager:
+    with _managers_lock:
+        if application_path not in _managers:
+            _managers[application_path] = TokenManager(application_path)
+        return _managers[application_path]
@@ -1,42 +1,167 @@
 import datetime
-from typing import List, Dict, Union, Tuple, Any
+from typing import Any, Callable, List, Dict, Union, Tuple
 from logging import getLogger
 from decimal import Decimal
-import json, os, traceback, base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib, json, os, tempfile, traceback, threading, time, uuid
 
-import requests
+from tenants import config
+import http_client
+import qb_tokens
+import state
+import tenants
+from logging_module import metrics
+from order_model import Order
 
-import config
+
+def get_qb_url(endpoint: str) -> str:
+    base_url = http_client.base_url('quickbooks', 'https://quickbooks.api.intuit.com')
+    return f'{base_url}/v3/company/{config.qb_company_id}/{endpoint}'
 
 
 def get_qb_headers(application_path: str) -> Dict[str, str]:
-    # Authorization API reference:
-    # https://developer.intuit.com/app/developer/qbo/docs/develop/authentication-and-authorization/faq
-    variables = json.load(open(os.path.join(application_path, 'variables.txt'), 'r'))
-
-    # This function updates the access token if it expired and then returns it
-    if datetime.datetime.utcnow() > datetime.datetime.fromisoformat(variables['quickbooks']['best before']):
-        url = 'https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer'
-        headers = {
-            'Accept': 'application/json',
-            'content-type': 'application/x-www-form-urlencoded',
-            'Authorization': 'Basic ' + str(base64.b64encode((config.qb_id + ':' + config.qb_secret).encode("utf-8")), "utf-8")
-        }
-        data = {
-            'grant_type': 'refresh_token',
-            'refresh_token': variables['quickbooks']['refresh token']
-        }
-        response = requests.post(url, headers=headers, data=data)
-        variables['quickbooks']['access token'] = response.json()['access_token']
-        variables['quickbooks']['refresh token'] = response.json()['refresh_token']
-        # Add almost an hour to account for slow requests speed:
-        variables['quickbooks']['best before'] = (datetime.datetime.utcnow() + datetime.timedelta(seconds=3300)).isoformat()
+    access_token = qb_tokens.get_token_manager(application_path).get_access_token()
+    return {
+        'Authorization': 'Bearer ' + access_token
+    }
 
-        json.dump(variables, open(os.path.join(application_path, 'variables.txt'), 'w'))  # Save them immediately
 
-    return {
-        'Authorization': 'Bearer ' + variables['quickbooks']['access token']
+# The field that get_qb_obj() matches and the fields kept in the local index per table
+INDEX_TABLES = {
+    'Item': ('Name', ['Id', 'Name']),
+    'Customer': ('DisplayName', ['Id', 'DisplayName'])
+}
+INDEX_FILE = 'quickbooks index.json'
+INDEX_PAGE_SIZE = 1000  # The maximum QuickBooks allows per query
+INDEX_REFRESH_SECONDS = 300  # How often a long-running process asks the CDC endpoint for changes
+CDC_MAX_AGE = datetime.timedelta(days=30)  # QuickBooks doesn't return changes older than 30 days
+BATCH_SIZE = 30  # The maximum number of operations in one /batch request
+BATCH_ATTEMPTS = 3
+BATCH_RETRY_DELAY = 2  # Seconds, multiplied by the attempt number
+# QuickBooks answers 429 to more than 10 requests in flight per company, config.qb_max_concurrent_requests overrides it
+MAX_CONCURRENT_REQUESTS = 10
+STALE_OBJECT_ERROR = '5010'  # The SyncToken of an update is older than the object's
+
+_index = {}
+_index_locks = {}  # {application path: lock}, a tenant's refresh doesn't wait for the other tenants' ones
+_index_locks_lock = threading.Lock()
+_executors = {}  # {company ID: pool}
+_executors_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    # One pool per company for the whole process, so the tenants of a company together stay under its limit and the
+    # tenants of different companies don't wait for each other
+    with _executors_lock:
+        if config.qb_company_id not in _executors:
+            _executors[config.qb_company_id] = ThreadPoolExecutor(
+                max_workers=getattr(config, 'qb_max_concurrent_requests', MAX_CONCURRENT_REQUESTS),
+                thread_name_prefix=f'quickbooks {config.qb_company_id}'
+            )
+        return _executors[config.qb_company_id]
+
+
+def _qb_query(sql_statement: str, application_path: str) -> Dict:
+    url = get_qb_url('query')
+    params = {'query': sql_statement, 'minorversion': 62}
+    response = http_client.get(url, params=params, headers=get_qb_headers(application_path=application_path),
+                               limit_key=config.qb_company_id)
+    response.raise_for_status()
+    return response.json()['QueryResponse']
+
+
+def _load_full_index(application_path: str) -> Dict:
+    # Page through every active object, 1000 per request
+    index = {'refreshed at': datetime.datetime.utcnow().replace(microsecond=0).isoformat()}
+    for table, (key_field, fields) in INDEX_TABLES.items():
+        objects = {}
+        position = 1
+        while True:
+            page = _qb_query(
+                f"select {', '.join(fields)} from {table} "
+                f"STARTPOSITION {position} MAXRESULTS {INDEX_PAGE_SIZE}",
+                application_path=application_path
+            ).get(table, [])
+            for obj in page:
+                objects[obj['Id']] = {field: obj.get(field) for field in fields}
+            if len(page) < INDEX_PAGE_SIZE:
+                break
+            position += INDEX_PAGE_SIZE
+        index[table] = objects
+    return index
+
+
+def _apply_cdc(index: Dict, application_path: str) -> bool:
+    # Change data capture API reference:
+    # https://developer.intuit.com/app/developer/qbo/docs/api/accounting/all-entities/changedatacapture
+    refreshed_at = datetime.datetime.utcnow().replace(microsecond=0)
+    url = get_qb_url('cdc')
+    params = {
+        'entities': ','.join(INDEX_TABLES),
+        'changedSince': index['refreshed at'] + '-00:00',
+        'minorversion': 62
     }
+    response = http_client.get(url, params=params, headers=get_qb_headers(application_path=application_path),
+                               limit_key=config.qb_company_id)
+    response.raise_for_status()
+
+    for query_response in response.json()['CDCResponse'][0]['QueryResponse']:
+        for table, (key_field, fields) in INDEX_TABLES.items():
+            changed = query_response.get(table, [])
+            if len(changed) >= INDEX_PAGE_SIZE:
+                return False  # CDC returns at most 1000 objects per table, reload everything instead
+            for obj in changed:
+                # Deleted and deactivated objects aren't returned by the regular query either
+                if obj.get('status') == 'Deleted' or not obj.get('Active', True):
+                    index[table].pop(obj['Id'], None)
+                else:
+                    index[table][obj['Id']] = {field: obj.get(field) for field in fields}
+
+    index['refreshed at'] = refreshed_at.isoformat()
+    return True
+
+
+def _build_lookup(index: Dict) -> Dict:
+    lookup = {}
+    for table, (key_field, fields) in INDEX_TABLES.items():
+        lookup[table] = {obj[key_field]: obj for obj in index[table].values()}
+    return lookup
+
+
+def _get_index_lock(application_path: str) -> threading.Lock:
+    with _index_locks_lock:
+        return _index_locks.setdefault(application_path, threading.Lock())
+
+
+def get_qb_index(application_path: str) -> Dict:
+    # Returns {table: {matched name: object}}, loaded from disk and brought up to date with the CDC endpoint
+    with _get_index_lock(application_path):
+        cached = _index.get(application_path)
+        if cached and time.monotonic() - cached['checked'] < INDEX_REFRESH_SECONDS:
+            return cached['lookup']
+
+        if cached:
+            index = cached['index']
+        else:
+            try:
+                with open(os.path.join(application_path, INDEX_FILE), 'r') as file:
+                    index = json.load(file)
+            except (FileNotFoundError, ValueError):
+                index = None
+
+        with metrics.stage('quickbooks index'):
+            if (not index
+                    or datetime.datetime.fromisoformat(index['refreshed at']) < datetime.datetime.utcnow() - CDC_MAX_AGE
+                    or not _apply_cdc(index, application_path=application_path)):
+                index = _load_full_index(application_path=application_path)
+
+        # A temporary file of its own, the worker.py processes may rewrite the index at the same time
+        with tempfile.NamedTemporaryFile('w', dir=application_path, suffix='.tmp', delete=False) as file:
+            json.dump(index, file)
+        os.replace(file.name, os.path.join(application_path, INDEX_FILE))
+
+        _index[application_path] = {'index': index, 'lookup': _build_lookup(index), 'checked': time.monotonic()}
+        return _index[application_path]['lookup']
 
 
 def get_qb_obj(
@@ -46,19 +171,12 @@ def get_qb_obj(
         name_key: str,
         application_path: str
 ) -> Union[Tuple[None, None], Tuple[str, str]]:
-    sql_statement = f"select * from {table} Where DisplayName = '{search_value}'"
-    url = 'https://quickbooks.api.intuit.com/v3/company/' + \
-          config.qb_company_id + \
-          '/query?query=' + \
-          sql_statement + \
-          '&minorversion=62'
-    response = requests.get(url, headers=get_qb_headers(application_path=application_path))
-    response.raise_for_status()
-    if not response.json()['QueryResponse'][table]:
+    obj = get_qb_index(application_path=application_path)[table].get(search_value)
+    metrics.count(f'quickbooks {table.lower()} lookups')
+    if not obj:
+        metrics.count(f'quickbooks {table.lower()} misses')
         return None, None
-    obj_id = response.json()['QueryResponse'][table][0][id_key]
-    obj_name = response.json()['QueryResponse'][table][0][name_key]
-    return obj_id, obj_name
+    return obj[id_key], obj[name_key]
 
 
 def prepare_qb_line_item(
@@ -87,7 +205,7 @@ def prepare_qb_line_item(
         "DetailType": "SalesItemLineDetail",
         "Amount": float(price * qty),
         "SalesItemLineDetail": {
-            "DiscountAmt": discount,
+            "DiscountAmt": float(discount),
             "ItemRef": {
                 "name": item_name,
                 "value": str(item_id)
@@ -98,14 +216,14 @@ def prepare_qb_line_item(
     }
 
 
-def create_qb_estimate(
+def build_qb_estimate(
         platform: str,
         customer_name_in_order: str,
         line_items: List,
         order_number: str,
         logger: getLogger,
         application_path: str
-) -> Any:
+) -> Union[Dict, None]:
     # Estimate API reference: https://developer.intuit.com/app/developer/qbo/docs/api/accounting/all-entities/estimate
     if None in line_items:
         return None
@@ -122,17 +240,260 @@ def create_qb_estimate(
                      f'Estimate was not created')
         return None
 
-    data = {
-        "CustomerRef": {
-            "name": customer_name,
-            "value": str(customer_id)
-        },
-        "Line": line_items
+    return {
+        'platform': platform,
+        'order number': order_number,
+        'estimate': {
+            "CustomerRef": {
+                "name": customer_name,
+                "value": str(customer_id)
+            },
+            "Line": line_items
+        }
     }
-    url = f"https://quickbooks.api.intuit.com/v3/company/{config.qb_company_id}/estimate"
-    response = requests.post(url, headers=get_qb_headers(application_path=application_path), json=data)
+
+
+def create_qb_estimate(
+        platform: str,
+        customer_name_in_order: str,
+        line_items: List,
+        order_number: str,
+        logger: getLogger,
+        application_path: str
+) -> Any:
+    # Posts a single estimate, create_qb_estimates() does the same for many orders in batches
+    pending = build_qb_estimate(
+        platform=platform,
+        customer_name_in_order=customer_name_in_order,
+        line_items=line_items,
+        order_number=order_number,
+        logger=logger,
+        application_path=application_path
+    )
+    if not pending:
+        return None
+
+    # The requestid makes a retry after 429 or 503 return the first response instead of creating a second estimate
+    response = http_client.post(
+        get_qb_url('estimate'),
+        limit_key=config.qb_company_id,
+        params={'requestid': uuid.uuid4().hex},
+        headers=get_qb_headers(application_path=application_path),
+        json=pending['estimate']
+    )
     try:
         response.raise_for_status()
     except:
         logger.error(f"Estimate for order {order_number} from {platform} wasn\'t creted in QuickBooks:")
-        logger.error(traceback.format_exc())
\ No newline at end of file
+        logger.error(traceback.format_exc())
+
+
+def order_hash(order: Order) -> str:
+    # What the estimate is made of: the QuickBooks customer and the lines, other changes don't concern QuickBooks
+    content = [order.qb_customer, [[line.name, str(line.quantity), str(line.price), str(line.discount)]
+                                   for line in order.lines]]
+    return hashlib.sha256(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+def build_order_estimate(order: Order, logger: getLogger, application_path: str) -> Union[Dict, None]:
+    # The estimate for a normalized order, None if the order has no QuickBooks customer, something wasn't found or
+    # the ledger shows an estimate made from the same content. A changed order becomes a sparse update of its estimate
+    if order.qb_customer is None:
+        return None
+    content_hash = order_hash(order)
+    recorded = state.get_estimate(application_path, order.platform, order.order_id)
+    if recorded and recorded['hash'] == content_hash:
+        metrics.count('estimates unchanged')
+        return None
+
+    line_items = [
+        prepare_qb_line_item(
+            platform=order.platform,
+            item_name_in_order=line.name,
+            price=line.price,
+            qty=Decimal(line.quantity),
+            discount=line.discount,
+            logger=logger,
+            application_path=application_path
+        ) for line in order.lines
+    ]
+    estimate = build_qb_estimate(
+        platform=order.platform,
+        customer_name_in_order=order.qb_customer,
+        line_items=line_items,
+        order_number=order.order_id,
+        logger=logger,
+        application_path=application_path
+    )
+    if estimate is None:
+        return None
+    estimate['hash'] = content_hash
+    if recorded:
+        # Only the customer and the lines are replaced, the rest of the estimate stays as someone may have edited it.
+        # An edit in QuickBooks makes the recorded SyncToken stale, _create_qb_estimates() then reads the current one
+        estimate['estimate id'] = recorded['estimate id']
+        estimate['estimate'].update({'Id': recorded['estimate id'], 'SyncToken': recorded['sync token'], 'sparse': True})
+    return estimate
+
+
+def _post_qb_batch(pending: List[Dict], request_id: str, application_path: str) -> List[Dict]:
+    # Batch API reference: https://developer.intuit.com/app/developer/qbo/docs/api/accounting/all-entities/batch
+    data = {
+        'BatchItemRequest': [
+            {'bId': item['batch item'], 'operation': 'update' if 'estimate id' in item else 'create',
+             'Estimate': item['estimate']}
+            for item in pending
+        ]
+    }
+    response = http_client.post(
+        get_qb_url('batch'),
+        limit_key=config.qb_company_id,
+        params={'minorversion': 62, 'requestid': request_id},
+        headers=get_qb_headers(application_path=application_path),
+        json=data
+    )
+    response.raise_for_status()
+    return response.json()['BatchItemResponse']
+
+
+def _get_sync_token(estimate_id: str, application_path: str) -> str:
+    response = http_client.get(
+        get_qb_url(f'estimate/{estimate_id}'),
+        params={'minorversion': 62},
+        headers=get_qb_headers(application_path=application_path),
+        limit_key=config.qb_company_id
+    )
+    response.raise_for_status()
+    return response.json()['Estimate']['SyncToken']
+
+
+def _make_chunks(pending: List[Dict]) -> Dict[str, List[Dict]]:
+    # {requestid: estimates} of up to 30. QuickBooks answers a repeated requestid with the first response, faults
+    # included, so an estimate whose fault was answered gets a new requestid. The ones that still carry the requestid
+    # of a send whose answer was lost, to a gateway error, a dropped connection or a worker that crashed, go again
+    # under it with their bId, in case QuickBooks created them anyway
+    chunks = {}
+    for item in pending:
+        if item.get('request id'):
+            chunks.setdefault(item['request id'], []).append(item)
+    new = [item for item in pending if not item.get('request id')]
+    for start in range(0, len(new), BATCH_SIZE):
+        request_id = uuid.uuid4().hex
+        for i, item in enumerate(new[start:start + BATCH_SIZE]):
+            item['request id'], item['batch item'] = request_id, str(i)
+        chunks[request_id] = new[start:start + BATCH_SIZE]
+    return chunks
+
+
+def create_qb_estimates(
+        pending: List[Dict],
+        logger: getLogger,
+        application_path: str,
+        remember: Callable[[Dict[str, List[Dict]]], None] = None
+) -> List[Dict]:
+    # Posts the estimates made by build_qb_estimate() in /batch requests of up to 30 operations and retries
+    # only the failed ones. Returns one result per estimate with its platform, order number and estimate ID or error,
+    # and the requestid of the error when QuickBooks never answered it.
+    # The estimates of build_order_estimate() are recorded in the ledger as soon as their batch succeeds.
+    # remember() gets the chunks with their requestids before they are sent, to save them for a crash
+    with metrics.stage('quickbooks estimates'):
+        results = _create_qb_estimates(pending=pending, logger=logger, application_path=application_path,
+                                       remember=remember)
+    metrics.count('estimates created', sum('estimate id' in result and not result['updated'] for result in results))
+    metrics.count('estimates updated', sum('estimate id' in result and result['updated'] for result in results))
+    metrics.count('estimates failed', sum('error' in result for result in results))
+    return results
+
+
+def _post_qb_chunk(
+        request_id: str, chunk: List[Dict], attempt: int, logger: getLogger, application_path: str
+) -> Union[Dict[str, Dict], None]:
+    # None when there's no answer to read, QuickBooks may still have created the estimates
+    try:
+        return {item['bId']: item for item in _post_qb_batch(chunk, request_id, application_path=application_path)}
+    except:
+        logger.error(f'QuickBooks batch request failed (attempt {attempt}):')
+        logger.error(traceback.format_exc())
+        return None
+
+
+def _create_qb_estimates(
+        pending: List[Dict], logger: getLogger, application_path: str, remember: Callable = None
+) -> List[Dict]:
+    results = []
+    for attempt in range(1, BATCH_ATTEMPTS + 1):
+        retry = []
+        wait = False  # A stale SyncToken is retried right away, a fault after a delay
+        chunks = _make_chunks(pending)
+        if remember:
+            remember(chunks)
+        # The batches are posted in parallel and handled in the order they come back
+        futures = {
+            tenants.submit(get_executor(), _post_qb_chunk, request_id, chunk, attempt, logger, application_path): chunk
+            for request_id, chunk in chunks.items()
+        }
+        for future in as_completed(futures):
+            chunk = futures[future]
+            responses = future.result()
+
+            ledger = []
+            for item in chunk:
+                response = (responses or {}).get(item['batch item'])
+                if response is None:
+                    # The same requestid and bId again, QuickBooks answers with the estimate if it made one
+                    if attempt < BATCH_ATTEMPTS:
+                        retry.append(item)
+                        wait = True
+                        continue
+                    logger.error(f"Estimate for order {item['order number']} from {item['platform']} got no answer "
+                                 f"from QuickBooks, it goes again under requestid {item['request id']}")
+                    results.append({'platform': item['platform'], 'order number': item['order number'],
+                                    'error': 'No response', 'request id': item['request id']})
+                    continue
+                # An answered fault would be answered again under this requestid, the next attempt gets a new one
+                del item['request id'], item['batch item']
+                if 'Estimate' in response:
+                    results.append({
+                        'platform': item['platform'],
+                        'order number': item['order number'],
+                        'estimate id': response['Estimate']['Id'],
+                        'sync token': response['Estimate'].get('SyncToken'),
+                        'updated': 'estimate id' in item
+                    })
+                    if 'hash' in item:
+                        ledger.append(dict(results[-1], hash=item['hash']))
+                    continue
+                # Validation faults won't pass on a retry either, except a stale SyncToken of an estimate edited
+                # in QuickBooks since it was recorded: the update goes again with the current one
+                stale = 'estimate id' in item and any(
+                    str(error.get('code')) == STALE_OBJECT_ERROR for error in response['Fault']['Error']
+                )
+                if stale and attempt < BATCH_ATTEMPTS:
+                    try:
+                        item['estimate']['SyncToken'] = _get_sync_token(item['estimate id'], application_path)
+                        metrics.count('estimates stale')
+                        retry.append(item)
+                        continue
+                    except:
+                        logger.error(f"Estimate {item['estimate id']} couldn't be read from QuickBooks:")
+                        logger.error(traceback.format_exc())
+                elif response['Fault'].get('type') != 'ValidationFault' and attempt < BATCH_ATTEMPTS:
+                    retry.append(item)
+                    wait = True
+                    continue
+                error = '; '.join(
+                    f"{error.get('Message', '')} {error.get('Detail', '')}".strip() for error in response['Fault']['Error']
+                )
+                logger.error(f"Estimate for order {item['order number']} from {item['platform']} wasn't "
+                             f"{'updated' if 'estimate id' in item else 'created'} in QuickBooks: {error}")
+                results.append({'platform': item['platform'], 'order number': item['order number'], 'error': error})
+            # Right away, so a crash later in the run can't lead to duplicates on the next one
+            state.save_estimates(application_path, ledger)
+
+        if not retry:
+            break
+        pending = retry
+        if wait:
+            time.sleep(BATCH_RETRY_DELAY * attempt)
+
+    return results
@@ -0,0 +1,80 @@
+# The CSV tables kept next to main.py, each mapping the values of its first column to the second one.
+# A table is parsed once into a dict, the parsed form is cached in a pickle file for the next processes, and a
+# long-running process picks up an edited file on its next lookup without restarting
+from typing import Dict
+import csv, hashlib, io, os, pickle, tempfile, threading, time
+
+TABLES = {
+    'customer rank': 'customer rank.csv',  # Customer ID as shown in the dashboard -> rank, lower comes first
+    'product location': 'product codes location.csv',  # Product code -> location
+    'rekki product codes': 'shopify-rekki product codes matching.csv'  # Rekki product code -> Shopify product code
+}
+CACHE_FILE = 'reference data.pickle'
+CHECK_INTERVAL = 5  # Seconds between checks of a file for changes
+
+_tables = {}  # {(application path, table name): {'mtime', 'size', 'hash', 'data', 'checked'}}
+_lock = threading.Lock()
+
+
+def _parse(content: bytes) -> Dict[str, str]:
+    table = {}
+    for row in csv.reader(io.StringIO(content.decode('utf-8-sig'))):
+        if len(row) >= 2:
+            table[row[0]] = row[1]
+    return table
+
+
+def _load_cache(application_path: str) -> Dict:
+    try:
+        with open(os.path.join(application_path, CACHE_FILE), 'rb') as file:
+            return pickle.load(file)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return {}
+
+
+def _save_cache(application_path: str) -> None:
+    cache = _load_cache(application_path)
+    cache.update({name: entry for (path, name), entry in _tables.items() if path == application_path})
+    # A temporary file of its own, the worker.py processes may save the cache at the same time
+    with tempfile.NamedTemporaryFile('wb', dir=application_path, suffix='.tmp', delete=False) as file:
+        pickle.dump(cache, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(file.name, os.path.join(application_path, CACHE_FILE))
+
+
+def _load(application_path: str, name: str) -> Dict:
+    # The cached entry if the file's modification time and size match, otherwise the file's hash decides whether
+    # it really changed before it's parsed again
+    stat = os.stat(os.path.join(application_path, TABLES[name]))
+    entry = _tables.get((application_path, name)) or _load_cache(application_path).get(name)
+    if entry and (entry['mtime'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+        return entry
+    with open(os.path.join(application_path, TABLES[name]), 'rb') as file:
+        content = file.read()
+    content_hash = hashlib.sha256(content).hexdigest()
+    data = entry['data'] if entry and entry['hash'] == content_hash else _parse(content)
+    entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': content_hash, 'data': data}
+    _tables[(application_path, name)] = entry
+    _save_cache(application_path)
+    return entry
+
+
+def get_table(name: str, application_path: str) -> Dict[str, str]:
+    with _lock:
+        entry = _tables.get((application_path, name))
+        if not entry or time.monotonic() - entry.get('checked', 0) > CHECK_INTERVAL:
+            entry = _load(application_path, name)
+            entry['checked'] = time.monotonic()
+        return entry['data']
+
+
+def customer_rank(customer: str, application_path: str) -> str:
+    return get_table('customer rank', application_path).get(customer, '')
+
+
+def product_location(product_code: str, application_path: str) -> str:
+    return get_table('product location', application_path).get(product_code, '')
+
+
+def shopify_product_code(rekki_product_code: str, application_path: str) -> str:
+    # Rekki codes without a match are kept as they are
+    return get_table('rekki product codes', application_path).get(rekki_product_code, rekki_product_code)
@@ -1,46 +1,77 @@
-from typing import List, Dict
+from typing import List, Dict, Iterator
 from logging import getLogger
+from decimal import Decimal
 from dateutil import tz
-import json, os, traceback, datetime, csv
+import traceback, datetime
 
-import requests
+from tenants import config
+import http_client
+import reference_data
+import state
+from order_model import Order, LineItem
 
-import config
+PAGE_SIZE = 500  # Orders per orders/list request
 
 
-def get_orders(logger: getLogger, application_path: str) -> List:
+def _pages(since: str) -> Iterator[List[Dict]]:
     # API reference https://api.rekki.com/swagger/index.html#operations-orders-ListOrdersBySupplierV3
-    orders = []
-    try:
-        variables = json.load(open(os.path.join(application_path, 'variables.txt'), 'r'))
-        url = 'https://api.rekki.com/api/integration/v3/orders/list'
-        headers = {
-            'Authorization': 'Bearer ' + config.rekki_token,
-            'X-REKKI-Authorization-Type': 'supplier_api_token',
-        }
+    # Keyset paging: every page asks for the orders after the newest one of the previous page
+    url = http_client.base_url('rekki', 'https://api.rekki.com') + '/api/integration/v3/orders/list'
+    headers = {
+        'Authorization': 'Bearer ' + config.rekki_token,
+        'X-REKKI-Authorization-Type': 'supplier_api_token',
+    }
+    while True:
         params = {
-            'since': variables['rekki']['last order time'],  # Comes as a string from the previous API call
+            'since': since,
+            'limit': PAGE_SIZE,
             "skip_integrated": False
         }
-        response = requests.post(url, json=params, headers=headers)
+        response = http_client.post(url, json=params, headers=headers)
         response.raise_for_status()
-    
-        # Remove orders that may duplicate from the last call and save the last order's timestamp
-        order_ids = []
-        for order in response.json()['orders']:
-            current_order_date_time_obj = datetime.datetime.strptime(order['inserted_at'], '%Y-%m-%dT%H:%M:%S.%fZ')
-            latest_order_date_time_obj = datetime.datetime.strptime(variables['rekki']['last order time'], '%Y-%m-%dT%H:%M:%S.%fZ')
-            if current_order_date_time_obj > latest_order_date_time_obj:
-                variables['rekki']['last order time'] = order['inserted_at']
-    
-            if order['reference'] not in variables['rekki']['last orders']:
-                orders.append(order)
-                order_ids.append(order['reference'])
-    
-        variables['rekki']['last orders'] = order_ids
-        json.dump(variables, open(os.path.join(application_path, 'variables.txt'), 'w'))
-    
-        logger.info(f'Rekki returned {str(len(orders))} orders')
+        page = response.json()['orders']
+        yield page
+        newest = max((order['inserted_at'] for order in page), default=since)
+        # A full page of orders inserted at the same moment would be requested again forever
+        if len(page) < PAGE_SIZE or newest == since:
+            return
+        since = newest
+
+
+def iter_orders(logger: getLogger, application_path: str) -> Iterator[Order]:
+    # Yields the orders page by page. The cursor and the seen orders are saved, and the orders queued for the sinks,
+    # once the consumer took every order of a page, so a failure later only costs the pages after the last checkpoint
+    cursor = state.get_cursor(application_path, 'rekki')
+    count = 0
+    for page in _pages(cursor['last order time']):  # Comes as a string from the previous API call
+        order_ids = set()
+        new_orders = []
+        for order in page:
+            # The timestamps have a fixed width, 2021-10-18T10:00:00.000000Z, so they compare correctly as strings
+            if order['inserted_at'] > cursor['last order time']:
+                cursor['last order time'] = order['inserted_at']
+
+            # Remove orders that may duplicate from the last call
+            if order['reference'] not in order_ids and not state.is_seen(application_path, 'rekki', order['reference']):
+                new_orders.append(order)
+                order_ids.add(order['reference'])
+
+        # Match the Rekki product codes with Shopify codes
+        normalized = normalize_orders(match_product_codes(orders=new_orders, application_path=application_path),
+                                      logger=logger)
+        for order in normalized:
+            count += 1
+            yield order
+        state.save(application_path, 'rekki', cursor=cursor, seen_order_ids=order_ids, orders=normalized)
+
+    logger.info(f'Rekki returned {str(count)} orders')
+
+
+def get_orders(logger: getLogger, application_path: str) -> List[Order]:
+    orders = []
+    try:
+        for order in iter_orders(logger=logger, application_path=application_path):
+            orders.append(order)
     except:
         logger.error(f'Could n\'t get orders from Rekki:')
         logger.error(traceback.format_exc())
@@ -49,16 +80,10 @@ def get_orders(logger: getLogger, application_path: str) -> List:
 
 
 def match_product_codes(orders: List, application_path: str) -> List:
-    # Load the dictionary to match Rekki product codes with the ones from Shopify
-    data = list(csv.reader(open(os.path.join(application_path, 'shopify-rekki product codes matching.csv'))))
-    product_codes = {}
-    for row in data:
-        product_codes[row[0]] = row[1]  # the first item is Rekki, the second one is Shopify
-
-    # Replace the Rekki product code using the productCodes dict
+    # Replace the Rekki product codes with the ones from Shopify
     for order in orders:
         for item in order['items']:
-            item['product_code'] = product_codes.get(item['product_code'], item['product_code'])
+            item['product_code'] = reference_data.shopify_product_code(item['product_code'], application_path)
 
     return orders
 
@@ -68,3 +93,32 @@ def get_delivery_dt(order: Dict) -> datetime.datetime:
             .strptime(order['delivery_on'], '%Y-%m-%d')
             .replace(tzinfo=tz.gettz('UTC'))
             .astimezone(tz.gettz('America/Toronto')))
+
+
+def normalize_orders(orders: List[Dict], logger: getLogger) -> List[Order]:
+    normalized = []
+    delivery_dts = {}  # Most orders share a few delivery dates, each one is parsed once
+    for order in orders:
+        try:
+            if order['delivery_on'] not in delivery_dts:
+                delivery_dts[order['delivery_on']] = get_delivery_dt(order)
+            normalized.append(Order(
+                platform='Rekki',
+                order_id=order['reference'],
+                customer=order['customer_account_no'],
+                qb_customer=order['contact_name'],
+                delivery_dt=delivery_dts[order['delivery_on']],
+                notes=order['notes'],
+                lines=tuple(
+                    LineItem(
+                        name=line['name'],
+                        quantity=line['quantity'],
+                        price=Decimal(str(line['price']) + '.' + str(line['price_cents'])),
+                        product_code=line['product_code']
+                    ) for line in order['items']
+                )
+            ))
+        except:
+            logger.error(f'Rekki order {order.get("reference")} couldn\'t be read and was skipped:')
+            logger.error(traceback.format_exc())
+    return normalized
@@ -1,59 +1,339 @@
 import datetime
-from typing import List, Dict
+from typing import List, Dict, Iterator
+from decimal import Decimal
 from logging import getLogger
-import json, os, traceback
+import collections, json, queue, re, threading, time, traceback
 
-import requests
+from tenants import config
+import http_client
+import state
+from order_model import Order, LineItem
 
-import config
+# Only the fields main.py uses, everything else Shopify sends is dropped by the API itself
+ORDER_FIELDS = 'id,created_at,customer,line_items'
+PREFETCH_PAGES = 2  # Pages downloaded ahead of the consumer
+DEFAULT_CREATED_AT_MIN = '2021-10-10T00:00:00-07:00'  # Orders created earlier are left out, config.shopify_created_at_min
+BULK_POLL_INTERVAL = 5  # Seconds between checks of a running bulk operation, config.shopify_bulk_poll_interval
+BULK_SAVE_SIZE = 250  # Orders of the bulk result queued per transaction
+BULK_PENDING_ORDERS = 1000  # Orders of the bulk result kept in memory for their line items
+# The fields of the REST orders that normalize() reads. Nested connections come as separate lines of the result
+BULK_QUERY = '''{
+  orders(query: "%s") {
+    edges { node {
+      id
+      legacyResourceId
+      createdAt
+      customer { firstName lastName }
+      lineItems { edges { node {
+        name
+        quantity
+        originalUnitPriceSet { shopMoney { amount } }
+        discountAllocations { allocatedAmountSet { shopMoney { amount } } }
+      } } }
+    } }
+  }
+}'''
 
 
-def get_orders(logger: getLogger, application_path: str) -> List:
+def _compact(order: Dict) -> Dict:
+    # customer and line_items come whole even with the fields parameter, keep only what's used
+    customer = order.get('customer') or {}
+    return {
+        'id': order['id'],
+        'created_at': order['created_at'],
+        'customer': {
+            'first_name': customer.get('first_name') or '',
+            'last_name': customer.get('last_name') or ''
+        },
+        'line_items': [
+            {
+                'name': item['name'],
+                'quantity': item['quantity'],
+                'price': item['price'],
+                'discount_allocations': [
+                    {'amount': allocation['amount']} for allocation in item.get('discount_allocations', [])
+                ]
+            } for item in order['line_items']
+        ]
+    }
+
+
+def _base_url() -> str:
+    return http_client.base_url('shopify', f'https://{config.shopify_store}.myshopify.com')
+
+
+def _pages(last_order_id: int) -> Iterator[List[Dict]]:
     # API reference https://shopify.dev/docs/admin-api/rest/reference/orders/order#index-2021-04
-    orders = []
-    try:
-        variables = json.load(open(os.path.join(application_path, 'variables.txt'), 'r'))
-        url = f'https://{config.shopify_store}.myshopify.com/admin/api/2021-04/orders.json'
-        headers = {'X-Shopify-Access-Token': config.shopify_password}
-        params = {
-            'status': 'open',
-            'limit': 250,
-            'since_id': variables['shopify']['last order id'],
-            'created_at_min': '2021-10-10T00:00:00-07:00'
-        }
-        response = requests.get(url, params=params, headers=headers)
+    url = f'{_base_url()}/admin/api/2021-04/orders.json'
+    headers = {'X-Shopify-Access-Token': config.shopify_password}
+    params = {
+        'status': 'open',
+        'limit': 250,
+        'since_id': last_order_id,
+        'created_at_min': getattr(config, 'shopify_created_at_min', DEFAULT_CREATED_AT_MIN),
+        'fields': ORDER_FIELDS
+    }
+    while url:
+        response = http_client.get(url, params=params, headers=headers)
         response.raise_for_status()
-
-        orders = response.json()['orders']
+        yield [_compact(order) for order in response.json()['orders']]
 
         # Continue requesting next pages if there are any
-        while '; rel="next"' in response.headers.get('Link', ''):
-            url_data = response.headers.get('Link')
-            for item in url_data.split(','):
-                if '; rel="next"' in item:
-                    url = item.split('; rel="next"')[0].strip(' <>')
-                    break
+        next_link = re.search(r'<([^>]*)>; rel="next"', response.headers.get('Link', ''))
+        url = next_link.group(1) if next_link else None
+        # Only limit and fields may be sent along with page_info
+        params = {} if url and 'fields=' in url else {'fields': ORDER_FIELDS}
 
-            headers = {'X-Shopify-Access-Token': config.shopify_password}
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
 
-            orders += response.json()['orders']
+def iter_orders(logger: getLogger, application_path: str) -> Iterator[Order]:
+    # Yields orders as the pages arrive while the next pages download in the background.
+    # A page's orders are queued for the sinks together with the cursor once the consumer took all of them, so an
+    # interrupted run fetches the rest again
+    cursor = state.get_cursor(application_path, 'shopify')
+    pages = queue.Queue(maxsize=PREFETCH_PAGES)
+    stop = threading.Event()
 
-        logger.info(f'Shopify returned {str(len(orders))} orders')
+    def download():
+        try:
+            for page in _pages(cursor['last order id']):
+                while not stop.is_set():
+                    try:
+                        pages.put(page, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            pages.put(None)
+        except Exception as error:
+            pages.put(error)
 
-        # Find the last id in the list
-        for order in orders:
-            if int(order['id']) > variables['shopify']['last order id']:
-                variables['shopify']['last order id'] = int(order['id'])
-        json.dump(variables, open(os.path.join(application_path, 'variables.txt'), 'w'))
+    threading.Thread(target=download, daemon=True, name='shopify-pages').start()
+    count = 0
+    try:
+        while True:
+            page = pages.get()
+            if page is None:
+                break
+            if isinstance(page, Exception):
+                raise page
+            seen_order_ids = []
+            new_orders = []
+            for order in page:
+                # Find the last id in the list
+                cursor['last order id'] = max(cursor['last order id'], int(order['id']))
+                # Orders that already came in by webhook
+                if state.is_seen(application_path, 'shopify', order['id']):
+                    continue
+                try:
+                    normalized = normalize(order)
+                except:
+                    logger.error(f'Shopify order {order["id"]} couldn\'t be read and was skipped:')
+                    logger.error(traceback.format_exc())
+                    continue
+                count += 1
+                seen_order_ids.append(order['id'])
+                new_orders.append(normalized)
+                yield normalized
+            state.save(application_path, 'shopify', cursor=cursor, seen_order_ids=seen_order_ids, orders=new_orders)
+    finally:
+        stop.set()
+
+    logger.info(f'Shopify returned {str(count)} orders')
+
+
+def get_queued_orders(logger: getLogger, application_path: str) -> List[Order]:
+    # Orders pushed by the orders/create webhook and waiting in the state inbox, the webhook body is the same
+    # order JSON the REST API returns. A payload leaves the inbox when its order is queued for the sinks
+    orders = []
+    last_id = 0
+    while True:
+        queued = state.peek_queued(application_path, 'shopify', after_id=last_id)
+        if not queued:
+            break
+        last_id = queued[-1][0]
+        seen_order_ids = []
+        new_orders = []
+        for inbox_id, payload in queued:
+            try:
+                order = _compact(json.loads(payload))
+                # Shopify may deliver a webhook more than once
+                if order['id'] in seen_order_ids or state.is_seen(application_path, 'shopify', order['id']):
+                    continue
+                new_orders.append(normalize(order))
+                seen_order_ids.append(order['id'])
+            except:
+                logger.error(f'Shopify webhook couldn\'t be read and was skipped: {payload[:200]}')
+                logger.error(traceback.format_exc())
+        state.save(application_path, 'shopify', seen_order_ids=seen_order_ids, orders=new_orders,
+                   inbox_ids=[inbox_id for inbox_id, payload in queued])
+        orders += new_orders
+    if orders:
+        logger.info(f'Shopify webhooks delivered {str(len(orders))} orders')
+
+    return orders
 
+
+def get_orders(logger: getLogger, application_path: str) -> List[Order]:
+    orders = []
+    try:
+        for order in iter_orders(logger=logger, application_path=application_path):
+            orders.append(order)
     except:
         logger.error(f'Could n\'t get orders from Shopify:')
         logger.error(traceback.format_exc())
+        orders = []
 
     return orders
 
 
+def _graphql(query: str) -> Dict:
+    # API reference https://shopify.dev/api/usage/bulk-operations/queries
+    response = http_client.post(
+        f'{_base_url()}/admin/api/2021-10/graphql.json',
+        json={'query': query},
+        headers={'X-Shopify-Access-Token': config.shopify_password}
+    )
+    response.raise_for_status()
+    result = response.json()
+    if result.get('errors'):
+        raise RuntimeError(f'Shopify GraphQL errors: {result["errors"]}')
+    return result['data']
+
+
+def _run_bulk_query(query: str, logger: getLogger) -> Dict:
+    # Starts the bulk operation and waits for it. Returns the finished operation with the URL of its JSONL result,
+    # None when nothing matched
+    started = _graphql(
+        'mutation { bulkOperationRunQuery(query: %s) { bulkOperation { id status } userErrors { field message } } }'
+        % json.dumps(query)
+    )['bulkOperationRunQuery']
+    if started['userErrors']:
+        # Only one bulk query runs per store at a time
+        raise RuntimeError(f'Shopify bulk query refused: {started["userErrors"]}')
+    operation_id = started['bulkOperation']['id']
+    logger.info(f'Shopify bulk operation {operation_id} started')
+    while True:
+        time.sleep(getattr(config, 'shopify_bulk_poll_interval', BULK_POLL_INTERVAL))
+        operation = _graphql(
+            '{ currentBulkOperation { id status errorCode objectCount fileSize url } }'
+        )['currentBulkOperation']
+        if operation['id'] != operation_id:
+            raise RuntimeError(f'Shopify bulk operation {operation_id} was replaced by {operation["id"]}')
+        if operation['status'] == 'COMPLETED':
+            return operation
+        if operation['status'] not in ('CREATED', 'RUNNING'):
+            raise RuntimeError(f'Shopify bulk operation {operation_id} ended {operation["status"]}, '
+                               f'error code {operation["errorCode"]}')
+
+
+def _bulk_orders(url: str) -> Iterator[Dict]:
+    # Streams the JSONL result and yields the orders in the shape of the REST API. Every line is an order or, with its
+    # __parentId, a line item of an order. Shopify only promises that an order comes before its line items, not right
+    # before them, so the last BULK_PENDING_ORDERS orders are kept by their ID for line items that come late
+    orders = collections.OrderedDict()
+    response = http_client.get(url, stream=True)
+    response.raise_for_status()
+    with response:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            node = json.loads(line)
+            if '__parentId' not in node:
+                if len(orders) == BULK_PENDING_ORDERS:
+                    yield orders.popitem(last=False)[1]
+                customer = node['customer'] or {}
+                orders[node['id']] = {
+                    'id': int(node['legacyResourceId']),
+                    # UTC with a Z, which fromisoformat() only reads from Python 3.11 on
+                    'created_at': node['createdAt'].replace('Z', '+00:00'),
+                    'customer': {
+                        'first_name': customer.get('firstName') or '',
+                        'last_name': customer.get('lastName') or ''
+                    },
+                    'line_items': []
+                }
+            else:
+                # Its order was already yielded without it, or never came: going on would write a wrong estimate
+                if node['__parentId'] not in orders:
+                    raise RuntimeError(f'Shopify bulk line item of {node["__parentId"]} came at least '
+                                       f'{BULK_PENDING_ORDERS} orders after its order, or without it')
+                orders[node['__parentId']]['line_items'].append({
+                    'name': node['name'],
+                    'quantity': node['quantity'],
+                    'price': node['originalUnitPriceSet']['shopMoney']['amount'],
+                    'discount_allocations': [
+                        {'amount': allocation['allocatedAmountSet']['shopMoney']['amount']}
+                        for allocation in node['discountAllocations']
+                    ]
+                })
+    yield from orders.values()
+
+
+def backfill(
+        logger: getLogger,
+        application_path: str,
+        since: datetime.date,
+        until: datetime.date = None,
+        quickbooks: bool = False
+) -> Dict[str, int]:
+    # Queues every open order created from `since` up to `until` with one bulk query instead of paging through
+    # REST, the orders already seen too, so a store's history can be written again. The cursor of iter_orders() isn't
+    # touched. Google Sheets skips the orders it already shows, so an interrupted backfill is simply run again.
+    # QuickBooks only knows the estimates of its ledger, the ones posted before it existed would be created a second
+    # time, so the orders are only queued for it with `quickbooks`
+    start = time.monotonic()
+    sinks = state.SINKS if quickbooks else ('google sheets',)
+    search = f'status:open created_at:>={since.isoformat()}'
+    if until:
+        search += f' created_at:<{until.isoformat()}'
+    operation = _run_bulk_query(BULK_QUERY % search, logger=logger)
+    results = {'objects': int(operation['objectCount']), 'orders': 0, 'failed': 0}
+    if operation['url']:
+        batch = []
+        for order in _bulk_orders(operation['url']):
+            try:
+                batch.append(normalize(order))
+            except:
+                results['failed'] += 1
+                logger.error(f'Shopify order {order["id"]} couldn\'t be read and was skipped:')
+                logger.error(traceback.format_exc())
+            if len(batch) == BULK_SAVE_SIZE:
+                state.save(application_path, 'shopify', seen_order_ids=[order.order_id for order in batch], orders=batch,
+                           sinks=sinks)
+                results['orders'] += len(batch)
+                batch = []
+        state.save(application_path, 'shopify', seen_order_ids=[order.order_id for order in batch], orders=batch,
+                   sinks=sinks)
+        results['orders'] += len(batch)
+    logger.info(f'Shopify backfill queued {results["orders"]} orders from {results["objects"]} objects '
+                f'in {time.monotonic() - start:.1f}s')
+    return results
+
+
 def get_delivery_dt(order: Dict) -> datetime.datetime:
     return datetime.datetime.fromisoformat(order['created_at'])
+
+
+def normalize(order: Dict) -> Order:
+    lines = []
+    for line in order['line_items']:
+        discount = Decimal("0")
+        for discount_allocation in line['discount_allocations']:
+            discount += Decimal(discount_allocation['amount'])
+        lines.append(LineItem(
+            name=line['name'],
+            quantity=line['quantity'],
+            price=Decimal(str(line['price'])),
+            discount=discount
+        ))
+    customer_name = (order['customer']['first_name'] + ' ' + order['customer']['last_name']).strip()
+    return Order(
+        platform='Shopify',
+        order_id=order['id'],
+        customer=customer_name,
+        qb_customer=customer_name,
+        delivery_dt=get_delivery_dt(order),
+        notes='',
+        lines=tuple(lines)
+    )
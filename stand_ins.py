@@ -0,0 +1,635 @@
+# Local stand-ins for the external services, used by benchmark.py to measure the project without touching production
+from typing import Dict, List, Union
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+import base64, collections, collections.abc, datetime, email, email.utils, json, random, re, socketserver, sys, threading, time
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, the same as the real APIs
+    disable_nagle_algorithm = True  # Headers and body are separate writes, don't let them wait for a delayed ACK
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method: str) -> None:
+        stand_in = self.server.stand_in
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        with stand_in.lock:
+            stand_in.requests[f'{method} {url.path}'] += 1
+        if stand_in.latency:
+            time.sleep(stand_in.latency)
+        status, headers, payload = stand_in.refuse() or \
+            stand_in.handle(method, url.path, parse_qs(url.query), body, self.headers)
+        if isinstance(payload, collections.abc.Iterator):
+            # A large body generated on the fly, sent in chunks without holding it in memory
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            sent = 0
+            for chunk in payload:
+                self.wfile.write(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n')
+                sent += len(chunk)
+            self.wfile.write(b'0\r\n\r\n')
+            with stand_in.lock:
+                stand_in.bytes_sent += sent
+            return
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        with stand_in.lock:
+            stand_in.bytes_sent += len(payload)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class _StandInServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # A client killed mid-request, as the queue benchmark does to a worker, isn't an error of the stand-in
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StandIn:
+    # Runs a local HTTP server in a background thread, subclasses implement handle().
+    # rate_limit is the requests per second allowed before answering 429, after a burst of up to burst requests
+    # (one second worth by default), error_rate the share answered with 503
+    def __init__(self, latency: float = 0.0, rate_limit: float = None, burst: float = None, error_rate: float = 0.0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.burst = burst or rate_limit
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.refused = collections.Counter()
+        self.bytes_sent = 0  # Response bodies
+        self._allowance = self.burst or 0
+        self._allowance_checked = time.monotonic()
+        self._server = _StandInServer(('127.0.0.1', 0), StandInHandler)
+        self._server.daemon_threads = True
+        self._server.stand_in = self
+        self.url = f'http://127.0.0.1:{self._server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def refuse(self) -> Union[tuple, None]:
+        # A leaky bucket refills rate_limit requests per second, up to burst
+        with self.lock:
+            if self.rate_limit:
+                now = time.monotonic()
+                self._allowance = min(self.burst, self._allowance + (now - self._allowance_checked) * self.rate_limit)
+                self._allowance_checked = now
+                if self._allowance < 1:
+                    self.refused['429'] += 1
+                    return 429, {'Retry-After': '1'}, {'errors': 'Exceeded the rate limit'}
+                self._allowance -= 1
+            if self.error_rate and random.random() < self.error_rate:
+                self.refused['503'] += 1
+                return 503, {}, {'errors': 'Injected error'}
+        return None
+
+    def bucket_usage(self) -> str:
+        # How full the rate limit bucket is, in the X-Shopify-Shop-Api-Call-Limit format
+        with self.lock:
+            return f'{int(self.burst - self._allowance)}/{int(self.burst)}'
+
+    def handle(self, method: str, path: str, query: Dict, body: bytes, headers) -> tuple:
+        return 404, {}, {'error': 'not found'}
+
+
+class QuickBooksStandIn(StandIn):
+    def __init__(self, items: List[str], customers: List[str], fault_rate: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.tables = {
+            'Item': [{'Id': str(i + 1), 'Name': name, 'Active': True} for i, name in enumerate(items)],
+            'Customer': [{'Id': str(i + 1), 'DisplayName': name, 'Active': True} for i, name in enumerate(customers)]
+        }
+        self.fault_rate = fault_rate
+        self.fault_requests = 0  # The next this many /batch requests fail whole, a transient outage
+        self.lost_responses = 0  # The next this many /batch requests are carried out, then answered with a 502
+        self.estimates = {}
+        self.responses = {}  # By requestid, a repeated request gets the first response back
+
+    def _create_estimate(self, estimate: Dict) -> Dict:
+        with self.lock:
+            estimate = dict(estimate, Id=str(len(self.estimates) + 1), SyncToken='0')
+            self.estimates[estimate['Id']] = estimate
+        return estimate
+
+    def edit_estimate(self, estimate_id: str) -> None:
+        # Someone changes the estimate in QuickBooks, the SyncToken the project recorded is stale then
+        with self.lock:
+            self.estimates[estimate_id]['PrivateNote'] = 'Edited in QuickBooks'
+            self.estimates[estimate_id]['SyncToken'] = str(int(self.estimates[estimate_id]['SyncToken']) + 1)
+
+    def _update_estimate(self, estimate: Dict) -> Dict:
+        # A sparse update replaces the fields it sends, a stale SyncToken means someone else changed the estimate
+        with self.lock:
+            current = self.estimates.get(estimate['Id'])
+            if current is None or current['SyncToken'] != estimate['SyncToken']:
+                return {'Fault': {'type': 'ValidationFault', 'Error': [{'Message': 'Stale Object Error', 'code': '5010'}]}}
+            current.update({key: value for key, value in estimate.items() if key != 'sparse'})
+            current['SyncToken'] = str(int(current['SyncToken']) + 1)
+            return {'Estimate': dict(current)}
+
+    def handle(self, method, path, query, body, headers):
+        endpoint = path.rsplit('/', 1)[-1]
+        if method == 'GET' and endpoint == 'query':
+            sql = query['query'][0]
+            table = re.search(r'from (\w+)', sql).group(1)
+            position = int(re.search(r'STARTPOSITION (\d+)', sql).group(1))
+            max_results = int(re.search(r'MAXRESULTS (\d+)', sql).group(1))
+            rows = self.tables[table][position - 1:position - 1 + max_results]
+            return 200, {}, {'QueryResponse': {table: rows} if rows else {}}
+        if method == 'GET' and re.search(r'/estimate/\w+$', path):
+            with self.lock:
+                estimate = self.estimates.get(endpoint)
+            if estimate is None:
+                return 400, {}, {'Fault': {'type': 'ValidationFault', 'Error': [{'Message': 'Object Not Found'}]}}
+            return 200, {}, {'Estimate': dict(estimate)}
+        if method == 'GET' and endpoint == 'cdc':
+            return 200, {}, {'CDCResponse': [{'QueryResponse': [{}]}]}
+        request_id = query.get('requestid', [None])[0]
+        if method == 'POST' and request_id in self.responses:
+            return 200, {}, self.responses[request_id]
+        if method == 'POST' and endpoint == 'estimate':
+            self.responses[request_id] = {'Estimate': self._create_estimate(json.loads(body))}
+            return 200, {}, self.responses[request_id]
+        if method == 'POST' and endpoint == 'batch':
+            with self.lock:
+                outage = self.fault_requests > 0
+                self.fault_requests -= outage
+            responses = []
+            for item in json.loads(body)['BatchItemRequest']:
+                if outage or random.random() < self.fault_rate:
+                    responses.append({
+                        'bId': item['bId'],
+                        'Fault': {'type': 'SystemFault', 'Error': [{'Message': 'Injected fault'}]}
+                    })
+                elif item['operation'] == 'update':
+                    responses.append(dict(self._update_estimate(item['Estimate']), bId=item['bId']))
+                else:
+                    responses.append({'bId': item['bId'], 'Estimate': self._create_estimate(item['Estimate'])})
+            self.responses[request_id] = {'BatchItemResponse': responses}
+            with self.lock:
+                lost = self.lost_responses > 0
+                self.lost_responses -= lost
+            if lost:
+                return 502, {'Content-Type': 'text/html'}, b'<html><body>502 Bad Gateway</body></html>'
+            return 200, {}, self.responses[request_id]
+        return super().handle(method, path, query, body, headers)
+
+
+
+class ShopifyStandIn(StandIn):
+    # Serves orders 1..order_count generated on the fly, paginated with page_info links like the REST Admin API.
+    # A GraphQL bulk query runs for bulk_seconds and its JSONL result, an order line followed by a line per line item,
+    # is generated while it's downloaded
+    def __init__(self, order_count: int, bulk_seconds: float = 1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.order_count = order_count
+        self.bulk_seconds = bulk_seconds
+        self.late_items = 0  # The line items of an order come after this many other orders in the bulk result
+        self.bulk_operations = []  # {'id', 'started'}
+
+    @staticmethod
+    def make_order(order_id: int) -> Dict:
+        address = {'first_name': 'Jane', 'last_name': f'Doe {order_id % 97}', 'address1': '1 Main St',
+                   'city': 'Toronto', 'province': 'Ontario', 'country': 'Canada', 'zip': 'M5V 2T6',
+                   'phone': '+14165550000', 'company': None, 'latitude': 43.6, 'longitude': -79.4}
+        today = datetime.date.today().isoformat()
+        return {
+            'id': order_id,
+            'admin_graphql_api_id': f'gid://shopify/Order/{order_id}',
+            'created_at': f'{today}T10:00:00-04:00',
+            'updated_at': f'{today}T10:00:00-04:00',
+            'email': f'customer{order_id % 97}@example.com',
+            'note': 'Please deliver before noon', 'tags': 'wholesale, priority',
+            'total_price': '123.45', 'subtotal_price': '120.00', 'total_tax': '3.45', 'currency': 'CAD',
+            'financial_status': 'paid', 'fulfillment_status': None,
+            'billing_address': address, 'shipping_address': address,
+            'customer': dict(address, id=order_id % 97, email=f'customer{order_id % 97}@example.com',
+                             orders_count=12, total_spent='1234.50', note=None, tags='', default_address=address),
+            'line_items': [
+                {'id': order_id * 100 + i, 'name': f'Item {(order_id + i) % 200}', 'title': f'Item {(order_id + i) % 200}',
+                 'quantity': 1 + i, 'price': '9.99', 'sku': f'SKU-{(order_id + i) % 200}', 'vendor': 'Vendor',
+                 'grams': 500, 'taxable': True, 'requires_shipping': True, 'fulfillable_quantity': 1 + i,
+                 'tax_lines': [{'title': 'HST', 'price': '1.30', 'rate': 0.13}],
+                 'discount_allocations': [{'amount': '0.50', 'discount_application_index': 0}] if i == 0 else []}
+                for i in range(1 + order_id % 8)
+            ],
+            'shipping_lines': [{'title': 'Local delivery', 'price': '5.00'}],
+            'tax_lines': [{'title': 'HST', 'price': '3.45', 'rate': 0.13}]
+        }
+
+    def _bulk_lines(self):
+        batch = []
+        late = collections.deque()  # The line items of the last orders, while they're held back
+        for order_id in range(1, self.order_count + 1):
+            order = self.make_order(order_id)
+            gid = f'gid://shopify/Order/{order_id}'
+            batch.append(json.dumps({
+                'id': gid, 'legacyResourceId': str(order_id), 'createdAt': f'{datetime.date.today()}T14:00:00Z',
+                'customer': {'firstName': order['customer']['first_name'], 'lastName': order['customer']['last_name']}
+            }))
+            items = []
+            for item in order['line_items']:
+                items.append(json.dumps({
+                    'name': item['name'], 'quantity': item['quantity'],
+                    'originalUnitPriceSet': {'shopMoney': {'amount': item['price'], 'currencyCode': 'CAD'}},
+                    'discountAllocations': [
+                        {'allocatedAmountSet': {'shopMoney': {'amount': allocation['amount'], 'currencyCode': 'CAD'}}}
+                        for allocation in item['discount_allocations']
+                    ],
+                    '__parentId': gid
+                }))
+            late.append(items)
+            if len(late) > self.late_items:
+                batch.extend(late.popleft())
+            if len(batch) >= 1000:
+                yield ('\n'.join(batch) + '\n').encode()
+                batch = []
+        batch.extend(line for items in late for line in items)
+        if batch:
+            yield ('\n'.join(batch) + '\n').encode()
+
+    def _graphql(self, query: str) -> tuple:
+        with self.lock:
+            current = self.bulk_operations[-1] if self.bulk_operations else None
+            status = 'COMPLETED' if current and time.monotonic() - current['started'] >= self.bulk_seconds else 'RUNNING'
+            if 'bulkOperationRunQuery' in query:
+                if current and status == 'RUNNING':
+                    return 200, {}, {'data': {'bulkOperationRunQuery': {'bulkOperation': None, 'userErrors': [
+                        {'field': None, 'message': 'A bulk query operation for this app and shop is already in progress'}
+                    ]}}}
+                current = {'id': f'gid://shopify/BulkOperation/{len(self.bulk_operations) + 1}',
+                           'started': time.monotonic()}
+                self.bulk_operations.append(current)
+                return 200, {}, {'data': {'bulkOperationRunQuery': {
+                    'bulkOperation': {'id': current['id'], 'status': 'CREATED'}, 'userErrors': []
+                }}}
+        if 'currentBulkOperation' in query and current:
+            done = status == 'COMPLETED'
+            return 200, {}, {'data': {'currentBulkOperation': {
+                'id': current['id'], 'status': status, 'errorCode': None,
+                'objectCount': str(sum(2 + order_id % 8 for order_id in range(1, self.order_count + 1))) if done else '0',
+                'fileSize': None, 'url': f'{self.url}/bulk/{current["id"].rsplit("/", 1)[1]}.jsonl'
+                if done and self.order_count else None
+            }}}
+        return 200, {}, {'errors': [{'message': 'Not supported by the stand-in'}]}
+
+    def handle(self, method, path, query, body, headers):
+        if method == 'POST' and path.endswith('/graphql.json'):
+            return self._graphql(json.loads(body)['query'])
+        if method == 'GET' and path.startswith('/bulk/'):
+            return 200, {'Content-Type': 'application/jsonl'}, self._bulk_lines()
+        if method != 'GET' or not path.endswith('/orders.json'):
+            return super().handle(method, path, query, body, headers)
+        limit = int(query.get('limit', ['50'])[0])
+        if 'page_info' in query:
+            since_id = json.loads(base64.urlsafe_b64decode(query['page_info'][0]))['since_id']
+        else:
+            since_id = int(query.get('since_id', ['0'])[0])
+        fields = query['fields'][0].split(',') if 'fields' in query else None
+        ids = range(since_id + 1, min(since_id + limit, self.order_count) + 1)
+        orders = []
+        for order_id in ids:
+            order = self.make_order(order_id)
+            orders.append({field: order[field] for field in fields} if fields else order)
+        response_headers = {'X-Shopify-Shop-Api-Call-Limit': self.bucket_usage()} if self.rate_limit else {}
+        if ids and ids[-1] < self.order_count:
+            page_info = base64.urlsafe_b64encode(json.dumps({'since_id': ids[-1]}).encode()).decode()
+            next_url = f'{self.url}{path}?limit={limit}&page_info={page_info}'
+            if fields:
+                next_url += '&fields=' + '%2C'.join(fields)
+            response_headers['Link'] = f'<{next_url}>; rel="next"'
+        return 200, response_headers, {'orders': orders}
+
+
+class RekkiStandIn(StandIn):
+    # Orders 1..order_count, one a second starting a day ago, listed oldest first after the 'since' timestamp, up to
+    # 'limit' of them, like orders/list
+    def __init__(self, order_count: int, **kwargs):
+        super().__init__(**kwargs)
+        self.start = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        self.orders = [self.make_order(order_id) for order_id in range(1, order_count + 1)]
+
+    def make_order(self, order_id: int) -> Dict:
+        return {
+            'reference': f'R{order_id}',
+            'inserted_at': (self.start + datetime.timedelta(seconds=order_id)).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'delivery_on': (datetime.date.today() + datetime.timedelta(days=order_id % 3)).isoformat(),
+            'customer_account_no': f'Rekki customer {order_id % 50}',
+            'contact_name': f'Customer {order_id % 50}',
+            'notes': 'Back door',
+            'items': [
+                {'name': f'Item {(order_id + i) % 200}', 'quantity': 1 + i, 'price': 9, 'price_cents': 99,
+                 'product_code': f'R-{(order_id + i) % 200}', 'unit': 'case'}
+                for i in range(1 + order_id % 6)
+            ]
+        }
+
+    def handle(self, method, path, query, body, headers):
+        if method == 'POST' and path == '/api/integration/v3/orders/list':
+            params = json.loads(body)
+            orders = [order for order in self.orders if order['inserted_at'] > params['since']]
+            return 200, {}, {'orders': orders[:params['limit']] if 'limit' in params else orders}
+        return super().handle(method, path, query, body, headers)
+
+
+class MarketmanStandIn(StandIn):
+    # GetToken and the vendor's orders 1..order_count, sent over the past hour and delivered from today on.
+    # GetOrdersByDeliveryDate returns all of them, GetOrdersBySentDate the ones sent within its window
+    TIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+    def __init__(self, order_count: int, **kwargs):
+        super().__init__(**kwargs)
+        self.orders = []
+        start = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        for order_id in range(1, order_count + 1):
+            self.orders.append(self.make_order(order_id, start + datetime.timedelta(seconds=3600 * order_id / order_count)))
+
+    @staticmethod
+    def make_order(order_id: int, sent: datetime.datetime = None) -> Dict:
+        return {
+            'OrderNumber': f'M{order_id}',
+            'BuyerName': f'Customer {order_id % 50}',
+            'SentDateUTC': (sent or datetime.datetime.utcnow()).strftime(MarketmanStandIn.TIME_FORMAT),
+            'DeliveryDateUTC': (datetime.date.today() + datetime.timedelta(days=order_id % 3)).isoformat(),
+            'Comments': '',
+            'Items': [{'ItemName': f'Item {(order_id + i) % 200}', 'Quantity': 2, 'Price': 9.99, 'ItemCode': str(i)}
+                      for i in range(1 + order_id % 5)]
+        }
+
+    def add_orders(self, count: int) -> None:
+        with self.lock:
+            first_id = len(self.orders) + 1
+            self.orders += [self.make_order(order_id) for order_id in range(first_id, first_id + count)]
+
+    def handle(self, method, path, query, body, headers):
+        if method == 'POST' and path == '/v3/buyers/auth/GetToken':
+            expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+            return 200, {}, {'Token': 'token', 'ExpireDateUTC': expires.strftime(self.TIME_FORMAT), 'IsSuccess': True}
+        if method == 'POST' and path.startswith('/v3/vendors/orders/'):
+            if headers.get('AUTH_TOKEN') != 'token':
+                return 401, {}, {'ErrorMessage': 'Invalid token', 'IsSuccess': False}
+            if path.endswith('/GetOrdersByDeliveryDate'):
+                return 200, {}, {'Orders': self.orders, 'IsSuccess': True}
+            if path.endswith('/GetOrdersBySentDate'):
+                window = json.loads(body)
+                orders = [order for order in self.orders
+                          if window['DateTimeFromUTC'] <= order['SentDateUTC'] <= window['DateTimeToUTC']]
+                return 200, {}, {'Orders': orders, 'IsSuccess': True}
+        return super().handle(method, path, query, body, headers)
+
+
+class SheetsStandIn(StandIn):
+    # Spreadsheets for the Sheets v4 and Drive v3 calls google_sheets.py makes, created on first use by their ID.
+    # googleapiclient services built with client_options={'api_endpoint': url} send their requests here
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.spreadsheets = {}  # {spreadsheet ID: {'tabs': {title: {'sheetId', 'rows'}} in tab order, 'version'}}
+
+    @property
+    def tabs(self) -> Dict[str, Dict]:
+        # The tabs of every spreadsheet
+        return {f'{spreadsheet_id} {title}': tab for spreadsheet_id, spreadsheet in self.spreadsheets.items()
+                for title, tab in spreadsheet['tabs'].items()}
+
+    @staticmethod
+    def _title(a1_range: str) -> str:
+        title = a1_range.rsplit('!', 1)[0] if '!' in a1_range else a1_range
+        return title[1:-1].replace("''", "'") if title.startswith("'") else title
+
+    def _batch_update(self, spreadsheet: Dict, requests: List[Dict]) -> None:
+        for request in requests:
+            if 'addSheet' in request:
+                properties = request['addSheet']['properties']
+                spreadsheet['tabs'][properties['title']] = {'sheetId': properties['sheetId'], 'rows': []}
+            elif 'deleteSheet' in request:
+                sheet_id = request['deleteSheet']['sheetId']
+                spreadsheet['tabs'] = {title: tab for title, tab in spreadsheet['tabs'].items()
+                                       if tab['sheetId'] != sheet_id}
+            elif 'updateSheetProperties' in request:
+                properties = request['updateSheetProperties']['properties']
+                tabs = spreadsheet['tabs']
+                titles = [title for title, tab in tabs.items() if tab['sheetId'] != properties['sheetId']]
+                title = next(title for title, tab in tabs.items() if tab['sheetId'] == properties['sheetId'])
+                titles.insert(properties['index'], title)
+                spreadsheet['tabs'] = {title: tabs[title] for title in titles}
+
+    def _write_values(self, spreadsheet: Dict, data: List[Dict]) -> None:
+        for value_range in data:
+            rows = spreadsheet['tabs'][self._title(value_range['range'])]['rows']
+            first_row = int(re.search(r'!A(\d+)', value_range['range']).group(1)) if '!' in value_range['range'] else 1
+            rows.extend([] for _ in range(first_row - 1 + len(value_range['values']) - len(rows)))
+            for i, row in enumerate(value_range['values']):
+                rows[first_row - 1 + i] = [str(value) for value in row]
+            while rows and not any(rows[-1]):
+                rows.pop()
+
+    def handle(self, method, path, query, body, headers):
+        path = unquote(path)
+        match = re.match(r'/(?:v4/spreadsheets|files)/([^/:]+)', path)
+        if not match:
+            return super().handle(method, path, query, body, headers)
+        with self.lock:
+            spreadsheet = self.spreadsheets.setdefault(
+                match.group(1), {'tabs': {'Sheet1': {'sheetId': 0, 'rows': []}}, 'version': 1}
+            )
+            if method == 'GET' and path.startswith('/files/'):
+                return 200, {}, {'version': str(spreadsheet['version'])}
+            if method == 'GET' and path.endswith('/values:batchGet'):
+                return 200, {}, {'valueRanges': [
+                    {'range': a1_range, 'values': spreadsheet['tabs'][self._title(a1_range)]['rows']}
+                    for a1_range in query.get('ranges', [])
+                ]}
+            if method == 'GET' and path.startswith('/v4/spreadsheets/'):
+                return 200, {}, {'sheets': [
+                    {'properties': {'sheetId': tab['sheetId'], 'title': title, 'index': index}}
+                    for index, (title, tab) in enumerate(spreadsheet['tabs'].items())
+                ]}
+            if method == 'POST' and path.endswith('/values:batchUpdate'):
+                self._write_values(spreadsheet, json.loads(body)['data'])
+                spreadsheet['version'] += 1
+                return 200, {}, {}
+            if method == 'POST' and path.endswith(':batchUpdate'):
+                self._batch_update(spreadsheet, json.loads(body)['requests'])
+                spreadsheet['version'] += 1
+                return 200, {}, {'replies': []}
+        return super().handle(method, path, query, body, headers)
+
+
+class IMAPStandIn:
+    # A minimal IMAP4rev1 server holding one mailbox, enough for imaplib and notch.py: LOGIN, SELECT/EXAMINE,
+    # UID SEARCH (UID range, FROM, SUBJECT, SINCE, BEFORE), FETCH/UID FETCH (UID, RFC822, BODYSTRUCTURE, BODY.PEEK[...])
+    def __init__(self, messages: List[bytes], latency: float = 0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.commands = collections.Counter()
+        self.bytes_sent = 0
+        self.messages = [email.message_from_bytes(message) for message in messages]
+        self.raw_messages = list(messages)
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _IMAPHandler)
+        self._server.daemon_threads = True
+        self._server.stand_in = self
+        self.port = self._server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_messages(self, messages: List[bytes]) -> None:
+        with self.lock:
+            self.messages += [email.message_from_bytes(message) for message in messages]
+            self.raw_messages += messages
+
+    def search(self, criteria: List[str]) -> List[int]:
+        uids = []
+        for uid, message in enumerate(self.messages, start=1):
+            i, matches = 0, True
+            while i < len(criteria) and matches:
+                key = criteria[i].upper()
+                if key == 'ALL':
+                    i += 1
+                    continue
+                value = criteria[i + 1].strip('"')
+                if key == 'UID':
+                    first, last = value.split(':')
+                    matches = int(first) <= uid <= (len(self.messages) if last == '*' else int(last)) \
+                        or (last == '*' and uid == len(self.messages))
+                elif key in ('FROM', 'SUBJECT'):
+                    matches = value.lower() in (message[key] or '').lower()
+                elif key == 'SINCE':
+                    since = datetime.datetime.strptime(value, '%d-%b-%Y').date()
+                    matches = email.utils.parsedate_to_datetime(message['Date']).date() >= since
+                elif key == 'BEFORE':
+                    before = datetime.datetime.strptime(value, '%d-%b-%Y').date()
+                    matches = email.utils.parsedate_to_datetime(message['Date']).date() < before
+                i += 2
+            if matches:
+                uids.append(uid)
+        return uids
+
+
+def _imap_string(value: str) -> str:
+    return 'NIL' if value is None else '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _bodystructure(part) -> str:
+    if part.is_multipart():
+        return '(' + ''.join(_bodystructure(child) for child in part.get_payload()) + \
+               ' ' + _imap_string(part.get_content_subtype().upper()) + ')'
+    payload = part.get_payload().encode('utf-8')
+    return '({} {} ("CHARSET" {}) NIL NIL {} {} {})'.format(
+        _imap_string(part.get_content_maintype().upper()),
+        _imap_string(part.get_content_subtype().upper()),
+        _imap_string(part.get_content_charset() or 'us-ascii'),
+        _imap_string((part['Content-Transfer-Encoding'] or '7BIT').upper()),
+        len(payload),
+        payload.count(b'\n')
+    )
+
+
+def _section(message, section: str) -> bytes:
+    if section.startswith('HEADER.FIELDS'):
+        names = section.split('(')[1].rstrip(')').split()
+        return ''.join(f'{name}: {message[name]}\r\n' for name in names if message[name] is not None).encode() + b'\r\n'
+    part = message
+    for number in section.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+    return part.get_payload().encode('utf-8')
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    def _send(self, data: bytes) -> None:
+        self.wfile.write(data)
+        with self.server.stand_in.lock:
+            self.server.stand_in.bytes_sent += len(data)
+
+    def _fetch_items(self, uid: int, items: List[str]) -> bytes:
+        stand_in = self.server.stand_in
+        message = stand_in.messages[uid - 1]
+        response = [f'UID {uid}'.encode()]
+        for item in items:
+            name = item.upper()
+            if name == 'UID':
+                continue
+            if name == 'RFC822':
+                data = stand_in.raw_messages[uid - 1]
+            elif name == 'BODYSTRUCTURE':
+                response.append(b'BODYSTRUCTURE ' + _bodystructure(message).encode())
+                continue
+            else:
+                section = item[item.index('[') + 1:item.rindex(']')]
+                name = f'BODY[{section}]'
+                data = _section(message, section)
+            response.append(name.encode() + b' {' + str(len(data)).encode() + b'}\r\n' + data)
+        return f'* {uid} FETCH ('.encode() + b' '.join(response) + b')\r\n'
+
+    def handle(self):
+        stand_in = self.server.stand_in
+        self._send(b'* OK [CAPABILITY IMAP4rev1] Stand-in ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, command, *rest = line.decode().rstrip('\r\n').split(' ', 2)
+            command = command.upper()
+            arguments = rest[0] if rest else ''
+            if command == 'UID':
+                command, arguments = arguments.split(' ', 1)
+                command = 'UID ' + command.upper()
+            with stand_in.lock:
+                stand_in.commands[command] += 1
+            if stand_in.latency:
+                time.sleep(stand_in.latency)
+
+            if command == 'CAPABILITY':
+                self._send(b'* CAPABILITY IMAP4rev1\r\n')
+            elif command in ('SELECT', 'EXAMINE'):
+                self._send(f'* {len(stand_in.messages)} EXISTS\r\n* OK [UIDVALIDITY 1] UIDs valid\r\n'
+                           f'* OK [UIDNEXT {len(stand_in.messages) + 1}] Predicted next UID\r\n'.encode())
+                self._send(f'{tag} OK [{"READ-ONLY" if command == "EXAMINE" else "READ-WRITE"}] Done\r\n'.encode())
+                continue
+            elif command == 'UID SEARCH':
+                uids = stand_in.search(re.findall(r'"[^"]*"|\S+', arguments))
+                self._send(('* SEARCH ' + ' '.join(map(str, uids))).rstrip().encode() + b'\r\n')
+            elif command in ('FETCH', 'UID FETCH'):
+                message_set, items = arguments.split(' ', 1)
+                items = re.findall(r'BODY(?:\.PEEK)?\[[^\]]*\]|[\w.]+', items.strip('()'))
+                uids = []
+                for interval in message_set.split(','):
+                    first, _, last = interval.partition(':')
+                    uids += range(int(first), int(last or first) + 1)
+                response = b''.join(self._fetch_items(uid, items) for uid in uids if 0 < uid <= len(stand_in.messages))
+                self._send(response)
+            elif command == 'LOGOUT':
+                self._send(b'* BYE\r\n' + tag.encode() + b' OK Done\r\n')
+                return
+            self._send(tag.encode() + b' OK Done\r\n')
@@ -0,0 +1,386 @@
+# Persistent state of the connectors in an SQLite database next to main.py: a cursor per platform, the IDs of the
+# orders already seen, the inbox of webhook payloads, the job queue of the sinks and the ledger of QuickBooks
+# estimates, so parallel connectors and processes can update their own state safely and atomically
+from typing import Callable, Dict, Iterable, List, Set, Tuple, Union
+import contextlib, contextvars, json, os, random, sqlite3, threading, time
+
+import tenants
+from tenants import config
+from order_model import Order, to_json, from_json
+
+DATABASE_FILE = 'state.sqlite3'
+# Days an order ID is remembered for deduplication, per platform
+DEFAULT_RETENTION_DAYS = 30
+# Every order becomes a job per sink, so a sink that fails retries without repeating the other one
+SINKS = ('google sheets', 'quickbooks')
+DEFAULT_JOB_ATTEMPTS = 8  # Then the job moves to dead_jobs, config.job_attempts overrides it
+JOB_BACKOFF_BASE = 30  # Seconds before the first retry, doubles with every attempt
+JOB_BACKOFF_MAX = 3600
+
+# Every fetch of a (tenant, platform) gets the next generation. A fetch that ran out of time, or that a newer one
+# superseded, must not move the cursor, otherwise the orders are lost
+_generations: Dict[Tuple[Union[str, None], str], int] = {}
+_abandoned: Set[Tuple[Union[str, None], str, int]] = set()
+_abandoned_lock = threading.Lock()
+# (platform, generation) of the fetch running in this context, None outside of a fetch
+_fetch = contextvars.ContextVar('fetch', default=None)
+_local = threading.local()
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cursors (
+    platform TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS seen_orders (
+    platform TEXT NOT NULL,
+    order_id TEXT NOT NULL,
+    seen_at REAL NOT NULL,
+    PRIMARY KEY (platform, order_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS seen_orders_age ON seen_orders (platform, seen_at);
+CREATE TABLE IF NOT EXISTS estimates (
+    platform TEXT NOT NULL,
+    order_id TEXT NOT NULL,
+    estimate_id TEXT NOT NULL,
+    sync_token TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (platform, order_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sink TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    order_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    leased_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    request_id TEXT,
+    batch_item TEXT,
+    UNIQUE (sink, platform, order_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_available ON jobs (sink, available_at);
+CREATE TABLE IF NOT EXISTS dead_jobs (
+    id INTEGER PRIMARY KEY,
+    sink TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    order_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    error TEXT,
+    failed_at REAL NOT NULL,
+    request_id TEXT,
+    batch_item TEXT
+);
+CREATE TABLE IF NOT EXISTS inbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    platform TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    received_at REAL NOT NULL
+);
+'''
+
+
+def _migrate(connection: sqlite3.Connection, application_path: str) -> None:
+    # One-time import of the variables.txt file that kept the state before
+    path = os.path.join(application_path, 'variables.txt')
+    if connection.execute('SELECT 1 FROM cursors LIMIT 1').fetchone() or not os.path.exists(path):
+        return
+    with open(path, 'r') as file:
+        variables = json.load(file)
+    now = time.time()
+    for platform, values in variables.items():
+        seen = values.pop('last orders', [])
+        connection.execute('INSERT INTO cursors (platform, value) VALUES (?, ?)', (platform, json.dumps(values)))
+        connection.executemany(
+            'INSERT OR IGNORE INTO seen_orders (platform, order_id, seen_at) VALUES (?, ?, ?)',
+            ((platform, str(order_id), now) for order_id in seen)
+        )
+    os.replace(path, path + '.migrated')
+
+
+def connect(application_path: str) -> sqlite3.Connection:
+    # One connection per thread and database, autocommit mode with explicit transactions
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    if application_path not in connections:
+        connection = sqlite3.connect(
+            os.path.join(application_path, DATABASE_FILE), timeout=30, isolation_level=None
+        )
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(_SCHEMA)
+        # Databases made before the jobs remembered their QuickBooks requestid
+        for table in ('jobs', 'dead_jobs'):
+            if 'request_id' not in {row[1] for row in connection.execute(f'PRAGMA table_info({table})')}:
+                connection.execute(f'ALTER TABLE {table} ADD COLUMN request_id TEXT')
+                connection.execute(f'ALTER TABLE {table} ADD COLUMN batch_item TEXT')
+        with transaction(connection):
+            _migrate(connection, application_path)
+        connections[application_path] = connection
+    return connections[application_path]
+
+
+class transaction:
+    # with transaction(connection): ... runs the statements in one IMMEDIATE transaction, all or nothing
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def get_cursor(application_path: str, platform: str) -> Dict:
+    row = connect(application_path).execute('SELECT value FROM cursors WHERE platform = ?', (platform,)).fetchone()
+    return json.loads(row[0]) if row else {}
+
+
+def get_cursor_version(application_path: str, platform: str) -> int:
+    # Increases with every save, lets a process notice that another one changed the cursor
+    row = connect(application_path).execute('SELECT version FROM cursors WHERE platform = ?', (platform,)).fetchone()
+    return row[0] if row else 0
+
+
+def update_cursor(
+        application_path: str, platform: str, update: Callable[[Dict], Union[Dict, None]]
+) -> Tuple[Dict, int]:
+    # Reads the cursor and saves what update() makes of it in one transaction, the other processes wait for it to
+    # finish before they read the cursor. update() returns None to keep it. Returns the cursor and its version
+    with transaction(connect(application_path)) as connection:
+        row = connection.execute('SELECT value, version FROM cursors WHERE platform = ?', (platform,)).fetchone()
+        cursor, version = (json.loads(row[0]), row[1]) if row else ({}, 0)
+        updated = update(cursor)
+        if updated is None:
+            return cursor, version
+        connection.execute(
+            'INSERT INTO cursors (platform, value) VALUES (?, ?) '
+            'ON CONFLICT (platform) DO UPDATE SET value = excluded.value, version = version + 1',
+            (platform, json.dumps(updated))
+        )
+        return updated, version + 1
+
+
+def is_seen(application_path: str, platform: str, order_id) -> bool:
+    return connect(application_path).execute(
+        'SELECT 1 FROM seen_orders WHERE platform = ? AND order_id = ?', (platform, str(order_id))
+    ).fetchone() is not None
+
+
+def save(
+        application_path: str,
+        platform: str,
+        cursor: Dict = None,
+        seen_order_ids: Iterable = (),
+        orders: Iterable[Order] = (),
+        inbox_ids: Iterable[int] = (),
+        sinks: Iterable[str] = SINKS
+) -> bool:
+    # Saves the cursor, remembers the order IDs and forgets the ones older than the retention window in one transaction.
+    # The orders are queued for the sinks and the inbox payloads they came from are removed in the same transaction,
+    # so the cursor never moves past an order that isn't safely queued
+    fetch = _fetch.get()
+    if fetch is not None and fetch[0] == platform:
+        with _abandoned_lock:
+            tenant = tenants.get_name()
+            if (tenant, *fetch) in _abandoned or _generations.get((tenant, platform)) != fetch[1]:
+                return False
+    retention_days = getattr(config, 'seen_orders_retention_days', {}).get(platform, DEFAULT_RETENTION_DAYS)
+    now = time.time()
+    with transaction(connect(application_path)) as connection:
+        if cursor is not None:
+            connection.execute(
+                'INSERT INTO cursors (platform, value) VALUES (?, ?) '
+                'ON CONFLICT (platform) DO UPDATE SET value = excluded.value, version = version + 1',
+                (platform, json.dumps(cursor))
+            )
+        connection.executemany(
+            'INSERT OR REPLACE INTO seen_orders (platform, order_id, seen_at) VALUES (?, ?, ?)',
+            ((platform, str(order_id), now) for order_id in seen_order_ids)
+        )
+        connection.execute(
+            'DELETE FROM seen_orders WHERE platform = ? AND seen_at < ?', (platform, now - retention_days * 86400)
+        )
+        # A job still waiting for the same order is kept
+        connection.executemany(
+            'INSERT OR IGNORE INTO jobs (sink, platform, order_id, payload, available_at) VALUES (?, ?, ?, ?, ?)',
+            ((sink, order.platform, str(order.order_id), to_json(order), now) for order in orders for sink in sinks)
+        )
+        connection.executemany('DELETE FROM inbox WHERE id = ?', ((inbox_id,) for inbox_id in inbox_ids))
+    return True
+
+
+def get_estimate(application_path: str, platform: str, order_id) -> Union[Dict, None]:
+    # The QuickBooks estimate created for the order and the hash of the order content it was made from
+    row = connect(application_path).execute(
+        'SELECT estimate_id, sync_token, content_hash FROM estimates WHERE platform = ? AND order_id = ?',
+        (platform, str(order_id))
+    ).fetchone()
+    return {'estimate id': row[0], 'sync token': row[1], 'hash': row[2]} if row else None
+
+
+def save_estimates(application_path: str, estimates: Iterable[Dict]) -> None:
+    # estimates: {'platform', 'order number', 'estimate id', 'sync token', 'hash'}
+    now = time.time()
+    with transaction(connect(application_path)) as connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO estimates (platform, order_id, estimate_id, sync_token, content_hash, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            ((estimate['platform'], str(estimate['order number']), estimate['estimate id'], estimate['sync token'],
+              estimate['hash'], now) for estimate in estimates)
+        )
+
+
+def enqueue(application_path: str, platform: str, payload: str) -> None:
+    # Webhook payloads wait here until the pipeline takes them, a committed payload survives a crash or restart
+    with transaction(connect(application_path)) as connection:
+        connection.execute(
+            'INSERT INTO inbox (platform, payload, received_at) VALUES (?, ?, ?)', (platform, payload, time.time())
+        )
+
+
+def peek_queued(application_path: str, platform: str, after_id: int = 0, limit: int = 1000) -> List[Tuple[int, str]]:
+    # The oldest payloads of the platform with their IDs. They stay in the inbox until save() removes them together
+    # with queuing their orders
+    return connect(application_path).execute(
+        'SELECT id, payload FROM inbox WHERE platform = ? AND id > ? ORDER BY id LIMIT ?', (platform, after_id, limit)
+    ).fetchall()
+
+
+def claim_jobs(
+        application_path: str, sink: str, owner: str, limit: int, lease_seconds: float, exclusive: bool = False
+) -> List[Tuple[int, Order]]:
+    # Leases up to `limit` due jobs of the sink to the owner. A job whose lease runs out, because its worker died,
+    # is claimed again. With exclusive, nothing is claimed while another owner holds a lease on the sink
+    now = time.time()
+    with transaction(connect(application_path)) as connection:
+        if exclusive and connection.execute(
+                'SELECT 1 FROM jobs WHERE sink = ? AND leased_until > ? AND lease_owner != ? LIMIT 1', (sink, now, owner)
+        ).fetchone():
+            return []
+        rows = connection.execute(
+            'SELECT id, payload FROM jobs WHERE sink = ? AND available_at <= ? AND leased_until <= ? ORDER BY id LIMIT ?',
+            (sink, now, now, limit)
+        ).fetchall()
+        connection.executemany(
+            'UPDATE jobs SET lease_owner = ?, leased_until = ?, attempts = attempts + 1 WHERE id = ?',
+            ((owner, now + lease_seconds, row[0]) for row in rows)
+        )
+    return [(row[0], from_json(row[1])) for row in rows]
+
+
+def complete_jobs(application_path: str, owner: str, job_ids: Iterable[int]) -> None:
+    # Only while the lease is the owner's: a job that was claimed again after the lease ran out belongs to the other one
+    with transaction(connect(application_path)) as connection:
+        connection.executemany(
+            'DELETE FROM jobs WHERE id = ? AND lease_owner = ?', ((job_id, owner) for job_id in job_ids)
+        )
+
+
+def set_job_requests(
+        application_path: str, owner: str, requests: Dict[int, Tuple[Union[str, None], Union[str, None]]]
+) -> None:
+    # Remembers the requestid and bId a job's estimate is about to be sent with, {job id: (requestid, bId)}, so the
+    # worker that takes the job over after a crash, or its retry after a lost answer, sends it the same way and
+    # QuickBooks answers with the first response. (None, None) forgets them once QuickBooks answered with a fault
+    with transaction(connect(application_path)) as connection:
+        connection.executemany(
+            'UPDATE jobs SET request_id = ?, batch_item = ? WHERE id = ? AND lease_owner = ?',
+            ((request_id, batch_item, job_id, owner) for job_id, (request_id, batch_item) in requests.items())
+        )
+
+
+def get_job_requests(application_path: str, job_ids: Iterable[int]) -> Dict[int, Tuple[str, str]]:
+    connection = connect(application_path)
+    requests = {}
+    for job_id in job_ids:
+        row = connection.execute(
+            'SELECT request_id, batch_item FROM jobs WHERE id = ? AND request_id IS NOT NULL', (job_id,)
+        ).fetchone()
+        if row:
+            requests[job_id] = (row[0], row[1])
+    return requests
+
+
+def fail_jobs(application_path: str, owner: str, errors: Dict[int, str]) -> int:
+    # Puts the jobs back with an exponential delay, or moves them to dead_jobs after the last attempt.
+    # Returns how many were moved
+    now = time.time()
+    max_attempts = getattr(config, 'job_attempts', DEFAULT_JOB_ATTEMPTS)
+    dead = 0
+    with transaction(connect(application_path)) as connection:
+        for job_id, error in errors.items():
+            row = connection.execute(
+                'SELECT attempts FROM jobs WHERE id = ? AND lease_owner = ?', (job_id, owner)
+            ).fetchone()
+            if not row:
+                continue
+            if row[0] >= max_attempts:
+                connection.execute(
+                    'INSERT OR REPLACE INTO dead_jobs '
+                    '(id, sink, platform, order_id, payload, attempts, error, failed_at, request_id, batch_item) '
+                    'SELECT id, sink, platform, order_id, payload, attempts, ?, ?, request_id, batch_item '
+                    'FROM jobs WHERE id = ?',
+                    (error, now, job_id)
+                )
+                connection.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+                dead += 1
+                continue
+            delay = min(JOB_BACKOFF_BASE * 2 ** (row[0] - 1), JOB_BACKOFF_MAX) * random.uniform(1, 1.5)
+            # The requestid stays, write_quickbooks() only forgets it when QuickBooks answered with a fault
+            connection.execute(
+                'UPDATE jobs SET available_at = ?, leased_until = 0, lease_owner = NULL, last_error = ? WHERE id = ?',
+                (now + delay, error, job_id)
+            )
+    return dead
+
+
+def retry_dead_jobs(application_path: str) -> int:
+    # Queues the dead jobs again with fresh attempts, e.g. after fixing a missing QuickBooks item
+    now = time.time()
+    with transaction(connect(application_path)) as connection:
+        count = connection.execute(
+            'INSERT OR IGNORE INTO jobs (sink, platform, order_id, payload, available_at, request_id, batch_item) '
+            'SELECT sink, platform, order_id, payload, ?, request_id, batch_item FROM dead_jobs', (now,)
+        ).rowcount
+        connection.execute('DELETE FROM dead_jobs')
+    return count
+
+
+def count_jobs(application_path: str) -> Dict[str, int]:
+    connection = connect(application_path)
+    counts = dict(connection.execute('SELECT sink, COUNT(*) FROM jobs GROUP BY sink').fetchall())
+    counts['dead'] = connection.execute('SELECT COUNT(*) FROM dead_jobs').fetchone()[0]
+    return counts
+
+
+def start_fetch(platform: str) -> int:
+    with _abandoned_lock:
+        key = (tenants.get_name(), platform)
+        _generations[key] = _generations.get(key, 0) + 1
+        return _generations[key]
+
+
+@contextlib.contextmanager
+def fetching(platform: str, generation: int):
+    # Runs the fetch of start_fetch() in this context, save() checks it wasn't abandoned or superseded
+    token = _fetch.set((platform, generation))
+    try:
+        yield
+    finally:
+        _fetch.reset(token)
+        with _abandoned_lock:
+            _abandoned.discard((tenants.get_name(), platform, generation))
+
+
+def abandon(platform: str, generation: int) -> None:
+    with _abandoned_lock:
+        _abandoned.add((tenants.get_name(), platform, generation))
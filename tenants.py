@@ -0,0 +1,61 @@
+# Several locations synced by one process. config.tenants maps a tenant name to the settings that differ for it:
+#   tenants = {'toronto': {'shopify_store': '...', 'qb_company_id': '...', 'google_sheet_id': '...'}, 'ottawa': {...}}
+# The modules read their settings through `config` below, which looks in the settings of the current context's tenant
+# first and falls back to config.py. The HTTP sessions stay shared, the QuickBooks rate limit bucket and worker pool
+# are per company, as QuickBooks limits each company on its own
+from typing import Any, Callable, List, Union
+from concurrent.futures import Executor, Future
+import contextlib, contextvars, os
+
+import config as _settings
+
+TENANTS_FOLDER = 'tenants'  # A folder per tenant with its state database, tokens, snapshots and CSV tables
+
+_current = contextvars.ContextVar('tenant', default=None)
+
+
+class _TenantConfig:
+    def __getattr__(self, name: str) -> Any:
+        tenant = _current.get()
+        if tenant is not None:
+            settings = _settings.tenants[tenant]
+            if name in settings:
+                return settings[name]
+        return getattr(_settings, name)
+
+
+config = _TenantConfig()
+
+
+def get_tenants() -> List[str]:
+    # Empty without config.tenants: the process then syncs the one location of config.py, as before
+    return list(getattr(_settings, 'tenants', {}))
+
+
+def get_name() -> Union[str, None]:
+    return _current.get()
+
+
+def get_application_path(application_path: str, tenant: Union[str, None]) -> str:
+    # None is the location of config.py, kept in the application folder itself
+    if tenant is None:
+        return application_path
+    path = os.path.join(application_path, TENANTS_FOLDER, tenant)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextlib.contextmanager
+def use(tenant: str):
+    # with tenants.use('toronto'): every config.x read in this context, and in the calls submitted with submit(),
+    # returns the Toronto setting
+    token = _current.set(tenant)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def submit(executor: Executor, fn: Callable, *args, **kwargs) -> Future:
+    # executor.submit() that keeps the tenant: the pool's threads don't inherit the caller's context
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,67 @@
+#! /usr/bin/python3
+# Writes the orders queued in the state database to Google Sheets and QuickBooks, next to main.py from cron or
+# daemon.py, which queue them. Jobs are claimed with a lease, so a worker that dies only delays its jobs until the
+# lease runs out, failed ones are retried with a growing delay and moved to dead_jobs after config.job_attempts.
+# More processes write QuickBooks estimates faster, the spreadsheet is synced by one of them at a time:
+#   python3 worker.py --processes 4
+#   python3 worker.py --retry-dead
+from logging import getLogger
+import argparse, multiprocessing, os, signal, socket, threading
+
+import config
+import logging_module, main, state, tenants
+
+# Seconds between checks of an empty queue, config.worker_poll_interval overrides it
+DEFAULT_POLL_INTERVAL = 5
+
+
+def work(logger: getLogger, application_path: str, stopping: threading.Event) -> None:
+    owner = f'{socket.gethostname()} {os.getpid()}'
+    while not stopping.is_set():
+        for tenant in tenants.get_tenants() or [None]:
+            with tenants.use(tenant):
+                main.write_queued(
+                    logger=logger,
+                    application_path=tenants.get_application_path(application_path, tenant),
+                    local_time=main.get_local_time(),
+                    owner=owner
+                )
+        if logging_module.metrics.counters:
+            logging_module.write_metrics(application_path=application_path, logger=logger)
+        stopping.wait(getattr(config, 'worker_poll_interval', DEFAULT_POLL_INTERVAL))
+
+
+def run_process(application_path: str) -> None:
+    logger = logging_module.get_logger(application_path=application_path, local_time=main.get_local_time())
+    stopping = threading.Event()
+    # The lease of the running claim is kept until it's written, then the loop ends
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    work(logger=logger, application_path=application_path, stopping=stopping)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the queued orders to Google Sheets and QuickBooks')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--retry-dead', action='store_true', help='Queue the dead jobs again and exit')
+    args = parser.parse_args()
+    applicationPath = os.path.abspath(os.path.dirname(__file__))
+
+    if args.retry_dead:
+        for tenant in tenants.get_tenants() or [None]:
+            count = state.retry_dead_jobs(tenants.get_application_path(applicationPath, tenant))
+            print(f'{tenant or "config.py"}: {count} jobs queued again')
+    elif args.processes == 1:
+        run_process(applicationPath)
+    else:
+        processes = [
+            multiprocessing.get_context('spawn').Process(target=run_process, args=(applicationPath,))
+            for _ in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        # Ctrl+C reaches the whole process group, SIGTERM is passed on
+        signal.signal(signal.SIGTERM, lambda signum, frame: [process.terminate() for process in processes])
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for process in processes:
+            process.join()